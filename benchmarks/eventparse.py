@@ -0,0 +1,181 @@
+'''
+How many events per second carml.eventparse decodes, compared to the
+ad-hoc splitting the commands used to do themselves.
+
+For each event type we generate (seeded) payloads like a busy Tor's
+and time decoding all of them both ways, reading the same fields::
+
+    python -m benchmarks.eventparse
+    python -m benchmarks.eventparse --count 200000 --json parse.json
+'''
+import json
+import time
+import random
+import platform
+
+import click
+
+from carml import eventparse
+from carml.eventfilter import keyword_finder
+
+
+def _fingerprint(rng):
+    return '$' + ''.join(rng.choice('0123456789ABCDEF') for _ in range(40))
+
+
+def make_events(count, seed=0):
+    """
+    :returns: dict mapping event name to a list of `count` payloads.
+    """
+    rng = random.Random(seed)
+    now = '2024-01-02T03:04:05.000000'
+
+    def circ(i):
+        path = ','.join('{}~relay{}'.format(_fingerprint(rng), rng.randrange(8000)) for _ in range(3))
+        status = rng.choice(['EXTENDED', 'BUILT', 'CLOSED'])
+        text = '{} {} {} BUILD_FLAGS=NEED_CAPACITY PURPOSE=GENERAL TIME_CREATED={}'.format(i, status, path, now)
+        if status == 'CLOSED':
+            text += ' REASON=FINISHED'
+        return text
+
+    def stream(i):
+        return '{} {} {} www{}.example.com:443 SOURCE_ADDR=127.0.0.1:{} PURPOSE=USER'.format(
+            i, rng.choice(['NEW', 'SENTCONNECT', 'SUCCEEDED', 'CLOSED']),
+            rng.randrange(1, 10000), i, rng.randrange(1025, 65536),
+        )
+
+    def stream_bw(i):
+        return '{} {} {}'.format(i, rng.randrange(65536), rng.randrange(65536))
+
+    def circ_bw(i):
+        return 'ID={} READ={} WRITTEN={}'.format(rng.randrange(1, 10000), rng.randrange(65536), rng.randrange(65536))
+
+    def bw(i):
+        return '{} {}'.format(rng.randrange(1 << 20), rng.randrange(1 << 20))
+
+    makers = [('CIRC', circ), ('STREAM', stream), ('STREAM_BW', stream_bw), ('CIRC_BW', circ_bw), ('BW', bw)]
+    return {name: [make(i) for i in range(1, count + 1)] for name, make in makers}
+
+
+_read = keyword_finder('READ')
+_written = keyword_finder('WRITTEN')
+
+
+# The old ways of getting fields out of each event; each reads the
+# same fields, as the same types, as its eventparse version below.
+
+def adhoc_circ(text):
+    # split everything, like txtorcon's CIRC handling
+    words = text.split()
+    keywords = dict(word.split('=', 1) for word in words[2:] if '=' in word)
+    return int(words[0]), words[1], keywords.get('PURPOSE')
+
+
+def adhoc_stream(text):
+    # close_stream
+    sid, status, _ = text.split(' ', 2)
+    return int(sid), status
+
+
+def adhoc_stream_bw(text):
+    # stream --follow
+    sid, written, read = [int(x) for x in text.split()]
+    return read, written
+
+
+def adhoc_circ_bw(text):
+    # events --aggregate
+    return int(_read(text) or 0), int(_written(text) or 0)
+
+
+def adhoc_bw(text):
+    # graph
+    read, written = (int(x) for x in text.split())
+    return read, written
+
+
+def typed_circ(text, CircEvent=eventparse.CircEvent):
+    event = CircEvent(text)
+    return event.id, event.status, event.purpose
+
+
+def typed_stream(text, StreamEvent=eventparse.StreamEvent):
+    event = StreamEvent(text)
+    return event.id, event.status
+
+
+def typed_stream_bw(text, StreamBwEvent=eventparse.StreamBwEvent):
+    event = StreamBwEvent(text)
+    return event.read, event.written
+
+
+def typed_circ_bw(text, CircBwEvent=eventparse.CircBwEvent):
+    event = CircBwEvent(text)
+    return event.read, event.written
+
+
+def typed_bw(text, BwEvent=eventparse.BwEvent):
+    event = BwEvent(text)
+    return event.read, event.written
+
+
+#: event name -> (ad-hoc, eventparse) ways of decoding it
+PARSERS = {
+    'CIRC': (adhoc_circ, typed_circ),
+    'STREAM': (adhoc_stream, typed_stream),
+    'STREAM_BW': (adhoc_stream_bw, typed_stream_bw),
+    'CIRC_BW': (adhoc_circ_bw, typed_circ_bw),
+    'BW': (adhoc_bw, typed_bw),
+}
+
+
+def measure(parsers, texts, repeat):
+    """
+    :returns: the best time (in seconds) of `repeat` runs of each of
+        `parsers` over all of `texts` (taking turns, so they all see
+        the same noise from the rest of the machine).
+    """
+    best = [None] * len(parsers)
+    for parse in parsers:
+        for text in texts[:1000]:
+            parse(text)
+    for _ in range(repeat):
+        for i, parse in enumerate(parsers):
+            start = time.perf_counter()
+            for text in texts:
+                parse(text)
+            elapsed = time.perf_counter() - start
+            if best[i] is None or elapsed < best[i]:
+                best[i] = elapsed
+    return best
+
+
+@click.command()
+@click.option('--count', '-n', default=100000, help='Events of each type to decode.')
+@click.option('--repeat', '-r', default=5, help='Number of timed runs of each.')
+@click.option('--seed', default=0, help='Random seed for the events.')
+@click.option('--json', 'json_out', type=click.File('w'), default=None, help='Also write JSON results to this file.')
+def main(count, repeat, seed, json_out):
+    events = make_events(count, seed)
+    results = {}
+    print("  {:<10} {:>14} {:>14} {:>8}".format('event', 'ad-hoc/s', 'eventparse/s', 'change'))
+    for name, texts in events.items():
+        adhoc, typed = (len(texts) / best for best in measure(PARSERS[name], texts, repeat))
+        results[name] = {'adhoc_per_s': adhoc, 'eventparse_per_s': typed}
+        print("  {:<10} {:>14,.0f} {:>14,.0f} {:>+7.1f}%".format(name, adhoc, typed, (typed - adhoc) / adhoc * 100.0))
+
+    if json_out is not None:
+        json.dump({
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'count': count,
+            'repeat': repeat,
+            'seed': seed,
+            'results': results,
+        }, json_out, indent=2, sort_keys=True)
+        json_out.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,471 @@
+'''
+A stand-in Tor control-port, for load-testing carml without a Tor.
+
+This speaks just enough of the control-protocol for txtorcon.connect()
+and Tor.create_state() to work: NULL authentication, the GETINFO keys
+that bootstrapping asks for, a synthetic consensus of N routers and a
+handful of BUILT circuits. On top of that it generates configurable
+storms of CIRC, STREAM, STREAM_BW, CIRC_BW, BW and NEWCONSENSUS events
+to every connection that subscribed to them::
+
+    python -m benchmarks.faketor --listen tcp:9999 --routers 8000 --rate STREAM=500 --rate BW=1
+
+CIRC and STREAM events carry an extra CARML_TS=<epoch> keyword (which
+real Tor doesn't send; parsers ignore unknown keywords) so drivers can
+measure end-to-end latency.
+'''
+import os
+import time
+import base64
+import random
+import itertools
+
+import click
+from twisted.internet import reactor, task, endpoints
+from twisted.internet.protocol import Factory
+from twisted.protocols.basic import LineOnlyReceiver
+
+
+ALL_EVENTS = (
+    'CIRC STREAM ORCONN BW DEBUG INFO NOTICE WARN ERR NEWDESC ADDRMAP '
+    'AUTHDIR_NEWDESCS DESCCHANGED STATUS_GENERAL STATUS_CLIENT STATUS_SERVER '
+    'GUARD NS STREAM_BW CLIENTS_SEEN NEWCONSENSUS BUILDTIMEOUT_SET SIGNAL '
+    'CONF_CHANGED CIRC_MINOR TRANSPORT_LAUNCHED CONN_BW CIRC_BW CELL_STATS '
+    'HS_DESC HS_DESC_CONTENT NETWORK_LIVENESS'
+)
+SIGNALS = 'RELOAD HUP SHUTDOWN DUMP USR1 DEBUG USR2 HALT TERM INT NEWNYM CLEARDNSCACHE HEARTBEAT ACTIVE DORMANT'
+MULTILINE_KEYS = ('ns/all', 'circuit-status', 'stream-status', 'config/names', 'entry-guards')
+FLAG_CHOICES = ['Exit', 'Fast', 'Guard', 'HSDir', 'Running', 'Stable', 'V2Dir', 'Valid']
+COUNTRIES = ['de', 'nl', 'us', 'fr', 'se', 'ch', 'ro', 'ca']
+EXIT_POLICIES = ['accept 80,443', 'accept 1-65535', 'reject 25,119,135-139,445,563,1214,4661-4666,6346-6429,6699,6881-6999', 'accept 22,53,80,443,993,995']
+
+
+def _b64(raw):
+    return base64.b64encode(raw).decode('ascii').rstrip('=')
+
+
+class FakeRouter(object):
+    __slots__ = ('nickname', 'idhash', 'orhash', 'id_hex', 'ip', 'orport', 'dirport', 'flags', 'bandwidth', 'country', 'policy')
+
+    def __init__(self, rng, index):
+        ident = bytes(rng.getrandbits(8) for _ in range(20))
+        self.nickname = 'fake{}'.format(index)
+        self.idhash = _b64(ident)
+        self.orhash = _b64(bytes(rng.getrandbits(8) for _ in range(20)))
+        self.id_hex = '$' + ident.hex().upper()
+        self.ip = '10.{}.{}.{}'.format(rng.randint(0, 255), rng.randint(0, 255), rng.randint(1, 254))
+        self.orport = 9001
+        self.dirport = 0
+        self.flags = sorted(set(['Running', 'Valid'] + rng.sample(FLAG_CHOICES, 3)))
+        self.bandwidth = rng.randint(20, 200000)
+        # from the identity, so the rest of the consensus is the same
+        # for a given seed as it always was
+        self.country = COUNTRIES[ident[0] % len(COUNTRIES)]
+        self.policy = EXIT_POLICIES[ident[1] % len(EXIT_POLICIES)] if 'Exit' in self.flags else 'reject 1-65535'
+
+    def ns_lines(self, published):
+        return [
+            'r {} {} {} {} {} {} {}'.format(
+                self.nickname, self.idhash, self.orhash, published,
+                self.ip, self.orport, self.dirport,
+            ),
+            's ' + ' '.join(self.flags),
+            'w Bandwidth={}'.format(self.bandwidth),
+            'p ' + self.policy,
+        ]
+
+    @property
+    def long_name(self):
+        return '{}~{}'.format(self.id_hex, self.nickname)
+
+
+class FakeNetwork(object):
+    """
+    The state shared by all connections: a consensus, some circuits
+    and streams, and counters for the ids of new ones.
+    """
+
+    def __init__(self, num_routers, num_circuits, seed=None):
+        self._rng = random.Random(seed)
+        self.routers = [FakeRouter(self._rng, i) for i in range(num_routers)]
+        self.by_id = {r.id_hex[1:]: r for r in self.routers}
+        self.by_ip = {r.ip: r for r in self.routers}
+        self.guards = [r for r in self.routers if 'Guard' in r.flags] or self.routers
+        self.valid_after = None
+        self._consensus = None
+        self.new_consensus()
+        self.circuits = {}      # id -> path (list of FakeRouter)
+        self.streams = {}       # id -> circuit id
+        self._circ_ids = itertools.count(1)
+        self._stream_ids = itertools.count(1)
+        for _ in range(num_circuits):
+            self.circuits[next(self._circ_ids)] = self.random_path()
+        # streams only ever go on these, so storms of CIRC events
+        # don't leave streams pointing at closed circuits
+        self.stable_circuits = list(self.circuits.keys())
+
+    def new_consensus(self):
+        self.valid_after = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())
+        lines = []
+        for r in self.routers:
+            lines.extend(r.ns_lines(self.valid_after))
+        self._consensus = '\r\n'.join(lines)
+        return self._consensus
+
+    def consensus(self):
+        return self._consensus
+
+    def random_path(self):
+        return [self._rng.choice(self.guards)] + self._rng.sample(self.routers, 2)
+
+    def circuit_line(self, circid, status='BUILT'):
+        return '{} {} {} BUILD_FLAGS=NEED_CAPACITY PURPOSE=GENERAL TIME_CREATED={}'.format(
+            circid, status,
+            ','.join(r.long_name for r in self.circuits[circid]),
+            time.strftime('%Y-%m-%dT%H:%M:%S.000000', time.gmtime()),
+        )
+
+    def next_circuit_id(self):
+        return next(self._circ_ids)
+
+    def next_stream_id(self):
+        return next(self._stream_ids)
+
+    def any_circuit(self):
+        return self._rng.choice(self.stable_circuits)
+
+    def close_circuit(self, circid):
+        del self.circuits[circid]
+        if circid in self.stable_circuits:
+            self.stable_circuits.remove(circid)
+        for sid, cid in list(self.streams.items()):
+            if cid == circid:
+                del self.streams[sid]
+
+    def random_bytes(self):
+        return self._rng.randint(0, 65536)
+
+    def random_port(self):
+        return self._rng.randint(1025, 65535)
+
+    def getinfo(self, key):
+        """
+        Returns the value for a GETINFO key, or None if we don't know
+        about it.
+        """
+        simple = {
+            'version': '0.4.8.9 (fake)',
+            'status/version/current': 'recommended',
+            'dormant': '0',
+            'signal/names': SIGNALS,
+            'events/names': ALL_EVENTS,
+            'process/pid': str(os.getpid()),
+            'net/listeners/socks': '"127.0.0.1:9050"',
+            'consensus/valid-after': self.valid_after,
+            'config/names': 'DataDirectory Filename',
+        }
+        if key in simple:
+            return simple[key]
+        if key == 'ns/all':
+            return self._consensus
+        if key == 'circuit-status':
+            return '\r\n'.join(self.circuit_line(cid) for cid in sorted(self.circuits))
+        if key == 'stream-status':
+            return '\r\n'.join(
+                '{} SUCCEEDED {} example.com:443'.format(sid, cid)
+                for sid, cid in sorted(self.streams.items())
+            )
+        if key in ('address-mappings/all', 'entry-guards'):
+            return ''
+        if key.startswith('ip-to-country/'):
+            router = self.by_ip.get(key[len('ip-to-country/'):])
+            return router.country if router is not None else '??'
+        return None
+
+
+class FakeTorControlProtocol(LineOnlyReceiver):
+    delimiter = b'\r\n'
+    MAX_LENGTH = 2 ** 20
+
+    def connectionMade(self):
+        self.events = set()
+        self.factory.connections.add(self)
+
+    def connectionLost(self, reason):
+        self.factory.connections.discard(self)
+
+    def send_lines(self, lines):
+        self.transport.write(('\r\n'.join(lines) + '\r\n').encode('ascii'))
+
+    def event(self, name, payload):
+        if name in self.events:
+            self.send_lines(['650 {} {}'.format(name, payload)])
+
+    def lineReceived(self, line):
+        line = line.decode('ascii')
+        verb, _, rest = line.partition(' ')
+        handler = getattr(self, 'do_' + verb.upper(), None)
+        if handler is None:
+            self.send_lines(['510 Unrecognized command "{}"'.format(verb)])
+        else:
+            handler(rest)
+
+    def do_PROTOCOLINFO(self, rest):
+        self.send_lines([
+            '250-PROTOCOLINFO 1',
+            '250-AUTH METHODS=NULL',
+            '250-VERSION Tor="0.4.8.9"',
+            '250 OK',
+        ])
+
+    def do_GETINFO(self, rest):
+        lines = []
+        for key in rest.split():
+            value = self.factory.network.getinfo(key)
+            if value is None:
+                self.send_lines(['552 Unrecognized key "{}"'.format(key)])
+                return
+            if '\n' in value or key in MULTILINE_KEYS:
+                lines.append('250+{}='.format(key))
+                if value:
+                    lines.append(value)
+                lines.append('.')
+            else:
+                lines.append('250-{}={}'.format(key, value))
+        lines.append('250 OK')
+        self.send_lines(lines)
+
+    def do_GETCONF(self, rest):
+        keys = rest.split()
+        lines = ['250-{}='.format(k) for k in keys[:-1]]
+        lines.append('250 {}='.format(keys[-1]))
+        self.send_lines(lines)
+
+    def do_SETEVENTS(self, rest):
+        self.events = set(rest.split())
+        self.send_lines(['250 OK'])
+
+    def do_SIGNAL(self, rest):
+        self.send_lines(['250 OK'])
+        self.event('SIGNAL', rest.strip())
+
+    def do_EXTENDCIRCUIT(self, rest):
+        net = self.factory.network
+        circid = net.next_circuit_id()
+        words = rest.split()
+        path = None
+        if len(words) > 1 and '=' not in words[1]:
+            # the path asked for (fingerprints, maybe with ~nickname)
+            path = [net.by_id.get(name.lstrip('$').split('~')[0].upper()) for name in words[1].split(',')]
+            if None in path:
+                self.send_lines(['552 No such router "{}"'.format(words[1])])
+                return
+        net.circuits[circid] = path or net.random_path()
+        self.send_lines(['250 EXTENDED {}'.format(circid)])
+        for status in ('LAUNCHED', 'EXTENDED', 'BUILT'):
+            self.factory.broadcast('CIRC', net.circuit_line(circid, status))
+
+    def do_CLOSECIRCUIT(self, rest):
+        net = self.factory.network
+        circid = int(rest.split()[0])
+        if circid not in net.circuits:
+            self.send_lines(['552 Unknown circuit "{}"'.format(circid)])
+            return
+        self.send_lines(['250 OK'])
+        line = net.circuit_line(circid, 'CLOSED') + ' REASON=REQUESTED'
+        net.close_circuit(circid)
+        self.factory.broadcast('CIRC', line)
+
+    def do_QUIT(self, rest):
+        self.send_lines(['250 closing connection'])
+        self.transport.loseConnection()
+
+    def _ok(self, rest):
+        self.send_lines(['250 OK'])
+
+    do_AUTHENTICATE = _ok
+    do_USEFEATURE = _ok
+    do_SETCONF = _ok
+    do_RESETCONF = _ok
+    do_TAKEOWNERSHIP = _ok
+    do_ATTACHSTREAM = _ok
+    do_CLOSESTREAM = _ok
+
+
+class FakeTorFactory(Factory):
+    protocol = FakeTorControlProtocol
+
+    def __init__(self, network):
+        self.network = network
+        self.connections = set()
+        self.sent = 0
+
+    def broadcast(self, name, payload):
+        for proto in self.connections:
+            if name in proto.events:
+                proto.event(name, payload)
+                self.sent += 1
+
+    def broadcast_consensus(self):
+        lines = ['650+NEWCONSENSUS', self.network.new_consensus(), '.', '650 OK']
+        for proto in self.connections:
+            if 'NEWCONSENSUS' in proto.events:
+                proto.send_lines(lines)
+                self.sent += 1
+
+
+class EventStorm(object):
+    """
+    Emits events at the configured per-type rates (events/second),
+    in batches on a fixed tick.
+    """
+    TICK = 0.01
+
+    def __init__(self, factory, rates):
+        self._factory = factory
+        self._net = factory.network
+        self._rates = rates
+        self._owed = {name: 0.0 for name in rates}
+        self._storm_circuits = []   # circuits we launched, to close later
+        self._storm_streams = []    # (stream-id, circuit-id, target)
+        self._loop = task.LoopingCall(self._tick)
+
+    def start(self):
+        self._loop.start(self.TICK, now=False)
+
+    def _tick(self):
+        for name, rate in self._rates.items():
+            self._owed[name] += rate * self.TICK
+            count = int(self._owed[name])
+            self._owed[name] -= count
+            for _ in range(count):
+                getattr(self, '_event_' + name)()
+
+    def _event_CIRC(self):
+        net = self._net
+        # alternate between launching a new circuit and closing an old one
+        if len(self._storm_circuits) > 50 or (self._storm_circuits and random.random() < 0.5):
+            circid = self._storm_circuits.pop(0)
+            line = net.circuit_line(circid, 'CLOSED') + ' REASON=FINISHED'
+            net.close_circuit(circid)
+        else:
+            circid = net.next_circuit_id()
+            net.circuits[circid] = net.random_path()
+            self._storm_circuits.append(circid)
+            line = net.circuit_line(circid, 'BUILT')
+        self._factory.broadcast('CIRC', '{} CARML_TS={:.6f}'.format(line, time.time()))
+
+    def _event_STREAM(self):
+        net = self._net
+        ts = time.time()
+        if len(self._storm_streams) > 200 or (self._storm_streams and random.random() < 0.5):
+            sid, circid, target = self._storm_streams.pop(0)
+            net.streams.pop(sid, None)
+            if circid not in net.circuits:
+                circid = 0
+            line = '{} CLOSED {} {} REASON=DONE CARML_TS={:.6f}'.format(sid, circid, target, ts)
+        else:
+            sid = net.next_stream_id()
+            circid = net.any_circuit()
+            target = 'www{}.example.com:443'.format(sid)
+            net.streams[sid] = circid
+            self._storm_streams.append((sid, circid, target))
+            line = '{} SUCCEEDED {} {} SOURCE_ADDR=127.0.0.1:{} PURPOSE=USER CARML_TS={:.6f}'.format(
+                sid, circid, target, net.random_port(), ts,
+            )
+        self._factory.broadcast('STREAM', line)
+
+    def _event_STREAM_BW(self):
+        if self._storm_streams:
+            sid = self._storm_streams[-1][0]
+        else:
+            sid = 1
+        self._factory.broadcast(
+            'STREAM_BW',
+            '{} {} {}'.format(sid, self._net.random_bytes(), self._net.random_bytes()),
+        )
+
+    def _event_CIRC_BW(self):
+        self._factory.broadcast(
+            'CIRC_BW',
+            'ID={} READ={} WRITTEN={}'.format(
+                self._net.any_circuit(), self._net.random_bytes(), self._net.random_bytes(),
+            ),
+        )
+
+    def _event_BW(self):
+        self._factory.broadcast(
+            'BW', '{} {}'.format(self._net.random_bytes(), self._net.random_bytes()),
+        )
+
+    def _event_NEWCONSENSUS(self):
+        self._factory.broadcast_consensus()
+
+
+EVENT_TYPES = ['CIRC', 'STREAM', 'STREAM_BW', 'CIRC_BW', 'BW', 'NEWCONSENSUS']
+
+
+def parse_rates(rates):
+    parsed = {}
+    for r in rates:
+        name, _, value = r.partition('=')
+        name = name.upper()
+        if name not in EVENT_TYPES:
+            raise click.BadParameter(
+                '"{}" is not one of {}'.format(name, ', '.join(EVENT_TYPES))
+            )
+        try:
+            parsed[name] = float(value)
+        except ValueError:
+            raise click.BadParameter('"{}" is not an events/second rate'.format(value))
+    return parsed
+
+
+def listen(reactor, endpoint, routers=100, circuits=10, rates=None, seed=None):
+    """
+    Start a fake control-port listening on `endpoint` (a Twisted
+    server endpoint string). Returns a Deferred that fires with
+    (factory, listening-port).
+    """
+    network = FakeNetwork(routers, circuits, seed=seed)
+    factory = FakeTorFactory(network)
+    ep = endpoints.serverFromString(reactor, endpoint)
+    d = ep.listen(factory)
+
+    def _listening(port):
+        if rates:
+            EventStorm(factory, rates).start()
+        return factory, port
+    d.addCallback(_listening)
+    return d
+
+
+@click.command()
+@click.option('--listen', 'endpoint', default='tcp:9999:interface=127.0.0.1', help='Twisted server endpoint to listen on.')
+@click.option('--routers', default=8000, help='Number of routers in the synthetic consensus.')
+@click.option('--circuits', default=10, help='Number of initially-BUILT circuits.')
+@click.option('--rate', multiple=True, help='EVENT=per-second, e.g. STREAM=500. Accepted multiple times.')
+@click.option('--seed', default=None, type=int, help='Random seed (for repeatable consensuses).')
+def main(endpoint, routers, circuits, rate, seed):
+    rates = parse_rates(rate)
+
+    def _started(result):
+        factory, port = result
+        # the driver in load.py reads these lines
+        print("fake Tor listening on port {} ({} routers, {} circuits)".format(
+            port.getHost().port, routers, circuits), flush=True)
+
+        def _stats():
+            print("sent {} events".format(factory.sent), flush=True)
+        reactor.addSystemEventTrigger('before', 'shutdown', _stats)
+
+    def _failed(fail):
+        print("Error: {}".format(fail.getErrorMessage()))
+        reactor.stop()
+    d = listen(reactor, endpoint, routers, circuits, rates, seed)
+    d.addCallbacks(_started, _failed)
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main()
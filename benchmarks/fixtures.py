@@ -0,0 +1,88 @@
+'''
+Synthetic stand-ins for txtorcon's TorState, Router, Circuit and
+Stream, with just the attributes carml's formatting code uses.
+
+Everything is generated from a seed, so the same sizes give the same
+fixture on every run (and results stay comparable).
+'''
+import os
+import random
+import datetime
+
+
+class FakeLocation(object):
+    def __init__(self, ip, countrycode, asn=None, city=None):
+        self.ip = ip
+        self.countrycode = countrycode
+        self.asn = asn
+        self.city = city
+
+
+class FakeRouter(object):
+    def __init__(self, rng, index):
+        self.name = 'relay{}'.format(index)
+        self.id_hex = '$' + ''.join(rng.choice('0123456789ABCDEF') for _ in range(40))
+        self.name_is_unique = rng.random() < 0.9
+        self.ip = '10.{}.{}.{}'.format(rng.randrange(256), rng.randrange(256), rng.randrange(1, 255))
+        self.location = FakeLocation(
+            self.ip,
+            rng.choice(['DE', 'US', 'FR', 'NL', 'SE', 'CA', 'RO', 'CH']),
+            asn='AS{} Some Hosting Ltd'.format(rng.randrange(1000, 65000)),
+            city=['Somewhere'],
+        )
+        self.flags = ['fast', 'running', 'valid']
+        self.from_consensus = True
+
+
+class FakeCircuit(object):
+    def __init__(self, rng, circid, routers, now):
+        self.id = circid
+        self.path = rng.sample(routers, 3)
+        self.state = rng.choice(['BUILT'] * 8 + ['EXTENDED', 'FAILED'])
+        self.purpose = rng.choice(['GENERAL'] * 6 + ['HS_CLIENT_REND', 'CONFLUX_LINKED'])
+        self.time_created = now - datetime.timedelta(seconds=rng.randrange(1, 3600))
+        self.flags = {
+            'BUILD_FLAGS': 'NEED_CAPACITY',
+            'PURPOSE': self.purpose,
+            'TIME_CREATED': self.time_created.isoformat(),
+        }
+
+    def age(self, now=None):
+        if now is None:
+            now = datetime.datetime.utcnow()
+        return (now - self.time_created).seconds
+
+
+class FakeStream(object):
+    def __init__(self, rng, streamid, circuit):
+        self.id = streamid
+        self.circuit = circuit
+        self.state = 'SUCCEEDED'
+        self.target_host = 'www{}.example.com'.format(streamid)
+        self.target_addr = None
+        self.target_port = rng.choice([80, 443, 443, 443, 22])
+        # anything else would make process_from_address() run lsof
+        self.source_addr = rng.choice([None, '(Tor_internal)'])
+        self.source_port = 0
+        self.flags = {'PURPOSE': 'USER'}
+
+
+class FakeState(object):
+    def __init__(self, routers, circuits, streams):
+        self.routers = {r.id_hex: r for r in routers}
+        self.all_routers = set(routers)
+        self.circuits = {c.id: c for c in circuits}
+        self.streams = {s.id: s for s in streams}
+        self.tor_pid = os.getpid()
+
+
+def make_state(routers=8000, circuits=10000, streams=50000, seed=0):
+    rng = random.Random(seed)
+    now = datetime.datetime.utcnow()
+    all_routers = [FakeRouter(rng, i) for i in range(routers)]
+    all_circuits = [FakeCircuit(rng, i + 1, all_routers, now) for i in range(circuits)]
+    all_streams = [
+        FakeStream(rng, i + 1, all_circuits[rng.randrange(circuits)])
+        for i in range(streams)
+    ]
+    return FakeState(all_routers, all_circuits, all_streams)
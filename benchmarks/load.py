@@ -0,0 +1,229 @@
+'''
+End-to-end load test: runs carml commands against a fake Tor.
+
+For each command, this starts a fresh fake control-port (faketor.py)
+with a synthetic consensus and the given event storm, runs the carml
+command against it with --json for a while, and reports:
+
+ * throughput: events the fake Tor sent, and records carml printed,
+   per second;
+ * latency: from the fake Tor stamping a CIRC or STREAM event (its
+   CARML_TS keyword) until carml's record for it reached us;
+ * peak RSS of the carml process (from /proc, so Linux only).
+
+For example::
+
+    python -m benchmarks.load
+    python -m benchmarks.load --routers 8000 --rate STREAM=2000 --rate STREAM_BW=5000 --duration 30
+    python -m benchmarks.load --command events --command monitor --json results.json
+'''
+import os
+import re
+import sys
+import json
+import time
+import signal
+import tempfile
+import selectors
+import subprocess
+
+import click
+
+from benchmarks.faketor import parse_rates
+
+
+COMMANDS = {
+    'monitor': ['monitor'],
+    'events': ['events', 'CIRC', 'STREAM', 'STREAM_BW', 'BW', 'NEWCONSENSUS'],
+    'stream': ['stream', '--follow'],
+    'graph': ['graph'],
+}
+
+DEFAULT_RATES = ('CIRC=50', 'STREAM=500', 'STREAM_BW=1000', 'BW=1', 'NEWCONSENSUS=0.05')
+
+_carml_ts = re.compile(r'CARML_TS\W+([0-9]+\.[0-9]+)')
+
+
+def start_fake_tor(routers, circuits, rates, seed):
+    """
+    :returns: (Popen, port) for a fake Tor listening on localhost.
+    """
+    args = [
+        sys.executable, '-m', 'benchmarks.faketor',
+        '--listen', 'tcp:0:interface=127.0.0.1',
+        '--routers', str(routers),
+        '--circuits', str(circuits),
+        '--seed', str(seed),
+    ]
+    for rate in rates:
+        args.extend(['--rate', rate])
+    proc = subprocess.Popen(args, stdout=subprocess.PIPE, universal_newlines=True)
+    line = proc.stdout.readline()
+    match = re.search(r'listening on port ([0-9]+)', line)
+    if match is None:
+        proc.kill()
+        raise click.ClickException("fake Tor didn't start: {}".format(line.strip() or 'no output'))
+    return proc, int(match.group(1))
+
+
+def stop_fake_tor(proc):
+    """
+    :returns: how many events the fake Tor sent.
+    """
+    proc.send_signal(signal.SIGINT)
+    out, _ = proc.communicate()
+    match = re.search(r'sent ([0-9]+) events', out)
+    return int(match.group(1)) if match else None
+
+
+def peak_rss(pid):
+    """
+    :returns: the peak resident set size of `pid` in bytes, or None.
+    """
+    try:
+        with open('/proc/{}/status'.format(pid)) as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError):
+        pass
+    return None
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+
+def run_command(name, port, duration):
+    """
+    Runs carml `name` against the fake Tor on `port` for `duration`
+    seconds (after its first record) and collects statistics.
+    """
+    args = [
+        sys.executable, '-m', 'carml',
+        '--connect', 'tcp:127.0.0.1:{}'.format(port),
+        '--json', '--no-consensus-cache',
+    ] + COMMANDS[name]
+    launched = time.time()
+    # a file, so carml can never block on a full stderr pipe
+    errors = tempfile.TemporaryFile()
+    proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=errors)
+
+    records = 0
+    latencies = []
+    first = None
+    partial = b''
+    selector = selectors.DefaultSelector()
+    selector.register(proc.stdout, selectors.EVENT_READ)
+    deadline = launched + duration + 60.0  # generous time to connect
+    while time.time() < deadline:
+        if not selector.select(timeout=max(0.0, deadline - time.time())):
+            continue
+        data = os.read(proc.stdout.fileno(), 1 << 16)
+        if not data:
+            break
+        now = time.time()
+        if first is None:
+            first = now
+            deadline = now + duration
+        lines = (partial + data).split(b'\n')
+        partial = lines.pop()
+        records += len(lines)
+        for line in lines:
+            match = _carml_ts.search(line.decode('utf8', 'replace'))
+            if match:
+                latencies.append(now - float(match.group(1)))
+
+    rss = peak_rss(proc.pid)
+    exited = proc.poll()
+    if exited is None:
+        proc.send_signal(signal.SIGINT)
+    try:
+        proc.communicate(timeout=10)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.communicate()
+    if exited is not None and first is None:
+        errors.seek(0)
+        raise click.ClickException(
+            "carml {} exited with {}:\n{}".format(name, exited, errors.read().decode('utf8', 'replace'))
+        )
+    errors.close()
+
+    elapsed = (time.time() if first is None else min(time.time(), deadline)) - (first or launched)
+    return {
+        'startup_s': (first - launched) if first else None,
+        'elapsed_s': elapsed,
+        'records': records,
+        'records_per_s': records / elapsed if elapsed else 0.0,
+        'latency_samples': len(latencies),
+        'latency_p50_ms': _ms(percentile(latencies, 50)),
+        'latency_p95_ms': _ms(percentile(latencies, 95)),
+        'latency_p99_ms': _ms(percentile(latencies, 99)),
+        'latency_max_ms': _ms(max(latencies) if latencies else None),
+        'peak_rss_bytes': rss,
+    }
+
+
+def _ms(seconds):
+    return None if seconds is None else seconds * 1000.0
+
+
+def _fmt(value, spec):
+    return '-' if value is None else format(value, spec)
+
+
+@click.command()
+@click.option('--command', '-c', 'commands', multiple=True, type=click.Choice(sorted(COMMANDS)), help='Command to load-test (may be repeated; default: all).')
+@click.option('--routers', default=8000, help='Routers in the fake consensus.')
+@click.option('--circuits', default=50, help='Circuits the fake Tor starts with.')
+@click.option('--rate', multiple=True, help='EVENT=per-second for the fake Tor\'s storm (may be repeated; default: {}).'.format(' '.join(DEFAULT_RATES)))
+@click.option('--duration', '-d', default=20.0, help='Seconds to run each command for, once it is printing.')
+@click.option('--seed', default=0, help='Random seed for the fake consensus.')
+@click.option('--json', 'json_out', type=click.File('w'), default=None, help='Also write JSON results to this file.')
+def main(commands, routers, circuits, rate, duration, seed, json_out):
+    rates = rate or DEFAULT_RATES
+    parse_rates(rates)  # complain about bad ones before starting anything
+    commands = commands or sorted(COMMANDS)
+
+    results = {}
+    for name in commands:
+        fake, port = start_fake_tor(routers, circuits, rates, seed)
+        try:
+            result = run_command(name, port, duration)
+        finally:
+            sent = stop_fake_tor(fake)
+        result['events_sent'] = sent
+        result['events_per_s'] = sent / result['elapsed_s'] if sent and result['elapsed_s'] else None
+        results[name] = result
+        print(
+            "  {:<8} {:>9} events/s sent  {:>9} records/s  latency p50 {:>8}ms p99 {:>8}ms max {:>8}ms  "
+            "peak RSS {:>6}MiB  start-up {}s".format(
+                name,
+                _fmt(result['events_per_s'], '.0f'),
+                _fmt(result['records_per_s'], '.0f'),
+                _fmt(result['latency_p50_ms'], '.1f'),
+                _fmt(result['latency_p99_ms'], '.1f'),
+                _fmt(result['latency_max_ms'], '.1f'),
+                _fmt(result['peak_rss_bytes'] and result['peak_rss_bytes'] / (1024.0 * 1024.0), '.1f'),
+                _fmt(result['startup_s'], '.2f'),
+            )
+        )
+
+    if json_out is not None:
+        json.dump({
+            'routers': routers,
+            'circuits': circuits,
+            'rates': parse_rates(rates),
+            'duration': duration,
+            'seed': seed,
+            'results': results,
+        }, json_out, indent=2, sort_keys=True)
+        json_out.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,273 @@
+'''
+Microbenchmarks for carml's formatting and bandwidth-accounting code.
+
+Times the functions that run once per circuit, stream, router or
+bandwidth event -- util.dump_circuits, util.nice_router_name,
+util.wrap, carml_monitor.string_for_circuit/string_for_stream,
+StreamBandwidth.add_bandwidth/rate, BandwidthTracker.draw_bars and
+deciding where streams go (isolation.IsolationAttacher) --
+against a synthetic, seeded TorState (see fixtures.py) of a busy Tor.
+Anything printed is thrown away, so only formatting is measured::
+
+    python -m benchmarks.micro
+    python -m benchmarks.micro --json after.json --compare before.json
+    python -m benchmarks.micro --only stream --repeat 10
+
+The --json results of two runs with the same sizes and seed are
+directly comparable (e.g. before and after a change).
+'''
+import sys
+import json
+import time
+import random
+import platform
+import contextlib
+import statistics
+
+import click
+
+from benchmarks.fixtures import make_state
+
+
+class _Discard(object):
+    "Stands in for sys.stdout."
+
+    encoding = 'utf8'
+
+    def write(self, text):
+        return len(text)
+
+    def flush(self):
+        pass
+
+
+def bench_dump_circuits(state):
+    from carml.util import dump_circuits
+
+    def run():
+        dump_circuits(state, False)
+    return run, len(state.circuits)
+
+
+def bench_dump_circuits_verbose(state):
+    from carml.util import dump_circuits
+
+    def run():
+        dump_circuits(state, True, show_countries=True)
+    return run, len(state.circuits)
+
+
+def bench_nice_router_name(state):
+    from carml.util import nice_router_name
+    routers = list(state.routers.values())
+
+    def run():
+        for router in routers:
+            nice_router_name(router)
+    return run, len(routers)
+
+
+def bench_wrap(state):
+    from carml.util import wrap
+    # roughly what "relay --info" and the monitor's log-lines wrap
+    texts = [
+        ' '.join(r.name + ' ' + r.location.asn for r in circ.path) * 3
+        for circ in list(state.circuits.values())[:2000]
+    ]
+
+    def run():
+        for text in texts:
+            wrap(text, 72, '    ')
+    return run, len(texts)
+
+
+def bench_string_for_circuit(state):
+    from carml.carml_monitor import string_for_circuit
+    circuits = list(state.circuits.values())
+
+    def run():
+        for circ in circuits:
+            string_for_circuit(state, circ)
+    return run, len(circuits)
+
+
+def bench_string_for_stream(state):
+    from carml.carml_monitor import string_for_stream
+    streams = list(state.streams.values())
+
+    def run():
+        for stream in streams:
+            string_for_stream(state, stream)
+    return run, len(streams)
+
+
+def _bandwidth_events(count, seed=0):
+    rng = random.Random(seed)
+    return [
+        (1000 + i, rng.randrange(0, 65536), rng.randrange(0, 8192))
+        for i in range(count)
+    ]
+
+
+def bench_stream_bandwidth_add(state):
+    from carml.carml_stream import StreamBandwidth
+    events = _bandwidth_events(100)
+    streams = 500
+
+    def run():
+        for _ in range(streams):
+            bw = StreamBandwidth()
+            for epoch, r, w in events:
+                bw.add_bandwidth(epoch, r, w)
+    return run, streams * len(events)
+
+
+def bench_stream_bandwidth_rate(state):
+    from carml.carml_stream import StreamBandwidth
+    streams = []
+    for i in range(5000):
+        bw = StreamBandwidth()
+        for epoch, r, w in _bandwidth_events(i % 40, seed=i):
+            bw.add_bandwidth(epoch, r, w)
+        streams.append(bw)
+
+    def run():
+        for bw in streams:
+            bw.rate()
+    return run, len(streams)
+
+
+def bench_draw_bars(state):
+    from carml.carml_graph import BandwidthTracker
+    tracker = BandwidthTracker(1024 * 1024, state)
+    for _, r, w in _bandwidth_events(100):
+        tracker._bandwidth.append((r * 8, w * 8))
+    calls = 20
+
+    def run():
+        for _ in range(calls):
+            tracker.draw_bars()
+    return run, calls
+
+
+class _InstantPool(object):
+    "Stands in for a CircuitPool that always has a spare circuit."
+
+    def __init__(self, circuits):
+        self._circuits = circuits
+        self._next = 0
+
+    def take(self):
+        from twisted.internet import defer
+        self._next = (self._next + 1) % len(self._circuits)
+        return defer.succeed(self._circuits[self._next])
+
+    def release(self, circuit):
+        pass
+
+
+def _bench_isolation(policy):
+    def bench(state):
+        from carml.isolation import IsolationAttacher
+        circuits = list(state.circuits.values())
+        streams = list(state.streams.values())
+
+        def run():
+            attacher = IsolationAttacher(state, None, _InstantPool(circuits), policy, log=lambda msg: None)
+            for stream in streams:
+                attacher.attach_stream(stream, state.circuits)
+            for stream in streams:
+                attacher.stream_closed(stream)
+        return run, len(streams)
+    return bench
+
+
+BENCHMARKS = [
+    ('dump_circuits', bench_dump_circuits),
+    ('dump_circuits_verbose', bench_dump_circuits_verbose),
+    ('nice_router_name', bench_nice_router_name),
+    ('wrap', bench_wrap),
+    ('string_for_circuit', bench_string_for_circuit),
+    ('string_for_stream', bench_string_for_stream),
+    ('stream_bandwidth_add', bench_stream_bandwidth_add),
+    ('stream_bandwidth_rate', bench_stream_bandwidth_rate),
+    ('draw_bars', bench_draw_bars),
+    ('isolation_attach_domain', _bench_isolation('domain')),
+    ('isolation_attach_port', _bench_isolation('port')),
+]
+
+
+def measure(run, repeat):
+    """
+    :returns: a list of `repeat` wall-clock times (in seconds) for
+        calling `run`, with stdout discarded.
+    """
+    times = []
+    with contextlib.redirect_stdout(_Discard()):
+        run()  # warm up
+        for _ in range(repeat):
+            start = time.perf_counter()
+            run()
+            times.append(time.perf_counter() - start)
+    return times
+
+
+@click.command()
+@click.option('--repeat', '-r', default=5, help='Number of timed runs of each benchmark.')
+@click.option('--only', '-k', multiple=True, help='Only run benchmarks whose name contains this (may be repeated).')
+@click.option('--circuits', default=10000, help='Circuits in the synthetic TorState.')
+@click.option('--streams', default=50000, help='Streams in the synthetic TorState.')
+@click.option('--routers', default=8000, help='Routers in the synthetic TorState.')
+@click.option('--seed', default=0, help='Random seed for the synthetic TorState.')
+@click.option('--json', 'json_out', type=click.File('w'), default=None, help='Also write JSON results to this file ("-" for stdout).')
+@click.option('--compare', type=click.File('r'), default=None, help='JSON results of an earlier run to compare against.')
+def main(repeat, only, circuits, streams, routers, seed, json_out, compare):
+    sizes = {'circuits': circuits, 'streams': streams, 'routers': routers, 'seed': seed}
+    start = time.perf_counter()
+    state = make_state(routers=routers, circuits=circuits, streams=streams, seed=seed)
+    print("Built synthetic state ({circuits} circuits, {streams} streams, {routers} routers) in {elapsed:.1f}s".format(
+        elapsed=time.perf_counter() - start, **sizes), file=sys.stderr)
+
+    previous = {}
+    if compare is not None:
+        old = json.load(compare)
+        if old.get('sizes') != sizes:
+            print("Warning: {} used different sizes: {}".format(compare.name, old.get('sizes')), file=sys.stderr)
+        previous = old.get('results', {})
+
+    results = {}
+    for name, setup in BENCHMARKS:
+        if only and not any(pattern in name for pattern in only):
+            continue
+        run, ops = setup(state)
+        times = measure(run, repeat)
+        best = min(times)
+        results[name] = {
+            'ops': ops,
+            'best_s': best,
+            'median_s': statistics.median(times),
+            'per_op_us': best / ops * 1e6,
+        }
+
+        line = "  {:<24} {:>10.2f}us/op  best {:.4f}s  median {:.4f}s  ({} ops)".format(
+            name, results[name]['per_op_us'], best, results[name]['median_s'], ops,
+        )
+        if name in previous:
+            before = previous[name]['per_op_us']
+            line += "  {:+.1f}%".format((results[name]['per_op_us'] - before) / before * 100.0)
+        print(line, file=sys.stderr if json_out is not None and json_out.name == '<stdout>' else sys.stdout)
+
+    if json_out is not None:
+        json.dump({
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'repeat': repeat,
+            'sizes': sizes,
+            'results': results,
+        }, json_out, indent=2, sort_keys=True)
+        json_out.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+'''
+Start-up time of the carml command-line.
+
+Runs "python -X importtime" over the CLI module (and, optionally, a
+sub-command's module) in a fresh interpreter several times and reports
+the total import time plus the most expensive imports. Use this to spot
+regressions in how much gets imported before a sub-command runs::
+
+    python -m benchmarks.startup
+    python -m benchmarks.startup --command tmux --json
+'''
+import sys
+import json
+import subprocess
+from collections import defaultdict
+
+import click
+
+
+def import_times(module, extra=None):
+    """
+    Returns a dict mapping module name -> cumulative import time (in
+    microseconds) for a fresh interpreter importing `module` (and then
+    `extra`, if given).
+    """
+    code = 'import {}'.format(module)
+    if extra:
+        code += '; import {}'.format(extra)
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        check=True,
+        universal_newlines=True,
+    )
+    times = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+@click.command()
+@click.option('--runs', '-r', default=5, help='Number of fresh interpreters to average over.')
+@click.option('--top', '-n', default=15, help='How many of the slowest imports to show.')
+@click.option('--command', '-c', default=None, help='Also import this sub-command\'s module (e.g. "tmux").')
+@click.option('--json', 'as_json', is_flag=True, help='Output JSON results.')
+def main(runs, top, command, as_json):
+    extra = None
+    if command is not None:
+        from carml.cli import COMMAND_MODULES
+        extra = COMMAND_MODULES[command]
+
+    totals = defaultdict(int)
+    for _ in range(runs):
+        for name, us in import_times('carml.cli', extra).items():
+            totals[name] += us
+    averages = {name: us / float(runs) for name, us in totals.items()}
+
+    total = averages.get('carml.cli', 0.0)
+    if extra:
+        total += averages.get(extra, 0.0)
+    slowest = sorted(averages.items(), key=lambda x: x[1], reverse=True)[:top]
+
+    if as_json:
+        print(json.dumps({
+            'runs': runs,
+            'command': command,
+            'total_us': total,
+            'slowest': [{'module': name, 'cumulative_us': us} for name, us in slowest],
+        }, indent=2))
+        return
+
+    print("carml start-up imports, averaged over {} runs".format(runs))
+    print("  total: {:.1f}ms".format(total / 1000.0))
+    for name, us in slowest:
+        print("  {:9.1f}ms  {}".format(us / 1000.0, name))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+'''
+Per-interval summaries of events, for "carml events --aggregate".
+
+Instead of remembering events, we keep running totals for the current
+window -- a count per event type and per value of the chosen keywords,
+and the bytes read/written for the bandwidth events -- which are
+emitted and reset when the window ends. Memory use depends only on how
+many distinct keyword values there are (a handful, for STATUS, PURPOSE
+or REASON), not on how many events arrive or how long we run.
+'''
+import time
+import collections
+
+from carml import eventparse
+from carml.eventfilter import keyword_finder
+
+
+#: the bandwidth events, and the classes that get the bytes read and
+#: written out of them
+BYTE_COUNTERS = {
+    name: eventparse.EVENT_TYPES[name]
+    for name in ('BW', 'STREAM_BW', 'CIRC_BW', 'CONN_BW')
+}
+
+
+class Aggregator(object):
+    """
+    Running totals of the events seen in one window.
+
+    :param by: keywords (e.g. 'STATUS', 'PURPOSE', 'REASON') to also
+        count each distinct value of.
+    """
+
+    def __init__(self, by=()):
+        self._by = [(key.upper(), keyword_finder(key)) for key in by]
+        self.reset()
+
+    def reset(self):
+        self._counts = collections.Counter()
+        # (event, key) -> Counter of values
+        self._values = collections.defaultdict(collections.Counter)
+        # event -> [read, written]
+        self._bytes = {}
+
+    def add(self, event, text):
+        self._counts[event] += 1
+        counter = BYTE_COUNTERS.get(event)
+        if counter is None:
+            for key, find in self._by:
+                value = find(text)
+                if value is not None:
+                    self._values[event, key][value] += 1
+        else:
+            # these don't have a status, purpose, etc
+            try:
+                parsed = counter(text)
+                read, written = parsed.read, parsed.written
+            except (ValueError, IndexError):
+                return
+            totals = self._bytes.get(event)
+            if totals is None:
+                self._bytes[event] = [read, written]
+            else:
+                totals[0] += read
+                totals[1] += written
+
+    def record(self, start, end, events):
+        """
+        :returns: a dict describing this window, with zeros for any of
+            `events` we didn't see.
+        """
+        counts = {}
+        for event in events:
+            entry = {'total': self._counts.get(event, 0)}
+            for key, _ in self._by:
+                values = self._values.get((event, key))
+                if values:
+                    entry[key] = dict(values)
+            if event in BYTE_COUNTERS:
+                read, written = self._bytes.get(event, (0, 0))
+                entry['read'] = read
+                entry['written'] = written
+            counts[event] = entry
+        return {
+            'type': 'aggregate',
+            'start': start,
+            'end': end,
+            'events': counts,
+        }
+
+
+def format_record(record):
+    """
+    :returns: a one-line, human-readable version of record().
+    """
+    parts = [
+        '{}-{}'.format(
+            time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(record['start'])),
+            time.strftime('%H:%M:%S', time.localtime(record['end'])),
+        )
+    ]
+    for event, entry in sorted(record['events'].items()):
+        text = '{}={}'.format(event, entry['total'])
+        if 'read' in entry:
+            text += ' read={} written={}'.format(entry['read'], entry['written'])
+        for key, values in sorted(entry.items()):
+            if isinstance(values, dict):
+                text += ' {}[{}]'.format(key.lower(), ' '.join(
+                    '{}={}'.format(value, count)
+                    for value, count in sorted(values.items(), key=lambda x: (-x[1], x[0]))
+                ))
+        parts.append(text)
+    return ' '.join(parts)
+
+
+class WindowedAggregator(object):
+    """
+    Calls `emit` with a record() for each `interval`-second window
+    (aligned to multiples of `interval` since the epoch), until
+    stop()-ed.
+    """
+
+    def __init__(self, reactor, interval, events, emit, by=()):
+        self._reactor = reactor
+        self._interval = interval
+        self._events = events
+        self._emit = emit
+        self._aggregator = Aggregator(by)
+        self.add = self._aggregator.add
+        self._start = None
+        self._call = None
+
+    def start(self):
+        now = time.time()
+        self._start = now
+        self._schedule((now // self._interval + 1) * self._interval)
+
+    def stop(self):
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        self._call = None
+
+    def _schedule(self, end):
+        self._call = self._reactor.callLater(max(0.0, end - time.time()), self._window_done, end)
+
+    def _window_done(self, end):
+        self._emit(self._aggregator.record(self._start, end, self._events))
+        self._aggregator.reset()
+        self._start = end
+        self._schedule(end + self._interval)
@@ -0,0 +1,168 @@
+'''
+Compact binary captures of a control-protocol session.
+
+A capture file is a short header followed by records, each one being
+a fixed-size header (timestamp, direction, length) and then the raw
+bytes that were read from (or written to) Tor. Writing goes through a
+preallocated buffer that's only flushed to disk when it fills up or on
+a timer, so capturing a busy control connection costs about one
+memory-copy per chunk instead of a formatted, flushed line per line.
+'''
+import time
+import struct
+
+import click
+
+
+MAGIC = b'carml-capture 1\n'
+
+#: records are: timestamp (double), direction (byte), length (uint32)
+RECORD = struct.Struct('<dBI')
+
+#: direction values
+FROM_TOR = 0
+TO_TOR = 1
+
+
+class CaptureWriter(object):
+    """
+    Appends records to the (binary) file `f`.
+
+    :param buffer_size: bytes we collect before writing to the file.
+
+    :param reactor: if not None, we also flush every
+        `flush_interval` seconds so the file is reasonably current.
+    """
+
+    def __init__(self, f, buffer_size=1 << 20, reactor=None, flush_interval=1.0):
+        self._f = f
+        self._buffer = bytearray(buffer_size)
+        self._view = memoryview(self._buffer)
+        self._used = 0
+        self._loop = None
+        self.records = 0
+        f.write(MAGIC)
+        if reactor is not None:
+            from twisted.internet import task
+            self._loop = task.LoopingCall(self.flush)
+            self._loop.clock = reactor
+            self._loop.start(flush_interval, now=False)
+            # e.g. SIGINT or SIGTERM stop the reactor without our
+            # caller getting a chance to close() us
+            reactor.addSystemEventTrigger('before', 'shutdown', self.close)
+
+    def record(self, direction, data):
+        size = RECORD.size + len(data)
+        if self._used + size > len(self._buffer):
+            self.flush()
+            if size > len(self._buffer):
+                # bigger than our whole buffer; skip the copy
+                self._f.write(RECORD.pack(time.time(), direction, len(data)))
+                self._f.write(data)
+                self.records += 1
+                return
+        RECORD.pack_into(self._buffer, self._used, time.time(), direction, len(data))
+        start = self._used + RECORD.size
+        self._buffer[start:start + len(data)] = data
+        self._used += size
+        self.records += 1
+
+    def flush(self):
+        if self._used:
+            self._f.write(self._view[:self._used])
+            self._used = 0
+        self._f.flush()
+
+    def close(self):
+        if self._f.closed:
+            return
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
+        self.flush()
+        self._f.close()
+
+
+def read_capture(f):
+    """
+    Generates (timestamp, direction, data) tuples from the capture file
+    `f` (opened in binary mode).
+    """
+    magic = f.read(len(MAGIC))
+    if magic != MAGIC:
+        raise RuntimeError("Not a carml capture file.")
+    while True:
+        header = f.read(RECORD.size)
+        if len(header) < RECORD.size:
+            return
+        timestamp, direction, length = RECORD.unpack(header)
+        data = f.read(length)
+        if len(data) < length:
+            # truncated by a crash; we have everything before this
+            return
+        yield timestamp, direction, data
+
+
+def capture_protocol(proto, writer):
+    """
+    Wraps the (connected) control-protocol `proto` so that everything
+    read from and written to Tor is recorded by `writer`.
+    """
+    orig_write = proto.transport.write
+    orig_read = proto.dataReceived
+
+    def write_wrapper(data):
+        writer.record(TO_TOR, data)
+        return orig_write(data)
+
+    def read_wrapper(data):
+        writer.record(FROM_TOR, data)
+        return orig_read(data)
+
+    proto.transport.write = write_wrapper
+    proto.dataReceived = read_wrapper
+
+
+class ProtocolRenderer(object):
+    """
+    Turns chunks of protocol data into coloured lines: blue ">>>"
+    for data we write to Tor, yellow "<<<" for data from Tor. Chunks
+    needn't end on line boundaries.
+    """
+
+    def __init__(self, echo=click.echo, timestamps=False):
+        self._echo = echo
+        self._timestamps = timestamps
+        self._partial = {FROM_TOR: b'', TO_TOR: b''}
+
+    def record(self, direction, data):
+        """
+        So we can be given to capture_protocol() to render live.
+        """
+        self.render(time.time(), direction, data)
+
+    def render(self, timestamp, direction, data):
+        data = self._partial[direction] + data
+        lines = data.split(b'\r\n')
+        self._partial[direction] = lines.pop()
+        for line in lines:
+            self._echo_line(timestamp, direction, line)
+
+    def finish(self, timestamp=None):
+        for direction, tail in self._partial.items():
+            if tail:
+                self._echo_line(timestamp, direction, tail)
+        self._partial = {FROM_TOR: b'', TO_TOR: b''}
+
+    def _echo_line(self, timestamp, direction, line):
+        line = line.decode('utf8', 'replace')
+        if direction == TO_TOR:
+            msg = ">>> " + click.style(line, fg='blue')
+        else:
+            msg = "<<< " + click.style(line, fg='yellow')
+        if self._timestamps and timestamp is not None:
+            msg = click.style(_format_time(timestamp), fg='cyan') + ' ' + msg
+        self._echo(msg)
+
+
+def _format_time(timestamp):
+    return time.strftime('%H:%M:%S', time.localtime(timestamp)) + '{:.6f}'.format(timestamp % 1)[1:]
@@ -1,4 +1,5 @@
 import sys
+import time
 import datetime
 import functools
 import random
@@ -10,6 +11,7 @@ import humanize
 import txtorcon
 
 from carml import util
+from carml import ndjson
 
 
 class CircOptions(usage.Options):
@@ -36,6 +38,12 @@ class CircOptions(usage.Options):
 
 
 async def list_circuits(reactor, cfg, tor, verbose):
+    if cfg.json:
+        state = await tor.create_state()
+        for circ in sorted(state.circuits.values(), key=lambda c: c.id):
+            ndjson.emit(ndjson.circuit(circ))
+        return
+
     print("Circuits:")
     state = await tor.create_state()
 
@@ -45,7 +53,8 @@ async def list_circuits(reactor, cfg, tor, verbose):
 
 async def delete_circuit(reactor, cfg, tor, circid, ifunused):
     unused_string = '(if unused) ' if ifunused else ''
-    print('Deleting circuit %s"%s"...' % (unused_string, circid),)
+    if not cfg.json:
+        print('Deleting circuit %s"%s"...' % (unused_string, circid),)
 
     state = await tor.create_state()  # bootstrap=False)
 
@@ -59,12 +68,47 @@ async def delete_circuit(reactor, cfg, tor, circid, ifunused):
         raise RuntimeError("No such circuit '{}'".format(circid))
 
     status = await state.close_circuit(circid, **kw)
-    print(status, '(waiting for CLOSED)...')
+    if not cfg.json:
+        print(status, '(waiting for CLOSED)...')
     await circ.when_closed()
+    if cfg.json:
+        ndjson.emit(ndjson.circuit(circ, event='closed', time=time.time()))
     # we're now awaiting a callback via CIRC events indicating
     # that our circuit has entered state CLOSED
 
 
+class _JsonCircuitListener(txtorcon.CircuitListenerMixin):
+    """
+    --json version of _BuiltCircuitListener: a record for every change
+    to our circuit.
+    """
+
+    def __init__(self, circid, all_done):
+        self.circid = circid
+        self._all_done = all_done
+
+    def _emit(self, circuit, event, **kw):
+        if circuit.id == self.circid:
+            ndjson.emit(ndjson.circuit(circuit, event=event, time=time.time(), **kw))
+            return True
+        return False
+
+    def circuit_extend(self, circuit, router):
+        self._emit(circuit, 'extend')
+
+    def circuit_built(self, circuit):
+        if self._emit(circuit, 'built'):
+            self._all_done.callback(None)
+
+    def circuit_closed(self, circuit, **kw):
+        if self._emit(circuit, 'closed', reason=kw.get('REASON')):
+            self._all_done.callback(None)
+
+    def circuit_failed(self, circuit, **kw):
+        if self._emit(circuit, 'failed', reason=kw.get('REASON'), remote_reason=kw.get('REMOTE_REASON')):
+            self._all_done.errback(RuntimeError('circuit {} failed'.format(circuit.id)))
+
+
 class _BuiltCircuitListener(txtorcon.CircuitListenerMixin):
     def __init__(self, circid, all_done):
         self.circid = circid
@@ -122,15 +166,19 @@ async def build_circuit(reactor, cfg, tor, routers):
             find_router(i, r)
             for i, r in enumerate(routers)
         ]
-        print("Building circuit:", '->'.join(util.nice_router_name(r) for r in routers))
+        if not cfg.json:
+            print("Building circuit:", '->'.join(util.nice_router_name(r) for r in routers))
 
     try:
         circ = await state.build_circuit(routers)
         all_done = defer.Deferred()
 
-        sys.stdout.write("Circuit ID %d: " % circ.id)
-        sys.stdout.flush()
-        state.add_circuit_listener(_BuiltCircuitListener(circ.id, all_done))
+        if cfg.json:
+            state.add_circuit_listener(_JsonCircuitListener(circ.id, all_done))
+        else:
+            sys.stdout.write("Circuit ID %d: " % circ.id)
+            sys.stdout.flush()
+            state.add_circuit_listener(_BuiltCircuitListener(circ.id, all_done))
         # all_done will callback when the circuit is built (or errback
         # if it fails).
 
@@ -0,0 +1,168 @@
+import os
+import io
+import sys
+import copy
+import json
+import stat
+
+from twisted.internet import defer
+from twisted.internet.endpoints import UNIXServerEndpoint
+from twisted.internet.protocol import Factory
+from twisted.protocols.basic import LineOnlyReceiver
+
+from carml import util
+from carml.daemon_client import default_socket_path, private_dir
+
+
+#: the sub-commands a daemon will answer; they only read from the
+#: TorState so it's fine to share one between them
+DAEMON_COMMANDS = ('tmux', 'circ', 'stream', 'relay')
+
+#: seconds before we give up on a command (so one wedged request,
+#: e.g. an onionoo lookup, can't block everyone else forever)
+REQUEST_TIMEOUT = 25
+
+
+class _SharedTor(object):
+    """
+    Stands in for a txtorcon.Tor instance when running a command
+    inside the daemon: create_state() hands out our one live TorState
+    instead of bootstrapping a new one.
+    """
+
+    def __init__(self, tor, state):
+        self._tor = tor
+        self._state = state
+
+    def __getattr__(self, name):
+        return getattr(self._tor, name)
+
+    async def create_state(self):
+        return self._state
+
+
+class DaemonProtocol(LineOnlyReceiver):
+    """
+    One request per connection: a line of JSON in, a JSON reply out
+    and then we hang up.
+    """
+    delimiter = b'\n'
+
+    def lineReceived(self, line):
+        try:
+            request = json.loads(line.decode('utf8'))
+        except ValueError:
+            self._reply({'declined': True, 'error': 'bad request'})
+            return
+        d = defer.ensureDeferred(self.factory.answer(request))
+        d.addCallback(self._reply)
+
+    def _reply(self, reply):
+        self.transport.write(json.dumps(reply).encode('utf8'))
+        self.transport.loseConnection()
+
+
+class DaemonFactory(Factory):
+    protocol = DaemonProtocol
+
+    def __init__(self, reactor, cfg, tor, state):
+        self._reactor = reactor
+        self._cfg = cfg
+        self._tor = _SharedTor(tor, state)
+        # commands print() their output, so we capture stdout while
+        # they run; that means only one may run at a time
+        self._lock = defer.DeferredLock()
+        self.answered = 0
+
+    async def answer(self, request):
+        command = request.get('command')
+        if command not in DAEMON_COMMANDS:
+            return {'declined': True, 'error': 'not a daemon command'}
+        connect = request.get('connect')
+        if connect is not None and connect != self._cfg.connect:
+            # they want a different Tor than the one we're connected to
+            return {'declined': True, 'error': 'different Tor'}
+
+        cfg = copy.copy(self._cfg)
+        for k, v in request.get('options', {}).items():
+            setattr(cfg, k, v)
+
+        captured = io.StringIO()
+        await self._lock.acquire()
+        try:
+            d = defer.ensureDeferred(self._run(command, cfg, request.get('args', []), captured))
+            d.addTimeout(REQUEST_TIMEOUT, self._reactor)
+            error = await d
+        except defer.TimeoutError:
+            # they still get whatever it printed before we gave up
+            error = 'timed out after {}s'.format(REQUEST_TIMEOUT)
+        finally:
+            self._lock.release()
+        self.answered += 1
+        return {'output': captured.getvalue(), 'error': error}
+
+    async def _run(self, command, cfg, args, captured):
+        from carml.cli import _command_runner
+        cmd = _command_runner(command)
+        error = None
+        orig_stdout = sys.stdout
+        sys.stdout = captured
+        try:
+            await cmd(self._reactor, cfg, self._tor, *args)
+        except defer.CancelledError:
+            raise
+        except Exception as e:
+            error = str(e)
+        finally:
+            sys.stdout = orig_stdout
+        return error
+
+
+def _make_private_dir(directory):
+    """
+    Create `directory` for only us to use, or make sure that's what
+    it already is (and not, say, something another user put there
+    first).
+    """
+    try:
+        os.mkdir(directory, 0o700)
+    except FileExistsError:
+        pass
+    st = os.lstat(directory)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+        raise RuntimeError(
+            "{} must be a directory that only you can use".format(directory)
+        )
+
+
+async def run(reactor, cfg, tor, socket_path):
+    if socket_path is None:
+        socket_path = default_socket_path()
+        if os.path.dirname(socket_path) == private_dir():
+            _make_private_dir(private_dir())
+
+    state = await tor.create_state()
+    factory = DaemonFactory(reactor, cfg, tor, state)
+
+    # a socket-file left over from a daemon that died would make
+    # listen() fail; if there was a live daemon there, clients will
+    # now talk to us instead
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    ep = UNIXServerEndpoint(reactor, socket_path, mode=0o600)
+    port = await ep.listen(factory)
+    print("Answering {} on {}".format(
+        ', '.join(util.colors.bold(c) for c in DAEMON_COMMANDS),
+        socket_path,
+    ))
+    sys.stdout.flush()
+
+    try:
+        await tor.protocol.when_disconnected()
+    except Exception as e:
+        print(util.colors.red('Error: ') + str(e))
+    finally:
+        print("Tor disconnected after answering {} requests.".format(factory.answered))
+        await defer.maybeDeferred(port.stopListening)
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
@@ -5,7 +5,7 @@ import functools
 
 import zope.interface
 from twisted.python import usage, log
-from twisted.internet import defer, reactor
+from twisted.internet import defer, reactor, endpoints
 
 import txtorcon
 
@@ -13,48 +13,258 @@ from carml.util import dump_circuits
 from carml.util import format_net_location
 from carml.util import nice_router_name
 from carml.util import colors
+from carml import ndjson
+from carml.rotating import RotatingOutput
+from carml.aggregate import WindowedAggregator, format_record
+from carml.eventstore import EventCapture, EventCaptureWriter
+from carml.eventserver import EventFanout
+from carml.flightrecorder import FlightRecorder, RateTrigger
+from carml.enrich import StreamEnricher, format_extra
 
 import click
 
 
-async def run(reactor, cfg, tor, list_events, once, show_event, count, events):
+async def run(reactor, cfg, tor, list_events, once, show_event, count, events,
+              output=None, rotate_size=None, rotate_interval=None, compress=None,
+              matches=None, aggregate=None, by=(), capture=None,
+              serve=None, client_buffer=None, slow_clients='drop',
+              flight_recorder=None, keep=600, max_memory=64 * 1024 * 1024,
+              trigger=None, trigger_rate=(20, 10), enrich=False):
     all_events = await tor.protocol.get_info('events/names')
     all_events = all_events['events/names']
     if list_events:
         for e in all_events.split():
-            click.echo(e)
+            if cfg.json:
+                ndjson.emit({'type': 'event_name', 'name': e})
+            else:
+                click.echo(e)
         return
 
+    for e in events:
+        if e.upper() not in all_events:
+            print("Invalid event:", e.upper())
+            return
+
+    if flight_recorder is not None:
+        return await _flight_record(
+            reactor, cfg, tor, events, matches,
+            flight_recorder, keep, max_memory, trigger, trigger_rate,
+        )
+    if serve is not None:
+        return await _serve(reactor, cfg, tor, events, matches, serve, client_buffer, slow_clients)
+
+    record = None
+    if capture is not None:
+        out = EventCaptureWriter(open(capture, 'wb'), reactor=reactor)
+        record = out.record
+        write = None
+    elif output is not None:
+        out = RotatingOutput(
+            output,
+            max_bytes=rotate_size,
+            max_age=rotate_interval,
+            compress=compress,
+            reactor=reactor,
+        )
+        write = out.write
+    else:
+        out = None
+
+        def write(text):
+            # sys.stdout is (usually) an OutputSink by now
+            sys.stdout.write(text)
+
     all_done = defer.Deferred()
     counter = [count]
     if once:
         counter[0] = 1
 
-    def _got_event(evt, msg):
+    if aggregate is not None:
+        try:
+            await _aggregate(reactor, cfg, tor, events, write, matches, aggregate, by)
+        finally:
+            if out is not None:
+                out.close()
+        return
+
+    label = show_event
+
+    enricher = None
+    if enrich:
+        # TorState has to see each STREAM event before we do, so this
+        # comes before adding our listeners
+        state = await tor.create_state()
+        enricher = StreamEnricher(state, reactor)
+        enricher.start()
+
+    def _got_event(evt, msg, extra=None):
+        # this runs for every event, so filter before doing anything
+        # else with it
+        if matches is not None and not matches(evt, msg):
+            return
+        if extra and not cfg.json:
+            msg = msg + ' ' + format_extra(extra)
+        if record is not None:
+            if counter[0] is None or counter[0] > 0:
+                record(evt, msg)
+        elif cfg.json:
+            if all_done.called or (counter[0] is not None and counter[0] <= 0):
+                return
+            line = {'type': 'event', 'event': evt, 'time': time.time(), 'data': msg}
+            if extra:
+                line.update(extra)
+            write(ndjson.line(line))
+        elif counter[0] is not None:
+            if counter[0] > 0:
+                write(msg + '\n')
+        elif label:
+            write("{}: {}\n".format(evt, msg))
+        else:
+            write("{} {}\n".format(time.asctime(), msg))
         if counter[0] is not None:
             counter[0] -= 1
-            if counter[0] >= 0:
-                print(msg)
-            elif all_done:
+            if counter[0] <= 0 and not all_done.called:
                 all_done.callback(None)
-                all_done = None
-        elif evt:
-            print("{}: {}".format(evt, msg))
-        else:
-            ts = time.asctime()
-            print("{} {}".format(ts, msg))
-        sys.stdout.flush()
+
+    def _got_stream(msg):
+        # always, so that closed streams are forgotten even if they
+        # don't match --filter
+        extra = enricher.enrich(msg)
+        _got_event('STREAM', msg, extra)
 
     for e in events:
         e = e.upper()
-        if e not in all_events:
-            print("Invalid event:", e)
-            return
-        if show_event:
-            listener = functools.partial(_got_event, e)
+        if e == 'STREAM' and enricher is not None:
+            tor.protocol.add_event_listener(e, _got_stream)
         else:
-            listener = functools.partial(_got_event, None)
-        tor.protocol.add_event_listener(e, listener)
+            tor.protocol.add_event_listener(e, functools.partial(_got_event, e))
 
     # might be forever if there's no count
-    await all_done
+    try:
+        await all_done
+    finally:
+        if enricher is not None:
+            enricher.stop()
+        if out is not None:
+            out.close()
+
+
+async def _aggregate(reactor, cfg, tor, events, write, matches, interval, by):
+    """
+    Instead of printing events, print a summary every `interval`
+    seconds (forever).
+    """
+    def _emit(record):
+        if cfg.json:
+            write(ndjson.line(record))
+        else:
+            write(format_record(record) + '\n')
+
+    names = [e.upper() for e in events]
+    windows = WindowedAggregator(reactor, interval, names, _emit, by=by)
+    add = windows.add
+
+    def _got_event(evt, msg):
+        if matches is not None and not matches(evt, msg):
+            return
+        add(evt, msg)
+
+    for e in names:
+        tor.protocol.add_event_listener(e, functools.partial(_got_event, e))
+    windows.start()
+    try:
+        await tor.protocol.when_disconnected()
+    except Exception:
+        pass
+    finally:
+        windows.stop()
+
+
+async def _serve(reactor, cfg, tor, events, matches, endpoint, client_buffer, slow_clients):
+    """
+    Instead of printing events, pass them on to whoever connects to
+    `endpoint` (until Tor disconnects).
+    """
+    fanout = EventFanout(
+        json=cfg.json,
+        max_buffer=client_buffer,
+        slow_clients=slow_clients,
+        log=None if cfg.json else print,
+    )
+    port = await endpoints.serverFromString(reactor, endpoint).listen(fanout)
+    names = [e.upper() for e in events]
+    if not cfg.json:
+        print("Serving {} events on {}.".format(' '.join(names), endpoint))
+
+    def _got_event(evt, msg):
+        if matches is not None and not matches(evt, msg):
+            return
+        fanout.event(evt, msg, time.time())
+
+    for e in names:
+        tor.protocol.add_event_listener(e, functools.partial(_got_event, e))
+    try:
+        await tor.protocol.when_disconnected()
+    except Exception:
+        pass
+    finally:
+        await defer.maybeDeferred(port.stopListening)
+
+
+async def _flight_record(reactor, cfg, tor, events, matches, directory, keep, max_memory, trigger, trigger_rate):
+    """
+    Instead of printing events, remember the recent ones and save them
+    on SIGUSR1 or when `trigger` matches too often (until Tor
+    disconnects).
+    """
+    names = [e.upper() for e in events]
+    recorder = FlightRecorder(
+        reactor, directory, names, max_memory, keep,
+        trigger_matches=trigger,
+        trigger=None if trigger is None else RateTrigger(*trigger_rate),
+        json=cfg.json,
+        log=None if cfg.json else print,
+    )
+    record = recorder.event
+    if cfg.json:
+        ndjson.emit({'type': 'flight_recorder', 'event': 'start', 'events': names, 'pid': os.getpid(), 'time': time.time()})
+    else:
+        print("Recording {} events; send SIGUSR1 to process {} to save them.".format(' '.join(names), os.getpid()))
+
+    def _got_event(evt, msg):
+        if matches is not None and not matches(evt, msg):
+            return
+        record(evt, msg)
+
+    for e in names:
+        tor.protocol.add_event_listener(e, functools.partial(_got_event, e))
+    recorder.start()
+    try:
+        await tor.protocol.when_disconnected()
+    except Exception:
+        pass
+    finally:
+        recorder.stop()
+
+
+def run_from_capture(cfg, path, since, until, types, show_event, count, matches):
+    """
+    Show events from a capture made with "events --capture" (this
+    doesn't talk to Tor).
+    """
+    write = sys.stdout.write
+    with open(path, 'rb') as f:
+        capture = EventCapture(f)
+        for when, evt, msg in capture.events(since=since, until=until, types=types):
+            if matches is not None and not matches(evt, msg):
+                continue
+            if count is not None:
+                if count <= 0:
+                    break
+                count -= 1
+            if cfg.json:
+                write(ndjson.line({'type': 'event', 'event': evt, 'time': when, 'data': msg}))
+            elif show_event:
+                write("{} {}: {}\n".format(time.asctime(time.localtime(when)), evt, msg))
+            else:
+                write("{} {}\n".format(time.asctime(time.localtime(when)), msg))
@@ -1,5 +1,6 @@
 import os
 import sys
+import time
 import functools
 
 import zope.interface
@@ -12,6 +13,8 @@ import txtorcon
 from twisted.internet.defer import Deferred
 
 from carml.util import dump_circuits, format_net_location, nice_router_name, colors, wrap
+from carml import ndjson
+from carml.eventparse import BwEvent
 
 LOG_LEVELS = ["DEBUG", "INFO", "NOTICE", "WARN", "ERR"]
 
@@ -21,11 +24,12 @@ class BandwidthTracker(object):
     This tracks bandwidth usage.
     '''
 
-    def __init__(self, maxscale, state):
+    def __init__(self, maxscale, state, json=False):
         #: a list of tuples
         self._bandwidth = []
         self._max = float(maxscale)
         self._state = state
+        self._json = json
 
     def circuits(self):
         return len(self._state.circuits)
@@ -34,7 +38,18 @@ class BandwidthTracker(object):
         return len(self._state.streams)
 
     def on_bandwidth(self, s):
-        r, w = (int(x) for x in s.split())
+        event = BwEvent(s)
+        r, w = event.read, event.written
+        if self._json:
+            ndjson.emit({
+                'type': 'bw',
+                'time': time.time(),
+                'read': r,
+                'written': w,
+                'streams': self.streams(),
+                'circuits': self.circuits(),
+            })
+            return
         self._bandwidth.append((r, w))
         try:
             self.draw_bars()
@@ -100,7 +115,7 @@ def right_bar(percent, width):
 
 async def run(reactor, cfg, tor, max):
     state = await tor.create_state()
-    bwtracker = BandwidthTracker(max, state)
+    bwtracker = BandwidthTracker(max, state, json=cfg.json)
     await tor.protocol.add_event_listener('BW', bwtracker.on_bandwidth)
     await tor.protocol.add_event_listener('STREAM_BW', bwtracker.on_stream_bandwidth)
 
@@ -1,5 +1,5 @@
-import os
 import sys
+import time
 import functools
 
 import zope.interface
@@ -10,6 +10,8 @@ import humanize
 import txtorcon
 
 from carml.util import dump_circuits, format_net_location, nice_router_name, colors, wrap
+from carml import ndjson
+from carml.procindex import process_from_address, executable
 
 LOG_LEVELS = ["DEBUG", "INFO", "NOTICE", "WARN", "ERR"]
 
@@ -27,9 +29,9 @@ def string_for_stream(state, stream):
     circ = ''
     if stream.circuit:
         circ = ' via circuit %d' % stream.circuit.id
-    proc = txtorcon.util.process_from_address(stream.source_addr, stream.source_port, state)
+    proc = process_from_address(stream.source_addr, stream.source_port, state)
     if proc:
-        proc = ' from process "%s"' % (colors.bold(os.path.realpath('/proc/%d/exe' % proc)), )
+        proc = ' from process "%s"' % (colors.bold(executable(proc)), )
 
     elif stream.source_addr == '(Tor_internal)':
         proc = ' for Tor internal use'
@@ -44,11 +46,15 @@ def string_for_stream(state, stream):
 
 
 class StreamLogger(txtorcon.StreamListenerMixin):
-    def __init__(self, state, verbose):
+    def __init__(self, state, verbose, json=False):
         self.state = state
         self.verbose = verbose
+        self.json = json
 
     def stream_attach(self, stream, circuit):
+        if self.json:
+            ndjson.emit(ndjson.stream(stream, event='attach', time=time.time()))
+            return
         print(string_for_stream(self.state, stream))
         if self.verbose:
             m = "  " + '->'.join(nice_router_name(x) for x in circuit.path)
@@ -56,6 +62,9 @@ class StreamLogger(txtorcon.StreamListenerMixin):
             print(m)
 
     def stream_failed(self, stream, remote_reason='', **kw):
+        if self.json:
+            ndjson.emit(ndjson.stream(stream, event='failed', remote_reason=remote_reason, time=time.time()))
+            return
         print('Stream %d %s because "%s"' % (stream.id, colors.red('failed'),
                                              colors.red(remote_reason)))
 
@@ -75,17 +84,27 @@ def flags(d):
 
 
 class CircuitLogger(txtorcon.CircuitListenerMixin):
-    def __init__(self, state, show_flags=False):
+    def __init__(self, state, show_flags=False, json=False):
         self.state = state
         self.show_flags = show_flags
+        self.json = json
+
+    def _emit(self, circuit, event, **kw):
+        ndjson.emit(ndjson.circuit(circuit, event=event, time=time.time(), **kw))
 
     def circuit_launched(self, circuit):
+        if self.json:
+            return self._emit(circuit, 'launched')
         print(string_for_circuit(self.state, circuit))
 
     def circuit_extend(self, circuit, router):
+        if self.json:
+            return self._emit(circuit, 'extend')
         print(string_for_circuit(self.state, circuit))
 
     def circuit_built(self, circuit):
+        if self.json:
+            return self._emit(circuit, 'built')
         print(string_for_circuit(self.state, circuit))
         if self.show_flags:
             flagslist = ['%s=%s' % x for x in circuit.flags.items()]
@@ -93,9 +112,13 @@ class CircuitLogger(txtorcon.CircuitListenerMixin):
             print(colors.cyan('    Flags:'), flags.lstrip())
 
     def circuit_failed(self, circuit, **kw):
+        if self.json:
+            return self._emit(circuit, 'failed')
         print('Circuit %d failed (%s).' % (circuit.id, flags(kw)))
 
     def circuit_closed(self, circuit, **kw):
+        if self.json:
+            return self._emit(circuit, 'closed')
         print('Circuit %d %s lasted %s (%s).' % (circuit.id,
                                                  colors.red('closed'),
                                                  humanize.time.naturaldelta(circuit.age()),
@@ -105,18 +128,76 @@ class CircuitLogger(txtorcon.CircuitListenerMixin):
 @zope.interface.implementer(txtorcon.interface.IAddrListener)
 class AddressLogger(object):
 
+    def __init__(self, json=False):
+        self.json = json
+
     def addrmap_added(self, addr):
+        if self.json:
+            ndjson.emit(addrmap_record(addr, event='added', time=time.time()))
+            return
         print('New address mapping: "%s" -> "%s".' % (addr.name, addr.ip))
 
     def addrmap_expired(self, name):
+        if self.json:
+            ndjson.emit({'type': 'addrmap', 'name': name, 'event': 'expired', 'time': time.time()})
+            return
         print('Address mapping for "%s" expired.' % name)
 
 
+def addrmap_record(addr, **kw):
+    record = {'type': 'addrmap', 'name': addr.name, 'ip': str(addr.ip)}
+    record.update(kw)
+    return record
+
+
 def tor_log(level, msg):
     print('%s: %s' % (level, msg))
 
 
+def tor_log_json(level, msg):
+    ndjson.emit({'type': 'log', 'level': level, 'time': time.time(), 'message': msg})
+
+
+async def _run_json(reactor, cfg, tor, verbose, no_guards, no_addr, no_circuits, no_streams, once, log_level):
+    """
+    --json version of run(): a record for everything currently there,
+    then (unless `once`) one per change.
+    """
+    state = await tor.create_state()
+
+    if not no_streams:
+        for stream in state.streams.values():
+            ndjson.emit(ndjson.stream(stream))
+    if not no_circuits:
+        for circuit in sorted(state.circuits.values(), key=lambda c: c.id):
+            ndjson.emit(ndjson.circuit(circuit))
+    if not no_guards:
+        for router in state.entry_guards.values():
+            ndjson.emit(ndjson.router(router, type='guard', from_consensus=router.from_consensus))
+    if not no_addr:
+        for addr in state.addrmap.addr.values():
+            ndjson.emit(addrmap_record(addr))
+    if once:
+        return
+
+    for event in log_level:
+        state.protocol.add_event_listener(event, functools.partial(tor_log_json, event))
+    if not no_streams:
+        state.add_stream_listener(StreamLogger(state, verbose, json=True))
+    if not no_circuits:
+        state.add_circuit_listener(CircuitLogger(state, json=True))
+    if not no_addr:
+        state.addrmap.add_listener(AddressLogger(json=True))
+
+    try:
+        await state.protocol.when_disconnected()
+    except Exception:
+        pass
+
+
 async def run(reactor, cfg, tor, verbose, no_guards, no_addr, no_circuits, no_streams, once, log_level):
+    if cfg.json:
+        return await _run_json(reactor, cfg, tor, verbose, no_guards, no_addr, no_circuits, no_streams, once, log_level)
     state = await tor.create_state()
 
     follow_string = None
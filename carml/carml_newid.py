@@ -1,19 +1,30 @@
 import sys
+import time
 import functools
 
 from twisted.internet import defer
 
+from carml import ndjson
 
-def newid_got_signal(all_done, x):
+
+def newid_got_signal(all_done, json, x):
     if x == 'NEWNYM':
-        print('success.')
+        if json:
+            ndjson.emit({'type': 'newid', 'event': 'success', 'time': time.time()})
+        else:
+            print('success.')
         all_done.callback(None)
 
 
-def newid_no_signal(reactor, left, all_done):
+def newid_no_signal(reactor, left, all_done, json=False):
+    if all_done.called:
+        return
     if left > 0:
-        print('  waiting {} more seconds.'.format(left))
-        reactor.callLater(1, newid_no_signal, reactor, left - 1, all_done)
+        if json:
+            ndjson.emit({'type': 'newid', 'event': 'waiting', 'seconds': left, 'time': time.time()})
+        else:
+            print('  waiting {} more seconds.'.format(left))
+        reactor.callLater(1, newid_no_signal, reactor, left - 1, all_done, json)
     else:
         all_done.errback(RuntimeError('no acknowledgement in 10 seconds.'))
 
@@ -22,13 +33,16 @@ async def run(reactor, cfg, tor):
     all_done = defer.Deferred()
 
     # Tor emits this event whenever it processes a SIGNAL command.
-    tor.protocol.add_event_listener('SIGNAL', functools.partial(newid_got_signal, all_done))
+    tor.protocol.add_event_listener('SIGNAL', functools.partial(newid_got_signal, all_done, cfg.json))
 
-    print("Requesting new identity",)
-    sys.stdout.flush()
+    if cfg.json:
+        ndjson.emit({'type': 'newid', 'event': 'requested', 'time': time.time()})
+    else:
+        print("Requesting new identity",)
+        sys.stdout.flush()
     await tor.protocol.signal('NEWNYM')
     # answer will be "OK" since Tor received the signal
     # if rate-limiting is happening, the "SIGNAL NEWNYM" event
     # will not be received. so we wait for it
-    reactor.callLater(1, newid_no_signal, reactor, 10, all_done)
+    reactor.callLater(1, newid_no_signal, reactor, 10, all_done, cfg.json)
     await all_done
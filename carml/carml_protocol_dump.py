@@ -0,0 +1,36 @@
+import functools
+
+import click
+
+from carml.capture import read_capture, ProtocolRenderer, FROM_TOR, TO_TOR
+
+
+# unlike most commands this doesn't talk to Tor at all, so it's a
+# plain function instead of an async run(reactor, cfg, tor, ...)
+def run(cfg, capture, direction, timestamps):
+    color = {'always': True, 'no': False}.get(cfg.color, None)
+    if cfg.no_color:
+        color = False
+    renderer = ProtocolRenderer(
+        echo=functools.partial(click.echo, color=color),
+        timestamps=timestamps,
+    )
+    wanted = {
+        'both': (FROM_TOR, TO_TOR),
+        'read': (FROM_TOR, ),
+        'write': (TO_TOR, ),
+    }[direction]
+
+    timestamp = None
+    counts = {FROM_TOR: 0, TO_TOR: 0}
+    for timestamp, which, data in read_capture(capture):
+        counts[which] += len(data)
+        if which in wanted:
+            renderer.render(timestamp, which, data)
+    renderer.finish(timestamp)
+
+    if not cfg.quiet:
+        click.echo(
+            "{} bytes from Tor, {} bytes to Tor.".format(counts[FROM_TOR], counts[TO_TOR]),
+            err=True,
+        )
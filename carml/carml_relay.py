@@ -12,9 +12,20 @@ import txtorcon
 from txtorcon.router import hashFromHexId
 
 from carml import util
+from carml import ndjson
 
 
-async def _print_router_info(router, agent=None):
+async def _emit_router_info(router, agent=None):
+    loc = await router.get_location()
+    record = ndjson.router(router, countrycode=loc.countrycode)
+    if agent:
+        record['onionoo'] = await router.get_onionoo_details(agent)
+    ndjson.emit(record)
+
+
+async def _print_router_info(router, agent=None, json=False):
+    if json:
+        return await _emit_router_info(router, agent)
     loc = await router.get_location()
     print(u"            name: {}".format(router.name))
     print(u"          hex id: {}".format(router.id_hex))
@@ -49,7 +60,7 @@ async def _print_router_info(router, agent=None):
         )
 
 
-async def router_info(state, arg, tor):
+async def router_info(state, arg, tor, json=False):
     for fp in arg:
         if len(fp) == 40 and not fp.startswith('$'):
             fp = '${}'.format(fp)
@@ -64,6 +75,10 @@ async def router_info(state, arg, tor):
                 r for r in state.all_routers
                 if fp in r.name or fp in r.id_hex
             ]
+            if json:
+                for router in candidates:
+                    await _print_router_info(router, json=True)
+                continue
             if not candidates:
                 print("Nothing found ({} routers total)".format(len(state.all_routers)))
             if len(candidates) > 1:
@@ -72,60 +87,70 @@ async def router_info(state, arg, tor):
                 await _print_router_info(router)
                 print()
         else:
-            await _print_router_info(relay, agent=tor.web_agent())
+            await _print_router_info(relay, agent=tor.web_agent(), json=json)
 
 
-async def _when_updated(state):
+async def _when_updated(state, json=False):
     d = defer.Deferred()
 
     def _newconsensus(doc):
         # we actually don't care what's *in* the event, we just know
         # that the state has now updated...maybe a .when_updated() in
         # TorState?
-        print("Got NEWCONSENSUS at {}".format(datetime.datetime.now()))
+        if not json:
+            print("Got NEWCONSENSUS at {}".format(datetime.datetime.now()))
         d.callback(None)
         return state.protocol.remove_event_listener('NEWCONSENSUS', _newconsensus)
     await state.protocol.add_event_listener('NEWCONSENSUS', _newconsensus)
     await d
 
 
-async def _await_router(state, router_id):
-    print("Waiting for relay {}".format(router_id))
+async def _await_router(state, router_id, json=False):
+    if not json:
+        print("Waiting for relay {}".format(router_id))
     while True:
-        await _when_updated(state)
-        print("received update")
+        await _when_updated(state, json)
+        if not json:
+            print("received update")
         try:
             return state.routers[router_id]
         except KeyError:
-            print("{} not found; waiting".format(router_id))
+            if not json:
+                print("{} not found; waiting".format(router_id))
             continue
 
 
-async def router_await(state, arg):
+async def router_await(state, arg, json=False):
     if len(arg) == 40 and not arg.startswith('$'):
         arg = '${}'.format(arg)
     if not arg.startswith('$') and len(arg) == 41:
+        if json:
+            raise RuntimeError("Doesn't appear to be a hex router ID")
         print("Doesn't appear to be a hex router ID")
         return
 
     if arg in state.routers:
-        print("Router already present:")
+        if not json:
+            print("Router already present:")
         r = state.routers[arg]
     else:
-        r = await _await_router(state, arg)
-    await _print_router_info(r)
+        r = await _await_router(state, arg, json)
+    await _print_router_info(r, json=json)
 
 
-async def router_list(state):
+async def router_list(state, json=False):
     for router in state.all_routers:
-        print("{}".format(router.id_hex[1:]))
+        if json:
+            ndjson.emit(ndjson.router(router))
+        else:
+            print("{}".format(router.id_hex[1:]))
 
 
 async def run(reactor, cfg, tor, list, info, wait):
     state = await tor.create_state()
     if info:
-        await router_info(state, info, tor)
+        await router_info(state, info, tor, json=cfg.json)
     elif list:
-        await router_list(state)
+        await router_list(state, json=cfg.json)
     elif wait:
-        await router_await(state, wait)
+        await router_await(state, wait, json=cfg.json)
@@ -1,72 +1,134 @@
-import os
 import sys
+import time
+import array
 import functools
 
 from twisted.python import usage, log
-from twisted.internet import defer, reactor
+from twisted.internet import defer, reactor, task
 from zope.interface import implementer
 import txtorcon
 import humanize
 
 from carml import util
+from carml import ndjson
+from carml.eventparse import StreamEvent, StreamBwEvent
+from carml.procindex import process_from_address
+from carml.circuitpool import CircuitPool
+from carml.isolation import IsolationAttacher, POLICIES, format_stats
+from carml.loadbalance import LoadBalancer
+from carml.exitindex import ExitIndex
+from carml.exitattach import ExitCountryAttacher, POOL_PORT, pool_builder
 
 
-def attach_streams_per_process(state):
-    print("Exiting (e.g. Ctrl-C) will cause Tor to resume choosing circuits.")
-    print("Giving each new PID we see its own Circuit (until they're gone).")
+def attach_streams_per_process(state, pool_size=3, json=False):
+    return attach_streams_isolated(state, 'pid', pool_size=pool_size, json=json)
 
-    @implementer(txtorcon.IStreamAttacher)
-    class Attacher(object):
 
-        def __init__(self):
-            self.pid_to_circuits = {}
+def attach_streams_isolated(state, policy, pool_size=None, max_age=None, stats_interval=60.0, json=False):
+    """
+    Attach streams according to an isolation policy (see
+    isolation.POLICIES); `pool_size` and `max_age` default to the
+    policy's own.
+    """
+    policy = POLICIES[policy]
+    if pool_size is None:
+        pool_size = policy.pool_size
+    if max_age is None:
+        max_age = policy.max_age
+    if not json:
+        print("Exiting (e.g. Ctrl-C) will cause Tor to resume choosing circuits.")
+        print("Giving each {} its own circuit (until its streams are gone).".format(policy.description))
+        print("Keeping {} spare circuits ready.".format(pool_size))
+    pool = CircuitPool(state, reactor, pool_size, log=None if json else print)
+    attacher = IsolationAttacher(state, reactor, pool, policy, max_age=max_age, json=json)
+
+    def _stats():
+        summary = attacher.stats.summary()
+        if json:
+            ndjson.emit(summary, type='attach_stats', time=time.time())
+        else:
+            print(format_stats(summary))
+    if stats_interval:
+        loop = task.LoopingCall(_stats)
+        loop.clock = reactor
+        loop.start(stats_interval, now=False)
+    reactor.addSystemEventTrigger('before', 'shutdown', _stats)
+    attacher.start()
+    return defer.Deferred()
 
-        def choose_new_circuit(self, stream, circuits):
-            for circ in circuits.values():
-                if circ in self.pid_to_circuits.values():
-                    continue
-                if circ.state != 'BUILT':
-                    continue
-                return circ
-            raise RuntimeError("Ran out of circuits to select.")
 
-        def attach_stream(self, stream, circuits):
-            src_addr, src_port = stream.flags['SOURCE_ADDR'].split(':')
-            pid = txtorcon.util.process_from_address(src_addr, src_port)
-            procname = os.path.realpath('/proc/%d/exe' % pid)
-
-            try:
-                circ = self.pid_to_circuits[pid]
-            except KeyError:
-                circ = self.choose_new_circuit(stream, circuits)
-                self.pid_to_circuits[pid] = circ
-                print('Selected circuit %d for process %d (%s).' % (circ.id, pid, procname))
-                print('  ', '->'.join([p.name if p.name_is_unique else ('{%s}' % p.name) for p in circ.path]))
-
-#            if stream.state == 'NEWRESOLVE':
-#                print "  attaching %d (resolve %s)" % (stream.id, stream.target_host)
-#            else:
-            print("  attaching stream %d to circuit %d for %s:%d (%s)" % (stream.id, circ.id, stream.target_host, stream.target_port, procname))
-            return circ
+def attach_streams_balanced(state, circuit_ids=(), auto=0, json=False):
+    """
+    Spread new streams across circuits `circuit_ids`, or `auto` ones
+    Tor builds for us, least-loaded first.
+    """
+    circuits = []
+    for circid in circuit_ids:
+        try:
+            circuits.append(state.circuits[circid])
+        except KeyError:
+            raise RuntimeError("Circuit {} doesn't exist.".format(circid))
+    if not json:
+        print("Exiting (e.g. Ctrl-C) will cause Tor to resume choosing circuits.")
+        if auto:
+            print("Spreading new streams across {} new circuits.".format(auto))
+        else:
+            print("Spreading new streams across circuits {}.".format(', '.join(str(c.id) for c in circuits)))
+    # circuits given by ID aren't replaced (by ones the user didn't
+    # choose), so there's no need for spares
+    pool = CircuitPool(state, reactor, 1, log=None if json else print) if auto else None
+    balancer = LoadBalancer(state, reactor, pool, circuits, wanted=auto or None, json=json)
+    if not json:
+        for circ in circuits:
+            print("  {}: {}".format(circ.id, '->'.join([p.name if p.name_is_unique else ('~%s' % p.name) for p in circ.path])))
+    d = balancer.start()
+    d.addCallback(lambda _: defer.Deferred())
+    return d
 
-    state.set_attacher(Attacher(), reactor)
 
+async def attach_streams_exit_country(state, countries, pool_size=3, json=False):
+    """
+    Attach streams only to circuits exiting in one of `countries`
+    (upper-case codes) through an exit that takes the stream's port.
+    """
+    index = ExitIndex(state)
+    await index.build()
+    available = index.countries()
+    missing = [c for c in countries if not available.get(c)]
+    if len(missing) == len(countries):
+        raise RuntimeError("No exits in {}.".format(','.join(countries)))
+    if not json:
+        print("Exiting (e.g. Ctrl-C) will cause Tor to resume choosing circuits.")
+        print("Attaching new streams only to circuits exiting in {} ({} exits).".format(
+            ','.join(countries), sum(available.get(c, 0) for c in countries)))
+        if missing:
+            print("No exits in {}.".format(','.join(missing)))
+    if not index.exits(countries, POOL_PORT):
+        # nothing to keep spares of; build per port as needed
+        pool_size = 0
+    pool = CircuitPool(state, reactor, pool_size, build=pool_builder(state, index, countries), log=None if json else print)
+    attacher = ExitCountryAttacher(state, reactor, index, pool, countries, json=json)
+    await attacher.start()
+    await defer.Deferred()
 
-def attach_streams_to_circuit(circid, state):
+
+def attach_streams_to_circuit(circid, state, json=False):
     try:
         circ = state.circuits[circid]
     except KeyError:
-        print("Circuit {} doesn't exist.".format(circid))
-        return None
-    print("Exiting (e.g. Ctrl-C) will cause Tor to resume choosing circuits.")
-    print("Attaching all new streams to Circuit %d." % circ.id)
-    print("   ", '->'.join([p.name if p.name_is_unique else ('~%s' % p.name) for p in circ.path]))
+        raise RuntimeError("Circuit {} doesn't exist.".format(circid))
+    if not json:
+        print("Exiting (e.g. Ctrl-C) will cause Tor to resume choosing circuits.")
+        print("Attaching all new streams to Circuit %d." % circ.id)
+        print("   ", '->'.join([p.name if p.name_is_unique else ('~%s' % p.name) for p in circ.path]))
 
     @implementer(txtorcon.IStreamAttacher)
     class Attacher(txtorcon.CircuitListenerMixin):
 
         def circuit_closed(self, this_circ, **kw):
-            if circ == this_circ:
+            if circ == this_circ and json:
+                ndjson.emit(ndjson.circuit(circ, event='closed', time=time.time()))
+            elif circ == this_circ:
                 print("Circuit {} vanished (REASON={}, REMOTE_REASON={})".format(
                     circ.id,
                     kw.get('REASON', 'not specified'),
@@ -80,6 +142,8 @@ def attach_streams_to_circuit(circid, state):
                 # so -> probably want exiting to be an option, and not the default
 
         def attach_stream(self, stream, circuits):
+            if json:
+                return self._attach_stream_json(stream)
             if stream.flags.get('PURPOSE', 'unknown') in ['DIR_FETCH', 'DIR_UPLOAD', 'DIRPORT_TEST']:
                 print("  tor-internal directory stream ({})".format(stream.flags['PURPOSE']))
                 return None
@@ -93,6 +157,16 @@ def attach_streams_to_circuit(circid, state):
                                                 stream.target_port))
             return circ
 
+        def _attach_stream_json(self, stream):
+            if stream.flags.get('PURPOSE', 'unknown') in ['DIR_FETCH', 'DIR_UPLOAD', 'DIRPORT_TEST']:
+                ndjson.emit(ndjson.stream(stream, event='not_attached', time=time.time()))
+                return None
+            if circ.state == 'CLOSED':
+                ndjson.emit(ndjson.stream(stream, event='not_attached', time=time.time()))
+                return txtorcon.TorState.DO_NOT_ATTACH
+            ndjson.emit(ndjson.stream(stream, event='attach', circuit=circ.id, time=time.time()))
+            return circ
+
     attacher = Attacher()
     state.set_attacher(attacher, reactor)
     state.add_circuit_listener(attacher)
@@ -102,7 +176,15 @@ def attach_streams_to_circuit(circid, state):
     return d
 
 
-async def list_streams(state, verbose):
+async def list_streams(state, verbose, json=False):
+    if json:
+        for stream in state.streams.values():
+            record = ndjson.stream(stream)
+            if verbose:
+                record['pid'] = process_from_address(stream.source_addr, stream.source_port)
+            ndjson.emit(record)
+        return
+
     print("Streams:")
     for stream in state.streams.values():
         flags = str(stream.flags) if stream.flags else 'no flags'
@@ -115,33 +197,38 @@ async def list_streams(state, verbose):
                                                flags))
         if verbose:
             h = stream.target_addr if stream.target_addr else stream.target_host
-            source = txtorcon.util.process_from_address(stream.source_addr, stream.source_port)
+            source = process_from_address(stream.source_addr, stream.source_port)
             if source is None:
                 source = 'unknown'
             print("     to %s:%s, from %s" % (h, stream.target_port, source))
 
 
-async def close_stream(state, streamid):
+async def close_stream(state, streamid, json=False):
     class DetermineStreamClosure(object):
         def __init__(self, target_id, done_d):
-            self.circ_id = str(target_id)
+            self.circ_id = int(target_id)
             self.stream_gone = False
             self.already_deleted = False
             self.completed_d = done_d
 
         def __call__(self, text):
-            cid, what, _ = text.split(' ', 2)
-            if what in ['CLOSED', 'FAILED']:
-                if self.circ_id == cid:
+            event = StreamEvent(text)
+            if event.status in ['CLOSED', 'FAILED']:
+                if self.circ_id == event.id:
                     self.stream_gone = True
-                    print("gone (%s)..." % self.circ_id,)
-                    sys.stdout.flush()
+                    if not json:
+                        print("gone (%s)..." % self.circ_id,)
+                        sys.stdout.flush()
                     if self.already_deleted:
                         self.completed_d.callback(self)
     if streamid not in state.streams:
+        if json:
+            raise RuntimeError('No such stream "{}".'.format(streamid))
         print('No such stream "%s".' % streamid)
         return
-    print('Closing stream "%s"...' % (streamid, ))
+    stream = state.streams[streamid]
+    if not json:
+        print('Closing stream "%s"...' % (streamid, ))
 
     gone_d = defer.Deferred()
     monitor = DetermineStreamClosure(streamid, gone_d)
@@ -153,9 +240,17 @@ async def close_stream(state, streamid):
         status = status.state
         monitor.already_deleted = True
     except txtorcon.TorProtocolError as e:
+        if json:
+            raise
         print(util.colors.red('Error: ') + e.what())
         return
 
+    if json:
+        if not monitor.stream_gone:
+            await gone_d
+        ndjson.emit(ndjson.stream(stream, event='closed', time=time.time()))
+        return
+
     if monitor.stream_gone:
         print(status)
         return
@@ -167,98 +262,176 @@ async def close_stream(state, streamid):
     # that our stream has entered state CLOSED
 
 
+class _Ring(object):
+    """
+    Byte counts in `size` buckets of `width` seconds each, newest
+    overwriting oldest.
+    """
+    __slots__ = ('width', 'size', 'buckets', 'newest')
+
+    def __init__(self, width, size):
+        self.width = width
+        self.size = size
+        #: read, written for each bucket, in turn
+        self.buckets = array.array('Q', bytes(16 * size))
+        #: number (seconds since the epoch // width) of the newest
+        #: bucket
+        self.newest = None
+
+    def add(self, epoch, read, written):
+        number = int(epoch // self.width)
+        newest = self.newest
+        buckets = self.buckets
+        if newest is None:
+            self.newest = number
+        elif number > newest:
+            # empty the buckets we're skipping over or re-using
+            for n in range(max(newest + 1, number - self.size + 1), number + 1):
+                slot = 2 * (n % self.size)
+                buckets[slot] = buckets[slot + 1] = 0
+            self.newest = number
+        elif number <= newest - self.size:
+            # (out of order, and too old for us)
+            return
+        slot = 2 * (number % self.size)
+        buckets[slot] += read
+        buckets[slot + 1] += written
+
+    def items(self):
+        """
+        :returns: (start epoch, read, written) for each bucket, oldest
+            first.
+        """
+        if self.newest is None:
+            return
+        for n in range(self.newest - self.size + 1, self.newest + 1):
+            slot = 2 * (n % self.size)
+            yield n * self.width, self.buckets[slot], self.buckets[slot + 1]
+
+    def since(self, epoch):
+        """
+        :returns: (read, written) in buckets from the one holding
+            `epoch` on.
+        """
+        read = written = 0
+        first = int(epoch // self.width)
+        for start, r, w in self.items():
+            if start // self.width >= first:
+                read += r
+                written += w
+        return read, written
+
+
 class StreamBandwidth(object):
     """
-    The bandwidth-events of a single stream
+    The bandwidth-events of a single stream: running totals, and
+    recent history in ring-buffers of one-second, one-minute and
+    one-hour buckets. A coarser tier is only allocated (rolling up the
+    finer one into it) once the stream outlives the finer one, so most
+    streams never need more than the first.
     """
-    #  __slots__ = ['_events']
+    __slots__ = ('read', 'written', 'first', 'last', '_tiers')
 
-    def __init__(self, max_live=20, roll_up=5):
-        self._events = []  # list of 3-tuples
-        self._history = []
-        self.max_live = max_live
-        self.roll_up = roll_up
+    #: (seconds per bucket, number of buckets) for each tier
+    TIERS = ((1, 16), (60, 16), (60 * 60, 24))
 
-        # XXX we could recursively roll-up too, i.e. spill from one
-        # bucket to the next. but, for now, there are precisely two
-        # bucks: the "current", and the first one containing (avg,
-        # min, max) etc
+    def __init__(self):
+        self.read = 0
+        self.written = 0
+        self.first = None
+        self.last = None
+        self._tiers = (_Ring(*self.TIERS[0]),)
 
     def add_bandwidth(self, epoch, read, write):
-        self._events.append((epoch, read, write))
-        self._maybe_truncate()
-
-    def _maybe_truncate(self):
+        if self.first is None:
+            self.first = epoch
+        if self.last is None or epoch > self.last:
+            self.last = epoch
+        self.read += read
+        self.written += write
+        # roll up before the coarsest tier would lose its oldest bucket
+        while len(self._tiers) < len(self.TIERS):
+            width, size = self.TIERS[len(self._tiers) - 1]
+            if epoch // width - self.first // width < size - 1:
+                break
+            self._roll_up()
+        for tier in self._tiers:
+            tier.add(epoch, read, write)
+
+    def _roll_up(self):
         """
-        If we've gone past our max_live amount by at least roll_up events,
-        we push it into the history (possibly also truncating that).
+        Add the next tier, starting from what the coarsest one has.
         """
-        # XXX should we examine seconds here instead? i.e. have a
-        # max-seconds (instead of going by event-count)?
-        if len(self._events) > self.max_live + self.roll_up:
-            rolling = self._events[:self.roll_up]
-            self._events = self._events[self.roll_up:]
-            duration = float(self._events[0][0] - rolling[0][0])
-            mean_r = sum(x[1] for x in rolling) / duration
-            mean_w = sum(x[2] for x in rolling) / duration
-
-            # XXX should append some smarter-er object instead of tuple?
-            # (start, duration, mean_r, mean_w, max_r, max_w)
-            self._history.append(
-                (
-                    rolling[0][0],
-                    duration,
-                    mean_r, mean_w,
-                    max(x[1] for x in rolling),
-                    max(x[2] for x in rolling),
-                )
-            )
-            self._history = self._history[-10:]
-            print("HISTORY NOW", self._history)
-            print("age {}, total bw {}".format(
-                self._events[-1][0] - (self._history[-1][0] + self._history[-1][1]),
-                sum([sum(x[1:]) for x in self._history]),
-            ))
+        coarsest = self._tiers[-1]
+        tier = _Ring(*self.TIERS[len(self._tiers)])
+        for start, read, written in coarsest.items():
+            if read or written:
+                tier.add(start, read, written)
+        self._tiers = self._tiers + (tier,)
 
     def bytes_read(self):
-        return sum(event[1] for event in self._events)
+        return self.read
 
     def bytes_written(self):
-        return sum(event[2] for event in self._events)
+        return self.written
 
     def duration(self):
-        if not self._events:
+        if self.first is None:
             return 0.0
-        if len(self._events) == 1:
+        if self.last == self.first:
             return 1.0
-        return float(self._events[-1][0] - self._events[0][0]) + 1.0
+        return float(self.last - self.first) + 1.0
 
     def rate(self):
+        """
+        :returns: (read, written) bytes per second over the life of
+            the stream.
+        """
         span = self.duration()
         if span == 0.0:
             return (0.0, 0.0)  # mmm...pragmatism
-        return (self.bytes_read() / span, self.bytes_written() / span)
+        return (self.read / span, self.written / span)
+
+    def recent(self, seconds):
+        """
+        :returns: (read, written) bytes in about the last `seconds`
+            (in whole buckets of the finest tier that goes back that
+            far, the newest one included, or as far back as we have).
+        """
+        if self.last is None:
+            return (0, 0)
+        for tier in self._tiers:
+            if tier.width * tier.size >= seconds:
+                break
+        return tier.since(self.last - seconds + tier.width)
 
 
 class BandwidthMonitor(txtorcon.StreamListenerMixin):
     @staticmethod
-    async def create(reactor, state):
-        bw = BandwidthMonitor(reactor, state)
+    async def create(reactor, state, json=False):
+        bw = BandwidthMonitor(reactor, state, json=json)
         await bw._setup()
         return bw
 
-    def __init__(self, reactor, state):
+    def __init__(self, reactor, state, json=False):
         self._reactor = reactor  # just IReactorClock required?
         self._state = state
+        self._json = json
         self._active = {}  # maps stream ID -> list-of-tuples
 
     def stream_new(self, stream):
-        print("new", stream)
         self._active[stream.id] = StreamBandwidth()
+        if self._json:
+            ndjson.emit(ndjson.stream(stream, event='new', time=time.time()))
+        else:
+            print("new", stream)
 
     def stream_succeeded(self, stream):
         # i think this happens when it *starts* passing data?
-        print("succeeded", stream, stream.target_host, stream.target_addr)
+        if self._json:
+            ndjson.emit(ndjson.stream(stream, event='succeeded', time=time.time()))
+        else:
+            print("succeeded", stream, stream.target_host, stream.target_addr)
 
     def stream_attach(self, stream, circuit):
         pass
@@ -268,7 +441,16 @@ class BandwidthMonitor(txtorcon.StreamListenerMixin):
 
     def stream_closed(self, stream, **kw):
         # print("closed", stream, self._active)
-        if stream.id not in self._active:
+        if self._json:
+            bw = self._active.pop(stream.id, None)
+            record = ndjson.stream(stream, event='closed', time=time.time())
+            if bw is not None:
+                record['bytes_read'] = bw.bytes_read()
+                record['bytes_written'] = bw.bytes_written()
+                record['duration'] = bw.duration()
+                record['read_rate'], record['write_rate'] = bw.rate()
+            ndjson.emit(record)
+        elif stream.id not in self._active:
             print(
                 "Previously unknown stream to {stream.target_host} died".format(
                     stream=stream,
@@ -290,35 +472,47 @@ class BandwidthMonitor(txtorcon.StreamListenerMixin):
         pass
 
     def _stream_bw(self, bw):
-        sid, wr, rd = [int(x) for x in bw.split()]
+        event = StreamBwEvent(bw)
         try:
-            bandwidth = self._active[sid]
+            bandwidth = self._active[event.stream_id]
         except KeyError:
-            bandwidth = self._active[sid] = StreamBandwidth()
-        bandwidth.add_bandwidth(self._reactor.seconds(), rd, wr)
+            bandwidth = self._active[event.stream_id] = StreamBandwidth()
+        bandwidth.add_bandwidth(self._reactor.seconds(), event.read, event.written)
 
     async def _setup(self):
         self._state.add_stream_listener(self)
         await self._state.protocol.add_event_listener('STREAM_BW', self._stream_bw)
 
 
-async def monitor_streams(state, verbose):
-    print("monitor", state, verbose)
+async def monitor_streams(state, verbose, json=False):
+    if not json:
+        print("monitor", state, verbose)
     from twisted.internet import reactor
-    bw = await BandwidthMonitor.create(reactor, state)
-    print(bw)
+    bw = await BandwidthMonitor.create(reactor, state, json=json)
+    if not json:
+        print(bw)
     await defer.Deferred()
 
 
-async def run(reactor, cfg, tor, list, follow, attach, close, verbose):
+async def run(reactor, cfg, tor, list, follow, attach, close, verbose,
+              isolate=None, pool_size=None, max_age=None, stats_interval=60.0,
+              exit_countries=None):
     state = await tor.create_state()
-    if attach:
-        await attach_streams_to_circuit(attach, state)
+    if exit_countries:
+        await attach_streams_exit_country(state, exit_countries, 3 if pool_size is None else pool_size, json=cfg.json)
+    elif attach:
+        circuit_ids, auto = attach
+        if len(circuit_ids) == 1:
+            await attach_streams_to_circuit(circuit_ids[0], state, json=cfg.json)
+        else:
+            await attach_streams_balanced(state, circuit_ids, auto, json=cfg.json)
+    elif isolate:
+        await attach_streams_isolated(state, isolate, pool_size, max_age, stats_interval, json=cfg.json)
     elif list:
-        await list_streams(state, verbose)
+        await list_streams(state, verbose, json=cfg.json)
     elif close:
-        await close_stream(state, close)
+        await close_stream(state, close, json=cfg.json)
     elif follow:
         d = defer.succeed(None)
-        await monitor_streams(state, verbose)
+        await monitor_streams(state, verbose, json=cfg.json)
         await defer.Deferred()
@@ -0,0 +1,171 @@
+'''
+A pool of spare, already-BUILT circuits.
+
+Stream attachers that want a circuit of their own for something (a
+process, say) would otherwise have to wait for Tor to build one -- a
+second or more -- before the first stream could go anywhere.
+CircuitPool keeps `size` spare circuits built in the background, hands
+one out immediately when asked (or as soon as one is built, if there
+are none), and starts building a replacement for each one handed out
+or lost.
+'''
+import time
+import collections
+
+import txtorcon
+from twisted.internet import defer
+
+
+class CircuitPool(txtorcon.CircuitListenerMixin):
+    """
+    :param size: how many spare BUILT circuits to keep.
+
+    :param build: callable returning a Deferred that fires with a new
+        Circuit (default: let Tor choose the path).
+
+    :param max_age: if not None, spare circuits older than this many
+        seconds are closed (and replaced) instead of handed out.
+    """
+
+    #: seconds to wait before trying again after a build fails
+    RETRY_DELAY = 1.0
+
+    def __init__(self, state, reactor, size, build=None, max_age=None, log=None):
+        self._state = state
+        self._reactor = reactor
+        self.size = size
+        self._build = build or state.build_circuit
+        self._max_age = max_age
+        self._log = log or (lambda msg: None)
+        #: circuit id -> (Circuit, when it was built), oldest first
+        self._spare = collections.OrderedDict()
+        #: circuit id -> Circuit, for ones we launched that aren't
+        #: BUILT yet
+        self._pending = {}
+        #: builds we've asked for but don't have a circuit id for yet
+        self._requested = 0
+        #: Deferreds from take() waiting for a circuit
+        self._waiting = collections.deque()
+        self._retry = None
+        self.built = 0
+        self.failed = 0
+
+    def start(self):
+        self._state.add_circuit_listener(self)
+        self._refill()
+
+    def stop(self):
+        if self._retry is not None and self._retry.active():
+            self._retry.cancel()
+        for d in self._waiting:
+            d.cancel()
+        self._waiting.clear()
+
+    def __len__(self):
+        return len(self._spare)
+
+    def take(self):
+        """
+        :returns: a Deferred that fires with a BUILT Circuit that's now
+            the caller's (immediately, if we have a spare).
+        """
+        now = time.time()
+        while self._spare:
+            _, (circuit, built_at) = self._spare.popitem(last=False)
+            if circuit.state != 'BUILT':
+                continue
+            if self._max_age is not None and now - built_at > self._max_age:
+                circuit.close()
+                continue
+            self._refill()
+            return defer.succeed(circuit)
+        d = defer.Deferred()
+        self._waiting.append(d)
+        self._refill()
+        return d
+
+    def take_matching(self, accept):
+        """
+        :returns: the oldest spare circuit for which `accept(circuit)`
+            is True (now the caller's), or None if there isn't one.
+        """
+        now = time.time()
+        for circuit_id, (circuit, built_at) in list(self._spare.items()):
+            if circuit.state != 'BUILT':
+                del self._spare[circuit_id]
+            elif self._max_age is not None and now - built_at > self._max_age:
+                del self._spare[circuit_id]
+                circuit.close()
+            elif accept(circuit):
+                del self._spare[circuit_id]
+                self._refill()
+                return circuit
+        self._refill()
+        return None
+
+    def release(self, circuit):
+        """
+        The caller is done with `circuit` (from take()); it is closed,
+        rather than re-used for someone else.
+        """
+        if circuit.state not in ('CLOSED', 'FAILED'):
+            d = circuit.close()
+            # e.g. it closed in the meantime
+            d.addErrback(lambda _: None)
+
+    def _refill(self):
+        wanted = self.size + len(self._waiting)
+        while len(self._spare) + len(self._pending) + self._requested < wanted:
+            # (a build that fails straight away schedules a retry;
+            # don't keep launching more)
+            if self._retry is not None and self._retry.active():
+                return
+            self._launch()
+
+    def _launch(self):
+        self._requested += 1
+        d = defer.maybeDeferred(self._build)
+        d.addCallbacks(self._launched, self._launch_failed)
+
+    def _launched(self, circuit):
+        self._requested -= 1
+        if circuit.state == 'BUILT':
+            self._ready(circuit)
+        elif circuit.state in ('CLOSED', 'FAILED'):
+            self._lost()
+        else:
+            self._pending[circuit.id] = circuit
+
+    def _launch_failed(self, failure):
+        self._requested -= 1
+        self._log("Failed to build a circuit: {}".format(failure.getErrorMessage()))
+        self._lost()
+
+    def _ready(self, circuit):
+        self.built += 1
+        while self._waiting:
+            d = self._waiting.popleft()
+            if not d.called:
+                d.callback(circuit)
+                return
+        self._spare[circuit.id] = (circuit, time.time())
+
+    def _lost(self):
+        self.failed += 1
+        # don't hammer Tor if it can't build anything right now
+        if self._retry is None or not self._retry.active():
+            self._retry = self._reactor.callLater(self.RETRY_DELAY, self._refill)
+
+    # ICircuitListener
+
+    def circuit_built(self, circuit):
+        if self._pending.pop(circuit.id, None) is not None:
+            self._ready(circuit)
+
+    def circuit_closed(self, circuit, **kw):
+        if self._pending.pop(circuit.id, None) is not None:
+            self._lost()
+        elif self._spare.pop(circuit.id, None) is not None:
+            self._refill()
+
+    circuit_failed = circuit_closed
@@ -1,36 +1,176 @@
 import sys
-
-from twisted.internet import defer, task
-from twisted.internet.endpoints import clientFromString
-from twisted.python.failure import Failure
-from twisted.python import usage, log
+import time
+import functools
+import importlib
 
 import click
-import txtorcon
-
-from . import carml_readme
-from . import carml_check_pypi
-from . import carml_stream
-from . import carml_events
-from . import carml_circ
-from . import carml_cmd
-from . import carml_monitor
-from . import carml_newid
-from . import carml_pastebin
-from . import carml_copybin
-from . import carml_relay
-from . import carml_tbb
-from . import carml_onion
-from . import carml_tmux
-from . import carml_xplanet
-from . import carml_graph
+
+
+#: maps each sub-command to the module implementing it. We only
+#: import these when the command actually runs (see _run_command)
+#: because several of them pull in a lot (pyOpenSSL, twisted.web,
+#: pkg_resources, ...) and we don't want to pay for that on every
+#: "carml tmux" or "carml cmd" call.
+COMMAND_MODULES = {
+    'readme': 'carml.carml_readme',
+    'check_pypi': 'carml.carml_check_pypi',
+    'stream': 'carml.carml_stream',
+    'events': 'carml.carml_events',
+    'circ': 'carml.carml_circ',
+    'cmd': 'carml.carml_cmd',
+    'monitor': 'carml.carml_monitor',
+    'newid': 'carml.carml_newid',
+    'pastebin': 'carml.carml_pastebin',
+    'copybin': 'carml.carml_copybin',
+    'relay': 'carml.carml_relay',
+    'tbb': 'carml.carml_tbb',
+    'onion': 'carml.carml_onion',
+    'tmux': 'carml.carml_tmux',
+    'xplanet': 'carml.carml_xplanet',
+    'graph': 'carml.carml_graph',
+    'daemon': 'carml.carml_daemon',
+    'protocol_dump': 'carml.carml_protocol_dump',
+}
+
+
+def _command_runner(name):
+    """
+    Internal helper. Imports the module for sub-command `name` and
+    returns its run() coroutine-function.
+    """
+    return importlib.import_module(COMMAND_MODULES[name]).run
 
 
 LOG_LEVELS = ["DEBUG", "INFO", "NOTICE", "WARN", "ERR"]
 
+_SIZE_SUFFIXES = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+
+def _parse_size(ctx, param, value):
+    """
+    click callback: a number of bytes, with an optional K, M or G.
+    """
+    if value is None:
+        return None
+    text = value.strip().upper().rstrip('B')
+    suffix = text[-1:] if text[-1:] in _SIZE_SUFFIXES else ''
+    try:
+        size = int(float(text[:len(text) - len(suffix)]) * _SIZE_SUFFIXES[suffix])
+    except ValueError:
+        raise click.BadParameter('"{}" is not a size like 500K or 100M'.format(value))
+    if size <= 0:
+        raise click.BadParameter('must be more than zero')
+    return size
+
+
+_INTERVAL_SUFFIXES = {'s': 1, 'm': 60, 'h': 60 * 60, 'd': 24 * 60 * 60}
+
+
+def _parse_interval(ctx, param, value):
+    """
+    click callback: a number of seconds, or minutes/hours/days with an
+    m, h or d suffix.
+    """
+    if value is None:
+        return None
+    text = value.strip().lower()
+    multiplier = _INTERVAL_SUFFIXES.get(text[-1:], None)
+    if multiplier is not None:
+        text = text[:-1]
+    try:
+        seconds = float(text) * (multiplier or 1)
+    except ValueError:
+        raise click.BadParameter('"{}" is not an interval like 10s or 5m'.format(value))
+    if seconds <= 0:
+        raise click.BadParameter('must be more than zero')
+    return seconds
+
+
+def _parse_rate(ctx, param, value):
+    """
+    click callback: COUNT/INTERVAL, e.g. 20/10s; returns (count, seconds).
+    """
+    if value is None:
+        return None
+    count, _, interval = value.partition('/')
+    try:
+        count = int(count)
+    except ValueError:
+        raise click.BadParameter('"{}" is not like 20/10s'.format(value))
+    return count, _parse_interval(ctx, param, interval or '1')
+
+
+def _parse_circuits(ctx, param, value):
+    """
+    click callback: comma-separated circuit IDs, or auto:N for N new
+    circuits; returns (ids, N).
+    """
+    if value is None:
+        return None
+    text = value.strip().lower()
+    if text.startswith('auto'):
+        count = text[4:].lstrip(':') or '1'
+        try:
+            count = int(count)
+        except ValueError:
+            raise click.BadParameter('"{}" is not like auto:4'.format(value))
+        if count <= 0:
+            raise click.BadParameter('must be more than zero')
+        return (), count
+    try:
+        ids = tuple(int(x) for x in text.split(',') if x.strip())
+    except ValueError:
+        raise click.BadParameter('"{}" is not a circuit ID, a list like 12,15,18, or auto:4'.format(value))
+    if not ids:
+        raise click.BadParameter('no circuit IDs')
+    return ids, 0
+
+
+def _parse_countries(ctx, param, value):
+    """
+    click callback: comma-separated two-letter country codes; returns
+    a tuple of them, upper-case.
+    """
+    if value is None:
+        return None
+    countries = tuple(c.strip().upper() for c in value.split(',') if c.strip())
+    for country in countries:
+        if len(country) != 2 or not country.isalpha():
+            raise click.BadParameter('"{}" is not a two-letter country code'.format(country))
+    if not countries:
+        raise click.BadParameter('no country codes')
+    return countries
+
+
+def _parse_time(ctx, param, value):
+    """
+    click callback: a time, as epoch seconds.
+    """
+    if value is None:
+        return None
+    from carml.eventstore import parse_time
+    try:
+        return parse_time(value)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+
+def _compile_filters(ctx, param, value):
+    """
+    click callback: compiles "events --filter" expressions up-front,
+    so mistakes are usage errors.
+    """
+    from carml.eventfilter import compile_filters, FilterError
+    try:
+        return compile_filters(value)
+    except FilterError as e:
+        raise click.BadParameter(str(e))
+
 
 class LogObserver(object):
     def __init__(self, timestamp=False, flush=True):
+        from . import util
+        self._colors = util.colors
         self.timestamp = timestamp
         self.flush = flush
         # we keep our own copies of these, because Twisted's
@@ -38,6 +178,9 @@ class LogObserver(object):
         # monitoring machinery
         self.stdout = sys.stdout
         self.stderr = sys.stderr
+        # time.asctime() only changes once a second, so we re-use it
+        self._second = None
+        self._asctime = None
 
     def __call__(self, arg):
         # we don't want to print out every little thing logged by
@@ -52,16 +195,21 @@ class LogObserver(object):
 
         # possibly add timestamps
         if self.timestamp:
-            msg = util.colors.cyan(time.asctime()) + ': ' + msg
+            now = int(time.time())
+            if now != self._second:
+                self._second = now
+                self._asctime = self._colors.cyan(time.asctime(time.localtime(now)))
+            msg = self._asctime + ': ' + msg
 
         # figure out if we want stdout or stderr
         out = self.stdout
         if 'isError' in arg and arg['isError']:
             out = self.stderr
             if not msg and 'failure' in arg:
-                msg = util.colors.red('Error: ') + arg['failure'].getErrorMessage()
+                msg = self._colors.red('Error: ') + arg['failure'].getErrorMessage()
 
-        # actually print message
+        # actually print message; if stdout is an OutputSink, this
+        # flush() just means "soon"
         print(msg, file=out)
         if self.flush:
             out.flush()
@@ -85,6 +233,14 @@ class Config(object):
           'read/written in different colours'),
     is_flag=True,
 )
+@click.option(
+    '--capture-protocol',
+    help=('Record all bytes read from and written to Tor in a compact binary '
+          'file; see "carml protocol-dump" to show it.'),
+    default=None,
+    type=click.Path(dir_okay=False, writable=True),
+    metavar='FILE',
+)
 @click.option(
     '--password', '-p',
     help=('Password to authenticate to Tor with. Using cookie-based authentication'
@@ -94,12 +250,49 @@ class Config(object):
 )
 @click.option(
     '--connect', '-c',
-    default=None,
+    multiple=True,
     help=('Where to connect to Tor. This accepts any Twisted client endpoint '
           'string, or an ip:port pair. Examples: "tcp:localhost:9151" or '
-          '"unix:/var/run/tor/control".'),
+          '"unix:/var/run/tor/control". Give it more than once to run the '
+          'command against several Tors at once.'),
     metavar='ENDPOINT',
 )
+@click.option(
+    '--connect-file',
+    type=click.File('r'),
+    default=None,
+    help='Read more --connect endpoints from this file, one per line.',
+)
+@click.option(
+    '--daemon-socket',
+    default=None,
+    envvar='CARML_DAEMON_SOCKET',
+    help=('UNIX socket where "carml daemon" listens (default is '
+          '$XDG_RUNTIME_DIR/carml-<uid>.sock, or carml-<uid>/carml.sock '
+          'in the temp directory).'),
+    metavar='PATH',
+)
+@click.option(
+    '--no-daemon',
+    help='Always connect to Tor directly, even if a "carml daemon" is running.',
+    is_flag=True,
+)
+@click.option(
+    '--no-consensus-cache',
+    help='Always download and parse the consensus, ignoring (and not writing) our on-disk snapshot of it.',
+    is_flag=True,
+)
+@click.option(
+    '--profile',
+    help='Print how long each phase (connecting, authenticating, creating state, the command) took on stderr.',
+    is_flag=True,
+)
+@click.option(
+    '--profile-output',
+    help='With --profile, also dump cProfile stats for the command to this file (see the "pstats" module).',
+    default=None,
+    metavar='FILE',
+)
 @click.option(
     '--color', '-C',
     type=click.Choice(['auto', 'no', 'always']),
@@ -113,7 +306,7 @@ class Config(object):
     is_flag=True,
 )
 @click.pass_context
-def carml(ctx, timestamps, no_color, info, quiet, debug, debug_protocol, password, connect, color, json):
+def carml(ctx, timestamps, no_color, info, quiet, debug, debug_protocol, capture_protocol, password, connect, connect_file, daemon_socket, no_daemon, no_consensus_cache, profile, profile_output, color, json):
     if (color == 'always' and no_color) or \
        (color == 'no' and no_color is True):
         raise click.UsageError(
@@ -129,95 +322,253 @@ def carml(ctx, timestamps, no_color, info, quiet, debug, debug_protocol, passwor
     cfg.quiet = quiet
     cfg.debug = debug
     cfg.password = password
-    cfg.connect = connect
+    connects = list(connect)
+    if connect_file is not None:
+        from .fanout import read_connect_file
+        connects.extend(read_connect_file(connect_file))
+    if len(connects) > 1 and capture_protocol is not None:
+        raise click.UsageError("--capture-protocol can't be used with more than one --connect")
+    cfg.connects = connects or [None]
+    cfg.connect = cfg.connects[0]
+    cfg.daemon_socket = daemon_socket
+    cfg.no_daemon = no_daemon
+    cfg.no_consensus_cache = no_consensus_cache
+    cfg.profile = profile or profile_output is not None
+    cfg.profile_output = profile_output
     cfg.color = color
     cfg.debug_protocol = debug_protocol
+    cfg.capture_protocol = capture_protocol
+    cfg.replay = None
     cfg.json = True if json else False
 
+
+def _run_command(name, cfg, *args, **kwargs):
+    # these are imported here, rather than at the top, to keep the
+    # start-up time of "carml --help" etc down
+    from twisted.internet import defer, task
+    from twisted.python import log
+    import txtorcon
+
+    cmd = _command_runner(name)
+
+    # batch up what commands print, unless it's going to a terminal
+    from twisted.internet import reactor
+    from . import output
+    sink = output.install(reactor)
+
     # start logging
     _log_observer = LogObserver()
     log.startLoggingWithObserver(_log_observer, setStdout=False)
 
+    if cfg.profile:
+        from .profiling import PhaseProfiler
+        profiler = PhaseProfiler(pstats_path=cfg.profile_output)
+    else:
+        from .profiling import NullProfiler
+        profiler = NullProfiler()
 
-def _run_command(cmd, cfg, *args, **kwargs):
+    from . import capture
+    capture_writer = None
+    replayer = None
 
     async def _startup(reactor):
-        if cfg.connect is None:
-            ep = None
-        elif cfg.connect.startswith('tcp:') or cfg.connect.startswith('unix:'):
-            ep = clientFromString(reactor, cfg.connect)
-        else:
-            if ':' in cfg.connect:
-                ep = clientFromString(reactor, 'tcp:{}'.format(cfg.connect))
-            else:
-                ep = clientFromString(reactor, 'tcp:localhost:{}'.format(cfg.connect))
-        tor = await txtorcon.connect(reactor, ep)
-        if ep is None:
+        nonlocal capture_writer
+        if cfg.capture_protocol is not None:
+            capture_writer = capture.CaptureWriter(
+                open(cfg.capture_protocol, 'wb'),
+                reactor=reactor,
+            )
+
+        if cfg.replay is not None:
+            await _startup_replay(reactor)
+            return
+
+        if len(cfg.connects) > 1:
+            await _startup_many(reactor)
+            return
+
+        with profiler.phase('resolve endpoint'):
+            ep = _endpoint(reactor, cfg.connect)
+        with profiler.phase('connect'):
+            tor = await txtorcon.connect(reactor, profiler.timed_endpoint('tcp connect', ep))
+        if ep is None and not cfg.json:
             print("Connected via {}".format(tor.protocol.transport.addr))
 
+        if not cfg.no_consensus_cache:
+            # every command gets its TorState via tor.create_state(),
+            # so this is the one place to make them all use the
+            # snapshot
+            from . import consensus_cache
+            tor.create_state = functools.partial(consensus_cache.create_state, tor)
+        tor.create_state = profiler.wrap('create_state', tor.create_state)
+
+        await _run_with(reactor, tor)
+
+    async def _startup_replay(reactor):
+        nonlocal replayer
+        from . import replay
+        with open(cfg.replay, 'rb') as f:
+            session = replay.ReplaySession.from_file(f)
+        replayer = replay.ReplayTransport(
+            reactor, session,
+            realtime=cfg.replay_realtime,
+            speed=cfg.replay_speed,
+        )
+        with profiler.phase('connect'):
+            tor = await replay.connect(reactor, replayer)
+        # the on-disk snapshot belongs to the live Tor, not the capture
+        tor.create_state = profiler.wrap('create_state', tor.create_state)
+
+        # listening commands never finish by themselves, so we stop
+        # when the capture runs out of events
+        d = defer.ensureDeferred(_run_with(reactor, tor))
+        replayer.done.addCallback(lambda _: d.cancel())
+        try:
+            await d
+        except defer.CancelledError:
+            pass
+
+    async def _startup_many(reactor):
+        # one connection per --connect, all at once; each runs the
+        # command in parallel with its output tagged
+        from . import fanout, consensus_cache
+        tagged = fanout.install(json=cfg.json)
+
+        async def _connect(connect):
+            tor = await txtorcon.connect(reactor, _endpoint(reactor, connect))
+            # instances with the same consensus share the parsed
+            # router records (even with --no-consensus-cache, which
+            # only turns off the on-disk snapshot here)
+            tor.create_state = functools.partial(
+                consensus_cache.create_state, tor,
+                use_disk=not cfg.no_consensus_cache,
+            )
+            _debug_protocol(tor)
+            tagged.tag_protocol(connect, tor.protocol)
+            return tor
+
+        with profiler.phase('connect'):
+            results = await defer.DeferredList(
+                [defer.ensureDeferred(_connect(c)) for c in cfg.connects],
+                consumeErrors=True,
+            )
+        failed = False
+        running = []
+        with profiler.phase('command'):
+            for connect, (ok, result) in zip(cfg.connects, results):
+                with tagged.tagged(connect):
+                    if not ok:
+                        print("Error: {}".format(result.value))
+                        failed = True
+                        continue
+                    running.append(defer.ensureDeferred(_run_instance(reactor, result)))
+            for connect, (ok, result) in zip(cfg.connects, await defer.DeferredList(running, consumeErrors=True)):
+                if not ok:
+                    with tagged.tagged(connect):
+                        _the_bad_stuff(result, exit=False)
+                    failed = True
+        tagged.close()
+        if failed:
+            raise SystemExit(1)
+
+    def _debug_protocol(tor):
         if cfg.debug_protocol:
-
             click.echo("Low-level protocol debugging: ", nl=False)
             click.echo(click.style("data we write to Tor, ", fg='blue'), nl=False)
             click.echo(click.style("data from Tor", fg='yellow') + ".")
+            capture.capture_protocol(tor.protocol, capture.ProtocolRenderer())
 
-            def write_wrapper(data):
-                tail = data
-                while len(tail):
-                    head, tail = tail.split('\r\n', 1)
-                    click.echo(">>> " + click.style(head, fg='blue'), nl=False)
-                click.echo()
-                return orig_write(data)
-            orig_write = tor.protocol.transport.write
-            tor.protocol.transport.write = write_wrapper
-
-            def read_wrapper(data):
-                tail = data
-                while '\r\n' in tail:
-                    head, tail = tail.split('\r\n', 1)
-                    if not read_wrapper.write_prefix:
-                        click.echo(click.style(head, fg='yellow'))
-                        read_wrapper.write_prefix = True
-                    else:
-                        click.echo("<<< " + click.style(head, fg='yellow'))
-                if len(tail):
-                    click.echo("<<< " + click.style(tail, fg='yellow'), nl=False)
-                    read_wrapper.write_prefix = False
-                else:
-                    click.echo()
-                return orig_read(data)
-            read_wrapper.write_prefix = True
-            orig_read = tor.protocol.dataReceived
-            tor.protocol.dataReceived = read_wrapper
-
+    async def _show_info(tor):
+        info = await tor.protocol.get_info('version', 'status/version/current', 'dormant')
+        click.echo(
+            'Connected to a Tor version "{version}" (status: '
+            '{status/version/current}).\n'.format(**info)
+        )
 
+    async def _run_instance(reactor, tor):
         if cfg.info:
-            info = await tor.protocol.get_info('version', 'status/version/current', 'dormant')
-            click.echo(
-                'Connected to a Tor version "{version}" (status: '
-                '{status/version/current}).\n'.format(**info)
-            )
+            await _show_info(tor)
         await cmd(reactor, cfg, tor, *args, **kwargs)
 
-    from twisted.internet import reactor
-    codes = [0]
+    async def _run_with(reactor, tor):
+        _debug_protocol(tor)
+        if capture_writer is not None:
+            capture.capture_protocol(tor.protocol, capture_writer)
 
-    def _the_bad_stuff(f):
+        if cfg.info:
+            with profiler.phase('get_info'):
+                await _show_info(tor)
+        with profiler.phase('command'):
+            await cmd(reactor, cfg, tor, *args, **kwargs)
+
+    def _the_bad_stuff(f, exit=True):
+        if f.check(SystemExit):
+            return f
         print("Error: {}".format(f.value))
         if cfg.debug:
             print(f.getTraceback())
-        codes[0] = 1
-        return None
-
-    def _go():
+        if exit:
+            raise SystemExit(1)
+
+    def _report(arg):
+        sink.close()
+        if capture_writer is not None:
+            capture_writer.close()
+        if replayer is not None:
+            replayer.report()
+        profiler.report()
+        return arg
+
+    def _main(reactor):
         d = defer.ensureDeferred(_startup(reactor))
         d.addErrback(_the_bad_stuff)
-        d.addBoth(lambda _: reactor.stop())
+        d.addBoth(_report)
+        return d
+
+    # react() exits the process for us
+    task.react(_main)
+
+
+def _endpoint(reactor, connect):
+    """
+    :returns: a client endpoint for the --connect string `connect`, or
+        None (meaning let txtorcon guess) if it's None.
+    """
+    from twisted.internet.endpoints import clientFromString
+    if connect is None:
+        return None
+    if connect.startswith('tcp:') or connect.startswith('unix:'):
+        return clientFromString(reactor, connect)
+    if ':' in connect:
+        return clientFromString(reactor, 'tcp:{}'.format(connect))
+    return clientFromString(reactor, 'tcp:localhost:{}'.format(connect))
+
 
-    # XXX can't we replace this with react() instead?
-    reactor.callWhenRunning(_go)
-    reactor.run()
-    sys.exit(codes[0])
+def _maybe_via_daemon(name, cfg, *args):
+    """
+    Internal helper. If a "carml daemon" is running, it answers this
+    command (using its already-connected Tor and live state) and we
+    exit. Otherwise we return and the caller uses _run_command() to
+    connect to Tor directly.
+    """
+    if cfg.no_daemon or cfg.info or cfg.debug_protocol or cfg.capture_protocol or cfg.replay:
+        return
+    if len(cfg.connects) > 1:
+        return
+    from .daemon_client import query_daemon, default_socket_path
+    reply = query_daemon(
+        cfg.daemon_socket or default_socket_path(),
+        name, args,
+        connect=cfg.connect,
+        options={'json': cfg.json, 'quiet': cfg.quiet},
+    )
+    if reply is None:
+        return
+    sys.stdout.write(reply['output'])
+    if reply['error'] is not None:
+        print("Error: {}".format(reply['error']))
+        sys.exit(1)
+    sys.exit(0)
 
 
 def _no_json(cfg):
@@ -236,7 +587,7 @@ def readme(cfg):
     """
     _no_json(cfg)
     return _run_command(
-        carml_readme.run,
+        'readme',
         cfg,
     )
 
@@ -259,7 +610,7 @@ def check_pypi(cfg, package, revision):
     """
     _no_json(cfg)
     return _run_command(
-        carml_check_pypi.run,
+        'check_pypi',
         cfg, package, revision,
     )
 
@@ -299,13 +650,14 @@ def circ(cfg, if_unused, verbose, list, build, delete):
     """
     Manipulate Tor circuits.
     """
-    _no_json(cfg)
     if len([o for o in [list, build, delete] if o]) != 1:
         raise click.UsageError(
             "Specify just one of --list, --build or --delete"
         )
+    if list:
+        _maybe_via_daemon('circ', cfg, if_unused, verbose, list, build, delete)
     return _run_command(
-        carml_circ.run,
+        'circ',
         cfg, if_unused, verbose, list, build, delete,
     )
 
@@ -323,7 +675,7 @@ def cmd(cfg, command_args):
     """
     _no_json(cfg)
     return _run_command(
-        carml_cmd.run,
+        'cmd',
         cfg, command_args,
     )
 
@@ -349,23 +701,218 @@ def cmd(cfg, command_args):
     help='Output this many events, and quit (default is unlimited).',
     type=int,
 )
+@click.option(
+    '--filter', 'filters',
+    help='Only show events matching this, e.g. PURPOSE=HS_SERVICE_REND, "STATUS in (FAILED,CLOSED)" or /regex/ (may be repeated; all must match).',
+    multiple=True,
+    callback=_compile_filters,
+    metavar='EXPRESSION',
+)
+@click.option(
+    '--aggregate',
+    help='Instead of each event, show how many there were (and bytes, for bandwidth events) every INTERVAL, e.g. 10s or 5m.',
+    callback=_parse_interval,
+    metavar='INTERVAL',
+    default=None,
+)
+@click.option(
+    '--by',
+    help='With --aggregate, also count each value of this keyword, e.g. STATUS, PURPOSE or REASON (may be repeated).',
+    multiple=True,
+    metavar='KEYWORD',
+)
+@click.option(
+    '--enrich',
+    help='Add the circuit path, exit country, process and resolved address to STREAM events (implies STREAM).',
+    is_flag=True,
+)
+@click.option(
+    '--capture',
+    help='Save events to an indexed, compressed capture FILE instead of printing them (see --from-capture).',
+    type=click.Path(dir_okay=False, writable=True),
+    metavar='FILE',
+    default=None,
+)
+@click.option(
+    '--from-capture',
+    help='Show events from a capture made with --capture, instead of from Tor.',
+    type=click.Path(exists=True, dir_okay=False),
+    metavar='FILE',
+    default=None,
+)
+@click.option(
+    '--since',
+    help='With --from-capture, start at this time (e.g. "2024-01-02 03:12", "03:12" or epoch seconds).',
+    callback=_parse_time,
+    metavar='TIME',
+    default=None,
+)
+@click.option(
+    '--until',
+    help='With --from-capture, stop at this time.',
+    callback=_parse_time,
+    metavar='TIME',
+    default=None,
+)
+@click.option(
+    '--type', 'types',
+    help='With --from-capture, only show this type of event (may be repeated; same as listing them).',
+    multiple=True,
+    metavar='EVENT',
+)
+@click.option(
+    '--serve',
+    help='Instead of printing events, serve them to any number of clients connecting to this endpoint (e.g. unix:/tmp/events or tcp:9052:interface=127.0.0.1).',
+    metavar='ENDPOINT',
+    default=None,
+)
+@click.option(
+    '--client-buffer',
+    help='With --serve, how much to queue for a client that is not keeping up (default 1M).',
+    callback=_parse_size,
+    metavar='SIZE',
+    default='1M',
+)
+@click.option(
+    '--slow-clients',
+    help='With --serve, what to do when a client\'s buffer is full: disconnect it, or skip events until it catches up.',
+    type=click.Choice(['drop', 'sample']),
+    default='drop',
+)
+@click.option(
+    '--flight-recorder',
+    help='Instead of printing events, keep the most recent ones in memory and save them to a capture in DIRECTORY on SIGUSR1 or when --trigger fires.',
+    type=click.Path(file_okay=False, exists=True, writable=True),
+    metavar='DIRECTORY',
+    default=None,
+)
+@click.option(
+    '--keep',
+    help='With --flight-recorder, how long to keep events for (default 10m).',
+    callback=_parse_interval,
+    metavar='INTERVAL',
+    default='10m',
+)
+@click.option(
+    '--max-memory',
+    help='With --flight-recorder, memory to keep events in (default 64M).',
+    callback=_parse_size,
+    metavar='SIZE',
+    default='64M',
+)
+@click.option(
+    '--trigger',
+    help='With --flight-recorder, save events when too many (see --trigger-rate) match this filter (may be repeated; all must match).',
+    multiple=True,
+    callback=_compile_filters,
+    metavar='EXPRESSION',
+)
+@click.option(
+    '--trigger-rate',
+    help='How many --trigger events in how long are too many (default 20/10s).',
+    callback=_parse_rate,
+    metavar='COUNT/INTERVAL',
+    default='20/10s',
+)
+@click.option(
+    '--output', '-o',
+    help='Write events to this file instead of stdout.',
+    type=click.Path(dir_okay=False, writable=True),
+    default=None,
+)
+@click.option(
+    '--rotate-size',
+    help='With --output, start a new file after this many bytes (e.g. 100M).',
+    callback=_parse_size,
+    metavar='SIZE',
+    default=None,
+)
+@click.option(
+    '--rotate-interval',
+    help='With --output, start a new file after this many seconds.',
+    type=click.FloatRange(min=1.0),
+    default=None,
+)
+@click.option(
+    '--compress',
+    help='With --output, compress each file as it is written.',
+    type=click.Choice(['none', 'gzip', 'zstd']),
+    default='none',
+)
 @click.argument(
     "events",
     nargs=-1,
 )
 @click.pass_obj
-def events(cfg, list, once, show_event, count, events):
+def events(cfg, list, once, show_event, count, filters, aggregate, by, enrich, capture, from_capture, since, until, types, serve, client_buffer, slow_clients, flight_recorder, keep, max_memory, trigger, trigger_rate, output, rotate_size, rotate_interval, compress, events):
     """
     Follow any Tor events, listed as positional arguments.
     """
-    _no_json(cfg)
+    if from_capture is not None:
+        if list or aggregate is not None or capture or output or serve or flight_recorder or enrich:
+            raise click.UsageError(
+                "--from-capture can't be combined with --list, --aggregate, --enrich, --capture, --serve, --flight-recorder or --output"
+            )
+        try:
+            importlib.import_module(COMMAND_MODULES['events']).run_from_capture(
+                cfg, from_capture, since, until,
+                [e.upper() for e in types + events] or None,
+                show_event, 1 if once else count, filters,
+            )
+        except RuntimeError as e:
+            raise click.ClickException(str(e))
+        return
+    if since is not None or until is not None or types:
+        raise click.UsageError("--since, --until and --type need --from-capture")
+    if capture is not None and (output is not None or aggregate is not None):
+        raise click.UsageError("--capture can't be combined with --output or --aggregate")
+    if serve is not None and (output or capture or aggregate is not None or count is not None or once):
+        raise click.UsageError(
+            "--serve can't be combined with --output, --capture, --aggregate, --count or --once"
+        )
+    if flight_recorder is not None and (serve or output or capture or aggregate is not None or count is not None or once):
+        raise click.UsageError(
+            "--flight-recorder can't be combined with --serve, --output, --capture, --aggregate, --count or --once"
+        )
+    if trigger is not None and flight_recorder is None:
+        raise click.UsageError("--trigger needs --flight-recorder")
+    if enrich:
+        if capture or serve or flight_recorder or aggregate is not None:
+            raise click.UsageError(
+                "--enrich can't be combined with --capture, --serve, --flight-recorder or --aggregate"
+            )
+        if 'STREAM' not in (e.upper() for e in events):
+            events = events + ('STREAM',)
     if len(events) < 1 and not list:
         raise click.UsageError(
             "Must specify at least one event"
         )
+    if aggregate is not None and (count is not None or once or show_event):
+        raise click.UsageError(
+            "--aggregate can't be combined with --count, --once or --show-event"
+        )
+    if by and aggregate is None:
+        raise click.UsageError("--by needs --aggregate")
+    if output is None and (rotate_size or rotate_interval or compress != 'none'):
+        raise click.UsageError(
+            "--rotate-size, --rotate-interval and --compress need --output"
+        )
+    if compress == 'zstd':
+        try:
+            import zstandard  # noqa
+        except ImportError:
+            raise click.UsageError(
+                'You need "zstandard" installed for --compress=zstd.'
+            )
     return _run_command(
-        carml_events.run,
+        'events',
         cfg, list, once, show_event, count, events,
+        output, rotate_size, rotate_interval,
+        None if compress == 'none' else compress,
+        filters, aggregate, by, capture,
+        serve, client_buffer, slow_clients,
+        flight_recorder, keep, max_memory, trigger, trigger_rate,
+        enrich,
     )
 
 
@@ -382,10 +929,49 @@ def events(cfg, list, once, show_event, count, events):
 )
 @click.option(
     '--attach', '-a',
-    help='Attach all new streams to a particular circuit-id.',
-    type=int,
+    help='Attach all new streams to a particular circuit-id; with several (e.g. 12,15,18) or auto:N (N new circuits), to the least-loaded of them.',
+    callback=_parse_circuits,
+    metavar='CIRCUITS',
+    default=None,
+)
+@click.option(
+    '--attach-per-process',
+    help='Attach each process\'s streams to a circuit of its own (same as --isolate pid).',
+    is_flag=True,
+)
+@click.option(
+    '--attach-exit-country',
+    help='Attach new streams only to circuits exiting in one of these countries (e.g. DE,NL) through an exit that takes their port.',
+    callback=_parse_countries,
+    metavar='COUNTRIES',
+    default=None,
+)
+@click.option(
+    '--isolate',
+    help='Give streams a circuit per process, domain, port, SOCKS username or process-and-domain.',
+    type=click.Choice(['pid', 'domain', 'port', 'socks-username', 'pid-domain']),
+    default=None,
+)
+@click.option(
+    '--pool-size',
+    help='With --isolate or --attach-exit-country, how many spare circuits to keep built (default depends on the policy; 3 for --attach-exit-country).',
+    type=click.IntRange(min=1),
     default=None,
 )
+@click.option(
+    '--max-age',
+    help='With --isolate, give new streams a fresh circuit once theirs has been used this long, e.g. 10m (default depends on the policy).',
+    callback=_parse_interval,
+    metavar='INTERVAL',
+    default=None,
+)
+@click.option(
+    '--stats-interval',
+    help='With --isolate, show attach-latency statistics this often (and at exit; default 1m).',
+    callback=_parse_interval,
+    metavar='INTERVAL',
+    default='1m',
+)
 @click.option(
     '--close', '-d',
     help='Delete/close a stream by its ID.',
@@ -398,20 +984,31 @@ def events(cfg, list, once, show_event, count, events):
     is_flag=True,
 )
 @click.pass_context
-def stream(ctx, list, follow, attach, close, verbose):
+def stream(ctx, list, follow, attach, attach_per_process, attach_exit_country, isolate, pool_size, max_age, stats_interval, close, verbose):
     """
     Manipulate Tor streams.
     """
     cfg = ctx.obj
-    _no_json(cfg)
-    if len([x for x in [list, follow, attach, close] if x]) != 1:
+    if attach_per_process:
+        if isolate not in (None, 'pid'):
+            raise click.UsageError("--attach-per-process is the same as --isolate pid")
+        isolate = 'pid'
+    if len([x for x in [list, follow, attach, attach_exit_country, isolate, close] if x]) != 1:
         click.echo(ctx.get_help())
         raise click.UsageError(
-            "Must specify one of --list, --follow, --attach or --close"
+            "Must specify one of --list, --follow, --attach, --attach-exit-country, --isolate or --close"
         )
+    if isolate is None and max_age is not None:
+        raise click.UsageError("--max-age needs --isolate")
+    if isolate is None and attach_exit_country is None and pool_size is not None:
+        raise click.UsageError("--pool-size needs --isolate or --attach-exit-country")
+    if list:
+        _maybe_via_daemon('stream', cfg, list, follow, attach, close, verbose)
     return _run_command(
-        carml_stream.run,
+        'stream',
         cfg, list, follow, attach, close, verbose,
+        isolate, pool_size, max_age, stats_interval,
+        attach_exit_country,
     )
 
 
@@ -459,9 +1056,8 @@ def monitor(ctx, verbose, no_guards, no_addr, no_circuits, no_streams, once, log
     address-maps and event monitoring.
     """
     cfg = ctx.obj
-    _no_json(cfg)
     return _run_command(
-        carml_monitor.run,
+        'monitor',
         cfg, verbose, no_guards, no_addr, no_circuits, no_streams, once, log_level,
     )
 
@@ -474,9 +1070,8 @@ def newid(ctx):
     acknowledgement.
     """
     cfg = ctx.obj
-    _no_json(cfg)
     return _run_command(
-        carml_newid.run,
+        'newid',
         cfg,
     )
 
@@ -527,7 +1122,7 @@ def pastebin(ctx, dry_run, once, file, count, keys):
     cfg = ctx.obj
     _no_json(cfg)
     return _run_command(
-        carml_pastebin.run,
+        'pastebin',
         cfg, dry_run, once, file, count, keys,
     )
 
@@ -572,9 +1167,10 @@ def relay(ctx, list, info, awaiting, info_file):
         infos = [info] if info else []
 
     cfg = ctx.obj
-    _no_json(cfg)
+    if infos and not list and not awaiting:
+        _maybe_via_daemon('relay', cfg, list, infos, awaiting)
     return _run_command(
-        carml_relay.run,
+        'relay',
         cfg, list, infos, awaiting,
     )
 
@@ -629,7 +1225,7 @@ def tbb(ctx, beta, alpha, use_clearnet, system_keychain, no_extract, no_launch):
     cfg = ctx.obj
     _no_json(cfg)
     return _run_command(
-        carml_tbb.run,
+        'tbb',
         cfg, beta, alpha, use_clearnet, system_keychain, no_extract, no_launch,
     )
 
@@ -724,7 +1320,7 @@ def onion(ctx, port, onion_version, private_key, show_private_key, detach):
 
     cfg = ctx.obj
     return _run_command(
-        carml_onion.run,
+        'onion',
         cfg,
         list(validated_ports),
         onion_version,
@@ -749,8 +1345,9 @@ def tmux(ctx):
     """
     cfg = ctx.obj
     _no_json(cfg)
+    _maybe_via_daemon('tmux', cfg)
     return _run_command(
-        carml_tmux.run,
+        'tmux',
         cfg,
     )
 
@@ -790,7 +1387,7 @@ def xplanet(ctx, all, execute, follow, arc_file, file):
     cfg = ctx.obj
     _no_json(cfg)
     return _run_command(
-        carml_xplanet.run,
+        'xplanet',
         cfg, all, execute, follow, arc_file, file,
     )
 
@@ -810,7 +1407,7 @@ def copybin(ctx, service):
     """
     cfg = ctx.obj
     return _run_command(
-        carml_copybin.run,
+        'copybin',
         cfg, service,
     )
 
@@ -827,13 +1424,109 @@ def graph(ctx, max):
     A nice coloured console bandwidth-graph.
     """
     cfg = ctx.obj
-    _no_json(cfg)
     return _run_command(
-        carml_graph.run,
+        'graph',
         cfg, max,
     )
 
 
+@carml.command()
+@click.option(
+    '--socket', '-s',
+    help='UNIX socket to listen on (default is the global --daemon-socket).',
+    default=None,
+    metavar='PATH',
+)
+@click.pass_context
+def daemon(ctx, socket):
+    """
+    Keep one connection to Tor open and answer other carml commands.
+
+    While this is running, "carml tmux", "carml circ --list", "carml
+    stream --list" and "carml relay --info" are answered by the daemon
+    (from its live Tor state) instead of each connecting to Tor and
+    downloading the consensus. Use the global --no-daemon to bypass
+    it.
+    """
+    cfg = ctx.obj
+    _no_json(cfg)
+    if len(cfg.connects) > 1:
+        raise click.UsageError("A daemon talks to just one Tor; give a single --connect.")
+    return _run_command(
+        'daemon',
+        cfg, socket or cfg.daemon_socket,
+    )
+
+
+@carml.command()
+@click.option(
+    '--direction', '-D',
+    type=click.Choice(['both', 'read', 'write']),
+    default='both',
+    help='Show only data read from Tor, written to Tor or both (the default).',
+)
+@click.option(
+    '--timestamps/--no-timestamps',
+    default=True,
+    help='Show when each line was read or written.',
+)
+@click.argument(
+    'capture',
+    type=click.File('rb'),
+)
+@click.pass_context
+def protocol_dump(ctx, direction, timestamps, capture):
+    """
+    Show a file recorded with --capture-protocol.
+    """
+    cfg = ctx.obj
+    _no_json(cfg)
+    try:
+        _command_runner('protocol_dump')(cfg, capture, direction, timestamps)
+    except RuntimeError as e:
+        raise click.ClickException(str(e))
+
+
+@carml.command(
+    context_settings=dict(ignore_unknown_options=True, allow_interspersed_args=False),
+)
+@click.option(
+    '--realtime', is_flag=True,
+    help='Replay events with their original timing (default: as fast as possible).',
+)
+@click.option(
+    '--speed',
+    type=float,
+    default=1.0,
+    help='With --realtime, play back this many times faster.',
+)
+@click.argument(
+    'capture',
+    type=click.Path(exists=True, dir_okay=False),
+)
+@click.argument(
+    'command',
+    nargs=-1,
+    required=True,
+    type=click.UNPROCESSED,
+)
+@click.pass_context
+def replay(ctx, realtime, speed, capture, command):
+    """
+    Run a command against a --capture-protocol file instead of Tor.
+    """
+    cfg = ctx.obj
+    name, args = command[0], list(command[1:])
+    sub = carml.get_command(ctx.parent, name)
+    if sub is None or name in ('replay', 'protocol-dump'):
+        raise click.UsageError('Can\'t replay into "{}".'.format(name))
+    cfg.replay = capture
+    cfg.replay_realtime = realtime
+    cfg.replay_speed = speed
+    with sub.make_context(name, args, parent=ctx) as sub_ctx:
+        sub.invoke(sub_ctx)
+
+
 @carml.command()
 @click.argument(
     'what'
@@ -0,0 +1,226 @@
+'''
+On-disk snapshot of the router table, keyed by the consensus'
+valid-after time.
+
+Building a TorState means downloading "GETINFO ns/all" and parsing it
+into several thousand Router objects, every single time -- even though
+the consensus only changes once an hour. Here we save the parsed
+router records after a bootstrap and, if "GETINFO consensus/valid-after"
+says the consensus is still the same one, later runs load them back
+with one read of a memory-mapped file instead.
+'''
+import os
+import mmap
+import marshal
+
+from twisted.internet import defer
+from zope.interface import implementer
+import txtorcon
+from txtorcon.interface import ITorControlProtocol
+
+
+#: bump this if the record layout changes
+CACHE_VERSION = 1
+
+_MAGIC = b'carml-routers'
+
+
+def default_cache_dir():
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'carml')
+
+
+def _cache_path(cache_dir):
+    return os.path.join(cache_dir, 'routers-v{}.snapshot'.format(CACHE_VERSION))
+
+
+def _record_from_kw(kw):
+    """
+    Turns the keyword-args that txtorcon's network-status parser gives
+    to TorState._create_router() into a (marshal-able) tuple.
+    """
+    return (
+        kw['nickname'], kw['idhash'], kw['orhash'], kw['modified'],
+        kw['ip'], kw['orport'], kw['dirport'],
+        kw.get('flags', []), kw.get('bandwidth', None), kw.get('ip_v6', None),
+    )
+
+
+def _kw_from_record(record):
+    (nickname, idhash, orhash, modified, ip, orport, dirport, flags, bandwidth, ip_v6) = record
+    kw = dict(
+        nickname=nickname, idhash=idhash, orhash=orhash, modified=modified,
+        ip=ip, orport=orport, dirport=dirport, flags=flags,
+    )
+    if bandwidth is not None:
+        kw['bandwidth'] = bandwidth
+    if ip_v6 is not None:
+        kw['ip_v6'] = ip_v6
+    return kw
+
+
+def load_routers(path, valid_after):
+    """
+    :returns: the list of router records saved in `path` if they are
+        from the consensus with the given `valid_after` time, otherwise
+        None.
+    """
+    try:
+        with open(path, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (IOError, OSError, ValueError):
+        # ValueError is mmap() of an empty file
+        return None
+    try:
+        header = mapped.readline().split()
+        if len(header) != 2 or header[0] != _MAGIC:
+            return None
+        if header[1].decode('ascii') != valid_after.replace(' ', 'T'):
+            return None
+        return marshal.loads(memoryview(mapped)[mapped.tell():])
+    except (ValueError, EOFError, TypeError):
+        return None
+    finally:
+        mapped.close()
+
+
+def save_routers(path, valid_after, records):
+    """
+    Atomically replace the snapshot in `path` with `records`.
+    """
+    directory = os.path.dirname(path)
+    if not os.path.exists(directory):
+        os.makedirs(directory, mode=0o700)
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(_MAGIC + b' ' + valid_after.replace(' ', 'T').encode('ascii') + b'\n')
+        f.write(marshal.dumps(records))
+    os.replace(tmp, path)
+
+
+@implementer(ITorControlProtocol)
+class _ConsensusFromSnapshot(object):
+    """
+    Wraps a TorControlProtocol for a TorState so that its bootstrap's
+    "GETINFO ns/all" is answered from our snapshot instead of by Tor.
+    Everything else goes to the real protocol.
+    """
+
+    def __init__(self, protocol, create_router, records):
+        self._protocol = protocol
+        self._create_router = create_router
+        self._records = records
+
+    def __getattr__(self, name):
+        return getattr(self._protocol, name)
+
+    def get_info_incremental(self, key, line_cb):
+        if key == 'ns/all' and self._records is not None:
+            records, self._records = self._records, None
+            for record in records:
+                self._create_router(**_kw_from_record(record))
+            return defer.succeed('')
+        return self._protocol.get_info_incremental(key, line_cb)
+
+
+class _SharedRecords(object):
+    """
+    The router records for one consensus, once someone in this
+    process has them.
+    """
+
+    def __init__(self):
+        self.records = None
+        self._waiting = []
+
+    def when_ready(self):
+        if self.records is not None:
+            return defer.succeed(self.records)
+        d = defer.Deferred()
+        self._waiting.append(d)
+        return d
+
+    def ready(self, records):
+        """
+        :param records: the router records, or None if getting them
+            failed (so each waiter should download its own).
+        """
+        self.records = records
+        waiting, self._waiting = self._waiting, []
+        for d in waiting:
+            d.callback(records)
+
+
+#: valid-after -> _SharedRecords; so that connections to several Tors
+#: (see "--connect" given more than once) that have the same consensus
+#: only download and parse it once between them
+_shared = {}
+
+
+class SnapshotTorState(txtorcon.TorState):
+    """
+    A TorState that loads its routers from `records` (if not None) or
+    otherwise remembers the records it parsed during bootstrap, in
+    `.parsed_records`, so they can be saved.
+    """
+
+    def __init__(self, protocol, records):
+        self.parsed_records = [] if records is None else None
+        proxy = _ConsensusFromSnapshot(protocol, self._create_router, records)
+        super(SnapshotTorState, self).__init__(proxy, bootstrap=True)
+
+    def _create_router(self, **kw):
+        if self.parsed_records is not None:
+            self.parsed_records.append(_record_from_kw(kw))
+        return super(SnapshotTorState, self)._create_router(**kw)
+
+
+async def create_state(tor, cache_dir=None, use_disk=True):
+    """
+    Like txtorcon.Tor.create_state() except that the router table
+    comes from our snapshot when the consensus hasn't changed since
+    it was saved (and we save one when it has).
+
+    Within one process, states for the same consensus also share the
+    router records; with `use_disk=False` that's all we do.
+    """
+    try:
+        info = await tor.protocol.get_info('consensus/valid-after')
+        valid_after = info['consensus/valid-after']
+    except (txtorcon.TorProtocolError, KeyError):
+        # older Tor, or no consensus yet: nothing to key a snapshot on
+        state = txtorcon.TorState(tor.protocol)
+        return await state.post_bootstrap
+
+    shared = _shared.get(valid_after)
+    if shared is not None:
+        # another connection has (or is getting) this consensus
+        records = await shared.when_ready()
+        state = SnapshotTorState(tor.protocol, records)
+        await state.post_bootstrap
+        state.parsed_records = None
+        return state
+
+    shared = _shared[valid_after] = _SharedRecords()
+    path = _cache_path(cache_dir or default_cache_dir())
+    records = load_routers(path, valid_after) if use_disk else None
+    if records is not None:
+        shared.ready(records)
+    state = SnapshotTorState(tor.protocol, records)
+    try:
+        await state.post_bootstrap
+    except Exception:
+        if shared.records is None:
+            del _shared[valid_after]
+            shared.ready(None)
+        raise
+    if state.parsed_records is not None:
+        records, state.parsed_records = state.parsed_records, None
+        shared.ready(records)
+        if use_disk:
+            try:
+                save_routers(path, valid_after, records)
+            except (IOError, OSError):
+                # a read-only home directory shouldn't stop anything
+                pass
+    return state
@@ -0,0 +1,89 @@
+'''
+Client side of "carml daemon".
+
+This is deliberately plain blocking-socket code with no Twisted
+imports, so that short-lived invocations like "carml tmux" can get an
+answer from a running daemon without starting a reactor or connecting
+to Tor at all.
+'''
+import os
+import json
+import stat
+import socket
+import tempfile
+
+
+def default_socket_path():
+    """
+    Where "carml daemon" listens if not told otherwise.
+    """
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir:
+        return os.path.join(runtime_dir, 'carml-{}.sock'.format(os.getuid()))
+    # anyone can create files in the temp directory, so the socket
+    # goes in a directory of our own there
+    return os.path.join(private_dir(), 'carml.sock')
+
+
+def private_dir():
+    """
+    The directory (only we may use) for the socket when there's no
+    $XDG_RUNTIME_DIR.
+    """
+    return os.path.join(tempfile.gettempdir(), 'carml-{}'.format(os.getuid()))
+
+
+def is_ours(path):
+    """
+    :returns: True if `path` is a UNIX socket owned by us (so that
+        another user can't answer our requests).
+    """
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+    return stat.S_ISSOCK(st.st_mode) and st.st_uid == os.getuid()
+
+
+def query_daemon(path, command, args, connect=None, options=None, timeout=30.0):
+    """
+    Ask the daemon listening on `path` to run `command` with the
+    (JSON-able) `args`.
+
+    :returns: None if there's no daemon (or it declined to answer),
+        otherwise a dict with "output" (the text the command printed)
+        and "error" (None, or a message).
+    """
+    if not is_ours(path):
+        return None
+    request = {
+        'command': command,
+        'args': list(args),
+        'connect': connect,
+        'options': options or {},
+    }
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path)
+        sock.sendall(json.dumps(request).encode('utf8') + b'\n')
+        chunks = []
+        while True:
+            data = sock.recv(65536)
+            if not data:
+                break
+            chunks.append(data)
+    except (socket.error, socket.timeout):
+        # stale socket-file, or the daemon is wedged; the caller
+        # should just talk to Tor itself
+        return None
+    finally:
+        sock.close()
+
+    try:
+        reply = json.loads(b''.join(chunks).decode('utf8'))
+    except ValueError:
+        return None
+    if reply.get('declined', False):
+        return None
+    return reply
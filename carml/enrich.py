@@ -0,0 +1,200 @@
+'''
+Adding context to STREAM events ("events --enrich").
+
+A STREAM event only says which circuit a stream is on and where it's
+going; to know the path, exit country or which program made the stream
+you'd otherwise have to join it up with CIRC and ADDRMAP events
+afterwards. StreamEnricher follows circuits and streams through
+TorState's listeners and keeps just enough about each live one to
+describe it, forgetting it as soon as it closes. Anything still
+remembered that TorState no longer knows about (e.g. because a close
+went missing) is swept away every so often, so memory stays bounded by
+how many circuits and streams are open, however long we run.
+'''
+import txtorcon
+from twisted.internet import task
+
+from carml.eventparse import StreamEvent
+from carml.procindex import process_from_address, executable
+
+
+def lookup_process(stream, state):
+    """
+    :returns: the PID of the program that opened `stream` (or None).
+    """
+    if stream.source_addr == '(Tor_internal)':
+        return None
+    return process_from_address(stream.source_addr, stream.source_port, state)
+
+
+class _Circuit(object):
+    __slots__ = ('path', 'exit_router')
+
+    def __init__(self, circuit):
+        self.path = [router.name for router in circuit.path]
+        self.exit_router = circuit.path[-1] if circuit.path else None
+
+    @property
+    def exit_country(self):
+        if self.exit_router is None:
+            return None
+        # this looks it up (from Tor) the first time, so the first
+        # stream on a circuit may not get it
+        return self.exit_router.location.countrycode
+
+
+class _Stream(object):
+    __slots__ = ('stream', 'circuit', 'pid', 'process')
+
+    def __init__(self, stream):
+        self.stream = stream
+        #: the _Circuit it's on (we still need it after CLOSED, when
+        #: txtorcon has forgotten)
+        self.circuit = None
+        self.pid = None
+        self.process = None
+
+
+class StreamEnricher(txtorcon.StreamListenerMixin, txtorcon.CircuitListenerMixin):
+    """
+    Add this as a stream and circuit listener to `state`, and call
+    enrich() with the text of each STREAM event *after* TorState has
+    seen it (i.e. from an event listener added after create_state()).
+
+    :param sweep_interval: seconds between checks for things TorState
+        has forgotten but we haven't.
+    """
+
+    def __init__(self, state, reactor=None, sweep_interval=60.0, lookup_process=lookup_process):
+        self._state = state
+        self._lookup_process = lookup_process
+        #: circuit id -> _Circuit
+        self._circuits = {}
+        #: stream id -> _Stream
+        self._streams = {}
+        self._loop = None
+        if reactor is not None:
+            self._loop = task.LoopingCall(self.sweep)
+            self._loop.clock = reactor
+        self._sweep_interval = sweep_interval
+
+    def start(self):
+        self._state.add_circuit_listener(self)
+        self._state.add_stream_listener(self)
+        for stream in self._state.streams.values():
+            self._stream(stream)
+            if stream.circuit is not None:
+                self.stream_attach(stream, stream.circuit)
+        if self._loop is not None:
+            self._loop.start(self._sweep_interval, now=False)
+
+    def stop(self):
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
+
+    def _circuit(self, circuit):
+        try:
+            return self._circuits[circuit.id]
+        except KeyError:
+            info = self._circuits[circuit.id] = _Circuit(circuit)
+            return info
+
+    def _stream(self, stream):
+        try:
+            return self._streams[stream.id]
+        except KeyError:
+            info = self._streams[stream.id] = _Stream(stream)
+            # now, while the program still has the connection open
+            info.pid = self._lookup_process(stream, self._state)
+            if info.pid:
+                info.process = executable(info.pid)
+            return info
+
+    # IStreamListener
+
+    def stream_new(self, stream):
+        self._stream(stream)
+
+    def stream_attach(self, stream, circuit):
+        self._stream(stream).circuit = self._circuit(circuit)
+
+    def stream_detach(self, stream, **kw):
+        self._stream(stream).circuit = None
+
+    # ICircuitListener
+
+    def circuit_extend(self, circuit, router):
+        # the path changed
+        self._circuits.pop(circuit.id, None)
+
+    def circuit_built(self, circuit):
+        self._circuits.pop(circuit.id, None)
+
+    def circuit_closed(self, circuit, **kw):
+        # streams on it keep their own reference until they close
+        self._circuits.pop(circuit.id, None)
+
+    def circuit_failed(self, circuit, **kw):
+        self._circuits.pop(circuit.id, None)
+
+    def enrich(self, text):
+        """
+        :returns: a dict of what we know about the stream in STREAM
+            event `text` (an empty one if we don't know the stream).
+        """
+        event = StreamEvent(text)
+        if event.status in ('CLOSED', 'FAILED'):
+            info = self._streams.pop(event.id, None)
+        else:
+            info = self._streams.get(event.id)
+            if info is None:
+                stream = self._state.streams.get(event.id)
+                if stream is None:
+                    return {}
+                info = self._stream(stream)
+        if info is None:
+            return {}
+        stream = info.stream
+        extra = {}
+        if info.circuit is not None:
+            extra['circuit_path'] = info.circuit.path
+            extra['exit_country'] = info.circuit.exit_country
+        if info.pid is not None:
+            extra['pid'] = info.pid
+            extra['process'] = info.process
+        resolved = stream.target_addr
+        if resolved is None:
+            try:
+                resolved = self._state.addrmap.find(stream.target_host).ip
+            except (KeyError, AttributeError):
+                pass
+        if resolved is not None:
+            extra['resolved'] = str(resolved)
+        return extra
+
+    def sweep(self):
+        """
+        Forget anything TorState doesn't know about any more.
+        """
+        for stream_id in [s for s in self._streams if s not in self._state.streams]:
+            del self._streams[stream_id]
+        for circuit_id in [c for c in self._circuits if c not in self._state.circuits]:
+            del self._circuits[circuit_id]
+
+
+def format_extra(extra):
+    """
+    :returns: what enrich() found, as keyword arguments to go after
+        the rest of the event.
+    """
+    parts = []
+    if 'circuit_path' in extra:
+        parts.append('CIRC_PATH={}'.format(','.join(extra['circuit_path'])))
+        parts.append('EXIT_COUNTRY={}'.format(extra['exit_country'] or '??'))
+    if 'pid' in extra:
+        parts.append('PID={}'.format(extra['pid']))
+        if extra['process']:
+            parts.append('PROCESS={}'.format(extra['process']))
+    if 'resolved' in extra:
+        parts.append('RESOLVED={}'.format(extra['resolved']))
+    return ' '.join(parts)
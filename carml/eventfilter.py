@@ -0,0 +1,179 @@
+'''
+Filters for "carml events --filter".
+
+Each filter expression is compiled (once) into a regular expression
+that's searched for in the raw event text Tor sent, so deciding to
+drop an event costs one or two regex searches and no parsing or
+formatting. The expressions are:
+
+``KEY=VALUE``, ``KEY!=VALUE``
+    the event has (or doesn't have) the keyword argument KEY=VALUE,
+    e.g. ``PURPOSE=HS_SERVICE_REND``
+
+``KEY in (A,B)``, ``KEY not in (A,B)``
+    KEY has (or doesn't have) one of the values
+
+``KEY~REGEX``
+    KEY's value matches the regular expression
+
+``/REGEX/``
+    the event text matches the regular expression anywhere
+
+There are three special keys: ``EVENT`` is the event's name (e.g.
+``CIRC``), ``ID`` its first word (the circuit or stream ID for CIRC
+and STREAM) and ``STATUS`` its second word (the status for CIRC,
+STREAM, ORCONN, ...). Several filters must all match.
+'''
+import re
+
+
+class FilterError(ValueError):
+    pass
+
+
+# "KEY in (A, B)" / "KEY not in (A, B)"
+_membership = re.compile(r'^\s*(\w+)\s+(not\s+)?in\s*\((.*)\)\s*$', re.IGNORECASE)
+# KEY=VALUE, KEY!=VALUE, KEY~REGEX
+_comparison = re.compile(r'^\s*(\w+)\s*(!=|=|~)\s*(.*?)\s*$')
+
+_VALUE_END = r'(?= |$)'
+
+
+def _value_regex(key, value_regex, quoted_regex=None):
+    """
+    :returns: the text of a regex matching an event whose `key` has a
+        value matching `value_regex` (which must match all of it), or
+        `quoted_regex` if the value is in quotes.
+    """
+    if quoted_regex is None:
+        quoted_regex = value_regex
+    if key == 'ID':
+        return r'^(?:' + value_regex + r')' + _VALUE_END
+    if key == 'STATUS':
+        return r'^\S+ (?:' + value_regex + r')' + _VALUE_END
+    # keyword arguments come after the positional ones, but may be
+    # quoted
+    quoted = r'"(?:' + quoted_regex + r')"'
+    bare = r'(?:' + value_regex + r')'
+    return r'(?:^| )' + re.escape(key) + r'=(?:' + quoted + r'|' + bare + r')' + _VALUE_END
+
+
+class _Predicate(object):
+    __slots__ = ('search', 'negate', 'on_event')
+
+    def __init__(self, search, negate=False, on_event=False):
+        #: a compiled regex's search method
+        self.search = search
+        self.negate = negate
+        #: if True we search the event name, not its text
+        self.on_event = on_event
+
+    def __call__(self, event, text):
+        matched = self.search(event if self.on_event else text) is not None
+        return matched != self.negate
+
+
+class _ValuePredicate(object):
+    """
+    For KEY~REGEX: finds KEY's value and then searches it for REGEX
+    (so that ^ and $ work).
+    """
+    __slots__ = ('find', 'search')
+
+    def __init__(self, find, search):
+        self.find = find
+        self.search = search
+
+    def __call__(self, event, text):
+        value = self.find(text)
+        return value is not None and self.search(value) is not None
+
+
+def _values(text):
+    return [v.strip().strip('"') for v in text.split(',') if v.strip()]
+
+
+def _compile(regex, expression):
+    try:
+        return re.compile(regex).search
+    except re.error as e:
+        raise FilterError('bad regular expression in "{}": {}'.format(expression, e))
+
+
+def compile_filter(expression):
+    """
+    :returns: a callable taking (event-name, event-text) and returning
+        True if `expression` matches.
+
+    :raises FilterError: if `expression` isn't valid.
+    """
+    expr = expression.strip()
+    if len(expr) >= 2 and expr.startswith('/') and expr.endswith('/'):
+        return _Predicate(_compile(expr[1:-1], expression))
+
+    match = _membership.match(expr)
+    if match:
+        key, negate, values = match.group(1).upper(), bool(match.group(2)), _values(match.group(3))
+        if not values:
+            raise FilterError('no values in "{}"'.format(expression))
+        pattern = '|'.join(re.escape(v) for v in values)
+        if key == 'EVENT':
+            return _Predicate(_compile('^(?:' + pattern.upper() + ')$', expression), negate, on_event=True)
+        return _Predicate(_compile(_value_regex(key, pattern), expression), negate)
+
+    match = _comparison.match(expr)
+    if match:
+        key, op, value = match.group(1).upper(), match.group(2), match.group(3)
+        negate = op == '!='
+        if op == '~':
+            search = _compile(value, expression)
+            if key == 'EVENT':
+                return _Predicate(search, on_event=True)
+            return _ValuePredicate(keyword_finder(key), search)
+        value = re.escape(value.strip('"'))
+        if key == 'EVENT':
+            return _Predicate(_compile('^' + value.upper() + '$', expression), negate, on_event=True)
+        return _Predicate(_compile(_value_regex(key, value), expression), negate)
+
+    raise FilterError(
+        'don\'t understand "{}"; try KEY=VALUE, KEY!=VALUE, KEY~REGEX, '
+        '"KEY in (A,B)" or /REGEX/'.format(expression)
+    )
+
+
+def keyword_finder(key):
+    """
+    :returns: a callable taking an event's text and returning the value
+        of `key` in it (one of the keyword arguments, or the special
+        ID or STATUS), or None if there isn't one.
+    """
+    find = re.compile(_value_regex(key.upper(), r'([^ "]*)', r'([^"]*)')).search
+
+    def value(text):
+        found = find(text)
+        if found is None:
+            return None
+        if found.group(1) is not None:
+            return found.group(1)
+        return found.group(2)
+    return value
+
+
+def compile_filters(expressions):
+    """
+    :returns: a callable taking (event-name, event-text) and returning
+        True if all of `expressions` match, or None if there aren't
+        any.
+    """
+    predicates = [compile_filter(e) for e in expressions]
+    if not predicates:
+        return None
+    if len(predicates) == 1:
+        return predicates[0]
+
+    def matches(event, text):
+        for predicate in predicates:
+            if not predicate(event, text):
+                return False
+        return True
+    return matches
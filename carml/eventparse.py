@@ -0,0 +1,266 @@
+'''
+Decoding the text of Tor's events into typed records.
+
+Listeners get each event as one string, like ``"12 BUILT
+$AB..~name,... PURPOSE=GENERAL ..."`` for CIRC. Rather than have every
+listener split that up its own way, parse() turns it into a small
+__slots__ object with the positional fields already converted. Only as
+much of the string as those fields need is split; the keyword
+arguments after them (PURPOSE=..., REASON=..., ...) are left as one
+string until something asks for one.
+'''
+
+
+class Event(object):
+    """
+    Any event: just the keyword arguments.
+
+    :ivar text: the whole event, as Tor sent it (minus "650 NAME ").
+    """
+    __slots__ = ('text', '_rest', '_keywords')
+
+    def __init__(self, text, rest=None):
+        self.text = text
+        # the part that may have keyword arguments
+        self._rest = text if rest is None else rest
+        self._keywords = None
+
+    @property
+    def keywords(self):
+        """
+        dict of the event's KEY=VALUE arguments (decoded the first time
+        it's used).
+        """
+        if self._keywords is None:
+            self._keywords = parse_keywords(self._rest)
+        return self._keywords
+
+    def get(self, key, default=None):
+        """
+        :returns: the value of keyword argument `key`, without decoding
+            any of the others (if we haven't already).
+        """
+        if self._keywords is not None:
+            return self._keywords.get(key, default)
+        rest = self._rest
+        if '"' in rest:
+            return self.keywords.get(key, default)
+        prefix = key + '='
+        start = rest.find(prefix)
+        # must be a whole word (e.g. not the "ID=" in "CIRC_ID=")
+        while start > 0 and rest[start - 1] != ' ':
+            start = rest.find(prefix, start + 1)
+        if start == -1:
+            return default
+        start += len(prefix)
+        end = rest.find(' ', start)
+        return rest[start:] if end == -1 else rest[start:end]
+
+    def __repr__(self):
+        return '<{} {}>'.format(self.__class__.__name__, self.text)
+
+
+class CircEvent(Event):
+    """
+    650 CIRC CircuitID CircStatus [Path] [KEY=VALUE ...]
+    """
+    __slots__ = ('id', 'status', '_path')
+
+    def __init__(self, text):
+        parts = text.split(' ', 3)
+        self.id = int(parts[0])
+        self.status = parts[1]
+        path = None
+        rest = ''
+        if len(parts) > 2:
+            if '=' in parts[2] and not parts[2].startswith('$'):
+                # no path; that's the first keyword
+                rest = text.split(' ', 2)[2]
+            else:
+                path = parts[2]
+                rest = parts[3] if len(parts) > 3 else ''
+        self._path = path
+        self.text = text
+        self._rest = rest
+        self._keywords = None
+
+    @property
+    def path(self):
+        """
+        list of (fingerprint, nickname-or-None) for each hop.
+        """
+        if not self._path:
+            return []
+        hops = []
+        for hop in self._path.split(','):
+            fingerprint, _, name = hop.partition('~')
+            if not name and '=' in fingerprint:
+                fingerprint, _, name = fingerprint.partition('=')
+            hops.append((fingerprint, name or None))
+        return hops
+
+    @property
+    def purpose(self):
+        return self.get('PURPOSE')
+
+    @property
+    def reason(self):
+        return self.get('REASON')
+
+
+class StreamEvent(Event):
+    """
+    650 STREAM StreamID StreamStatus CircuitID Target [KEY=VALUE ...]
+    """
+    __slots__ = ('id', 'status')
+
+    def __init__(self, text):
+        parts = text.split(' ', 2)
+        self.id = int(parts[0])
+        self.status = parts[1]
+        self.text = text
+        # the circuit and target are only split out if asked for; they
+        # don't look like keywords, so can stay in with them
+        self._rest = parts[2]
+        self._keywords = None
+
+    @property
+    def circuit_id(self):
+        return int(self._rest.split(' ', 1)[0])
+
+    @property
+    def target(self):
+        return self._rest.split(' ', 2)[1]
+
+    @property
+    def target_host(self):
+        return self.target.rpartition(':')[0]
+
+    @property
+    def target_port(self):
+        return int(self.target.rpartition(':')[2])
+
+    @property
+    def reason(self):
+        return self.get('REASON')
+
+
+class BwEvent(Event):
+    """
+    650 BW BytesRead BytesWritten [...]
+    """
+    __slots__ = ('read', 'written')
+
+    def __init__(self, text):
+        parts = text.split(' ', 2)
+        self.read = int(parts[0])
+        self.written = int(parts[1])
+        self.text = text
+        self._rest = parts[2] if len(parts) > 2 else ''
+        self._keywords = None
+
+
+class StreamBwEvent(Event):
+    """
+    650 STREAM_BW StreamID BytesWritten BytesRead [Time]
+    """
+    __slots__ = ('stream_id', 'written', 'read')
+
+    def __init__(self, text):
+        parts = text.split(' ', 3)
+        self.stream_id = int(parts[0])
+        self.written = int(parts[1])
+        self.read = int(parts[2])
+        self.text = text
+        self._rest = parts[3] if len(parts) > 3 else ''
+        self._keywords = None
+
+
+class CircBwEvent(Event):
+    """
+    650 CIRC_BW ID=CircuitID READ=BytesRead WRITTEN=BytesWritten [...]
+    (and CONN_BW, which looks the same)
+    """
+    __slots__ = ()
+
+    @property
+    def id(self):
+        return int(self.get('ID'))
+
+    @property
+    def read(self):
+        return int(self.get('READ', 0))
+
+    @property
+    def written(self):
+        return int(self.get('WRITTEN', 0))
+
+
+#: event name -> class that decodes it
+EVENT_TYPES = {
+    'CIRC': CircEvent,
+    'STREAM': StreamEvent,
+    'BW': BwEvent,
+    'STREAM_BW': StreamBwEvent,
+    'CIRC_BW': CircBwEvent,
+    'CONN_BW': CircBwEvent,
+}
+
+
+def parse(name, text):
+    """
+    :returns: an Event (or the subclass for event `name`) for `text`.
+
+    :raises ValueError: if `text` isn't a valid event of that type.
+    """
+    try:
+        return EVENT_TYPES.get(name, Event)(text)
+    except (IndexError, ValueError):
+        raise ValueError('Not a {} event: "{}"'.format(name, text))
+
+
+def parse_keywords(text):
+    """
+    :returns: a dict of the KEY=VALUE arguments in `text` (VALUE may
+        be in quotes, with backslash-escapes). Words without an "="
+        are ignored.
+    """
+    keywords = {}
+    if '"' not in text:
+        # the usual case
+        for word in text.split():
+            key, eq, value = word.partition('=')
+            if eq:
+                keywords[key] = value
+        return keywords
+
+    pos = 0
+    end = len(text)
+    while pos < end:
+        while pos < end and text[pos] == ' ':
+            pos += 1
+        eq = text.find('=', pos)
+        space = text.find(' ', pos)
+        if eq == -1 or (space != -1 and space < eq):
+            # a word without "="
+            pos = end if space == -1 else space
+            continue
+        key = text[pos:eq]
+        pos = eq + 1
+        if pos < end and text[pos] == '"':
+            value = []
+            pos += 1
+            while pos < end and text[pos] != '"':
+                if text[pos] == '\\' and pos + 1 < end:
+                    pos += 1
+                value.append(text[pos])
+                pos += 1
+            keywords[key] = ''.join(value)
+            pos += 1
+        else:
+            space = text.find(' ', pos)
+            if space == -1:
+                space = end
+            keywords[key] = text[pos:space]
+            pos = space
+    return keywords
@@ -0,0 +1,151 @@
+'''
+Serving events to local clients ("events --serve").
+
+We subscribe to Tor's events once and pass each one on to every
+connected client, so several tools can follow events for the price of
+one control-connection subscription. Each event is formatted once, no
+matter how many clients get it.
+
+Clients may send filter expressions (the same ones as "events
+--filter"), one per line, at any time; they then only get events
+matching all of them.
+
+Every client has a bounded buffer: when its connection is backed up,
+events are queued up to that size. After that, a slow client is either
+disconnected ("drop") or misses events until it catches up, after
+which it is told how many it missed ("sample"). Either way the reactor
+-- and our reading of the control connection -- never waits for a
+client.
+'''
+import collections
+
+import zope.interface
+from twisted.internet.interfaces import IPushProducer
+from twisted.internet.protocol import Factory
+from twisted.protocols.basic import LineOnlyReceiver
+
+from carml import ndjson
+from carml.eventfilter import compile_filter, FilterError
+
+
+@zope.interface.implementer(IPushProducer)
+class EventClient(LineOnlyReceiver):
+    delimiter = b'\n'
+
+    def connectionMade(self):
+        self._filters = []
+        self._paused = False
+        self._queue = collections.deque()
+        self._queued = 0
+        self.dropped = 0
+        # Twisted tells us (pauseProducing) when the connection's
+        # buffer is full, instead of buffering without limit
+        self.transport.registerProducer(self, True)
+        self.factory.client_connected(self)
+
+    def connectionLost(self, reason):
+        self.factory.client_disconnected(self)
+
+    def lineReceived(self, line):
+        expression = line.decode('utf8', 'replace').strip()
+        if not expression:
+            return
+        try:
+            self._filters.append(compile_filter(expression))
+        except FilterError as e:
+            self.transport.write(self.factory.format_error(str(e)))
+
+    def send(self, event, text, data):
+        """
+        Pass on one event: `data` is the already-formatted version of
+        (`event`, `text`).
+        """
+        for matches in self._filters:
+            if not matches(event, text):
+                return
+        if not self._paused:
+            self.transport.write(data)
+            return
+        if self._queued + len(data) > self.factory.max_buffer:
+            if self.factory.slow_clients == 'drop':
+                self.factory.client_too_slow(self)
+                self.transport.abortConnection()
+            else:
+                self.dropped += 1
+            return
+        self._queue.append(data)
+        self._queued += len(data)
+
+    # IPushProducer
+
+    def pauseProducing(self):
+        self._paused = True
+
+    def resumeProducing(self):
+        self._paused = False
+        # writing may pause us again
+        while self._queue and not self._paused:
+            data = self._queue.popleft()
+            self._queued -= len(data)
+            self.transport.write(data)
+        if self.dropped and not self._paused:
+            self.transport.write(self.factory.format_dropped(self.dropped))
+            self.dropped = 0
+
+    def stopProducing(self):
+        self._queue.clear()
+        self._queued = 0
+
+
+class EventFanout(Factory):
+    """
+    Keeps track of the connected clients, and sends them each event().
+
+    :param max_buffer: bytes we'll queue for a client whose connection
+        is backed up.
+
+    :param slow_clients: "drop" (disconnect) or "sample" (skip
+        events for) clients whose buffer is full.
+    """
+    protocol = EventClient
+
+    def __init__(self, json=False, max_buffer=1024 * 1024, slow_clients='drop', log=None):
+        self.clients = set()
+        self.json = json
+        self.max_buffer = max_buffer
+        self.slow_clients = slow_clients
+        self._log = log or (lambda msg: None)
+
+    def event(self, event, text, when):
+        if not self.clients:
+            return
+        if self.json:
+            data = ndjson.line({'type': 'event', 'event': event, 'time': when, 'data': text})
+        else:
+            data = '{}: {}\n'.format(event, text)
+        data = data.encode('utf8')
+        for client in list(self.clients):
+            client.send(event, text, data)
+
+    def format_error(self, message):
+        if self.json:
+            return ndjson.line({'type': 'error', 'message': message}).encode('utf8')
+        return 'error: {}\n'.format(message).encode('utf8')
+
+    def format_dropped(self, count):
+        if self.json:
+            return ndjson.line({'type': 'dropped', 'count': count}).encode('utf8')
+        return 'dropped: {} events\n'.format(count).encode('utf8')
+
+    def client_connected(self, client):
+        self.clients.add(client)
+        self._log("Client connected ({} now).".format(len(self.clients)))
+
+    def client_disconnected(self, client):
+        self.clients.discard(client)
+        self._log("Client disconnected ({} now).".format(len(self.clients)))
+
+    def client_too_slow(self, client):
+        # no more events for it, while the disconnect happens
+        self.clients.discard(client)
+        self._log("Dropping a client that can't keep up.")
@@ -0,0 +1,259 @@
+'''
+Indexed, compressed captures of events ("events --capture"), which
+can be queried by time and event type ("events --from-capture").
+
+A capture is a header followed by chunks. Each chunk holds a few
+hundred KiB of events, zlib-compressed, behind a small uncompressed
+header saying how many events it has, the first and last timestamp
+and which event types are in it. When the capture is closed we append
+an index of all the chunk headers, so a reader can load the index in
+one read and then seek straight to the chunks covering the times and
+types it wants. If the writer crashed before writing the index, the
+reader instead hops from chunk header to chunk header (still without
+decompressing anything it doesn't need).
+'''
+import time
+import zlib
+import struct
+import datetime
+
+
+MAGIC = b'carml-events 1\n'
+
+#: chunk header: marker, compressed size, events, size of the types
+#: list, first timestamp, last timestamp; followed by the types list
+#: (space-separated names) and then the compressed events
+CHUNK = struct.Struct('<4sIIIdd')
+CHUNK_MARKER = b'EVCH'
+
+#: each event (inside the compressed part): timestamp, index of its
+#: type in the chunk's types list, length of the text; then the text
+EVENT = struct.Struct('<dBI')
+
+#: index entry: offset of the chunk header, then the same as a chunk
+#: header (minus the marker), then the types list
+INDEX_ENTRY = struct.Struct('<QIIIdd')
+
+#: the very end of a closed capture: marker, offset of the index
+TRAILER = struct.Struct('<4sQ')
+TRAILER_MARKER = b'EVIX'
+
+
+class Chunk(object):
+    __slots__ = ('offset', 'size', 'count', 'types', 'first', 'last')
+
+    def __init__(self, offset, size, count, types, first, last):
+        #: where the chunk header starts
+        self.offset = offset
+        #: size of the compressed events
+        self.size = size
+        self.count = count
+        #: list of the event names in this chunk
+        self.types = types
+        self.first = first
+        self.last = last
+
+    def wanted(self, since, until, types):
+        if since is not None and self.last < since:
+            return False
+        if until is not None and self.first > until:
+            return False
+        if types is not None and types.isdisjoint(self.types):
+            return False
+        return True
+
+
+class EventCaptureWriter(object):
+    """
+    Writes events to the (binary) file `f`.
+
+    :param chunk_size: start a new chunk once this many bytes of
+        events (before compression) are waiting.
+
+    :param reactor: if not None, we also write out a chunk every
+        `flush_interval` seconds, so a crash loses at most that much.
+    """
+
+    def __init__(self, f, chunk_size=256 * 1024, reactor=None, flush_interval=10.0):
+        self._f = f
+        self._chunk_size = chunk_size
+        self._index = []
+        self._loop = None
+        self._reset()
+        f.write(MAGIC)
+        self._offset = len(MAGIC)
+        if reactor is not None:
+            from twisted.internet import task
+            self._loop = task.LoopingCall(self.flush)
+            self._loop.clock = reactor
+            self._loop.start(flush_interval, now=False)
+            # e.g. SIGINT or SIGTERM stop the reactor without our
+            # caller getting a chance to close() us
+            reactor.addSystemEventTrigger('before', 'shutdown', self.close)
+
+    def _reset(self):
+        self._buffer = bytearray()
+        self._types = {}
+        self._count = 0
+        self._first = None
+        self._last = None
+
+    def record(self, event, text, when=None):
+        if when is None:
+            when = time.time()
+        try:
+            type_index = self._types[event]
+        except KeyError:
+            if len(self._types) > 255:
+                # there's only a byte for it; start a new chunk
+                self.flush()
+            type_index = self._types[event] = len(self._types)
+        data = text.encode('utf8')
+        self._buffer += EVENT.pack(when, type_index, len(data))
+        self._buffer += data
+        if self._first is None:
+            self._first = when
+        self._last = when
+        self._count += 1
+        if len(self._buffer) >= self._chunk_size:
+            self.flush()
+
+    def flush(self):
+        if not self._count:
+            return
+        payload = zlib.compress(bytes(self._buffer), 6)
+        types = ' '.join(sorted(self._types, key=self._types.get)).encode('ascii')
+        header = CHUNK.pack(CHUNK_MARKER, len(payload), self._count, len(types), self._first, self._last)
+        self._f.write(header + types + payload)
+        self._f.flush()
+        self._index.append(INDEX_ENTRY.pack(
+            self._offset, len(payload), self._count, len(types), self._first, self._last,
+        ) + types)
+        self._offset += len(header) + len(types) + len(payload)
+        self._reset()
+
+    def close(self):
+        if self._f.closed:
+            return
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
+        self.flush()
+        self._f.write(b''.join(self._index))
+        self._f.write(TRAILER.pack(TRAILER_MARKER, self._offset))
+        self._f.close()
+
+
+class EventCapture(object):
+    """
+    Reads a capture from the (binary, seekable) file `f`.
+
+    :ivar chunks: list of Chunk instances, in order.
+    """
+
+    def __init__(self, f):
+        self._f = f
+        f.seek(0)
+        if f.read(len(MAGIC)) != MAGIC:
+            raise RuntimeError("Not a carml events capture.")
+        self.chunks = self._read_index()
+        if self.chunks is None:
+            self.chunks = list(self._scan_chunks())
+
+    def _read_index(self):
+        f = self._f
+        end = f.seek(0, 2)
+        if end < len(MAGIC) + TRAILER.size:
+            return None
+        f.seek(end - TRAILER.size)
+        marker, index_offset = TRAILER.unpack(f.read(TRAILER.size))
+        if marker != TRAILER_MARKER or index_offset > end:
+            return None
+        f.seek(index_offset)
+        index = f.read(end - TRAILER.size - index_offset)
+        chunks = []
+        pos = 0
+        while pos < len(index):
+            offset, size, count, types_len, first, last = INDEX_ENTRY.unpack_from(index, pos)
+            pos += INDEX_ENTRY.size
+            types = index[pos:pos + types_len].decode('ascii').split()
+            pos += types_len
+            chunks.append(Chunk(offset, size, count, types, first, last))
+        return chunks
+
+    def _scan_chunks(self):
+        f = self._f
+        offset = len(MAGIC)
+        while True:
+            f.seek(offset)
+            header = f.read(CHUNK.size)
+            if len(header) < CHUNK.size:
+                return
+            marker, size, count, types_len, first, last = CHUNK.unpack(header)
+            if marker != CHUNK_MARKER:
+                # the index, or garbage after a crash
+                return
+            types = f.read(types_len).decode('ascii').split()
+            end = offset + CHUNK.size + types_len + size
+            if f.seek(0, 2) < end:
+                # truncated by a crash; we have everything before this
+                return
+            yield Chunk(offset, size, count, types, first, last)
+            offset = end
+
+    def _chunk_events(self, chunk):
+        self._f.seek(chunk.offset + CHUNK.size + len(' '.join(chunk.types)))
+        data = zlib.decompress(self._f.read(chunk.size))
+        pos = 0
+        while pos < len(data):
+            when, type_index, length = EVENT.unpack_from(data, pos)
+            pos += EVENT.size
+            yield when, chunk.types[type_index], data[pos:pos + length].decode('utf8')
+            pos += length
+
+    def events(self, since=None, until=None, types=None):
+        """
+        Generates (timestamp, event-name, text) for each event between
+        `since` and `until` (epoch seconds, either may be None) whose
+        name is in `types` (or any, if None).
+        """
+        if types is not None:
+            types = frozenset(types)
+        for chunk in self.chunks:
+            if not chunk.wanted(since, until, types):
+                continue
+            for when, event, text in self._chunk_events(chunk):
+                if since is not None and when < since:
+                    continue
+                if until is not None and when > until:
+                    # events are in time order
+                    return
+                if types is None or event in types:
+                    yield when, event, text
+
+
+def parse_time(text, now=None):
+    """
+    :returns: epoch seconds for `text`, which may be seconds since the
+        epoch, an ISO date and time ("2024-01-02 03:12") or a time
+        today ("03:12"), in local time.
+
+    :raises ValueError: if we can't make sense of it.
+    """
+    text = text.strip()
+    try:
+        return float(text)
+    except ValueError:
+        pass
+    try:
+        return time.mktime(datetime.datetime.fromisoformat(text).timetuple())
+    except ValueError:
+        pass
+    for fmt in ('%H:%M', '%H:%M:%S'):
+        try:
+            parsed = datetime.datetime.strptime(text, fmt)
+        except ValueError:
+            continue
+        today = datetime.datetime.fromtimestamp(now or time.time())
+        parsed = today.replace(hour=parsed.hour, minute=parsed.minute, second=parsed.second, microsecond=0)
+        return time.mktime(parsed.timetuple())
+    raise ValueError('"{}" is not a time like "2024-01-02 03:12", "03:12" or seconds since the epoch'.format(text))
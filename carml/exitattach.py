@@ -0,0 +1,169 @@
+'''
+Attaching streams only to circuits that exit from certain countries
+("stream --attach-exit-country DE,NL").
+
+Each stream goes on a circuit whose exit is in one of the countries
+and takes the stream's port: one we're already using for that port if
+there is one, else a spare from a CircuitPool of such circuits (built
+to exits that take port 443, the usual case), else a new one built for
+just that port. Streams that no exit in those countries will take are
+never attached, rather than leaving from somewhere else.
+'''
+import time
+import functools
+
+import txtorcon
+from twisted.internet import defer
+from zope.interface import implementer
+
+from carml import ndjson
+
+
+#: the port the spare circuits' exits are chosen to take
+POOL_PORT = 443
+
+
+def build_exit_circuit(state, index, countries, port=None):
+    """
+    :returns: a Deferred that fires with a new BUILT Circuit through
+        an exit in `countries` that takes `port`.
+    """
+    path = index.choose_path(countries, port)
+    if path is None:
+        return defer.fail(RuntimeError(
+            "No exit in {} takes port {}".format(','.join(countries), port or 'any')
+        ))
+    d = state.build_circuit(path, using_guards=bool(state.entry_guards))
+    d.addCallback(lambda circ: circ.when_built())
+    return d
+
+
+def pool_builder(state, index, countries):
+    """
+    :returns: a `build` callable for a CircuitPool of circuits through
+        exits in `countries`.
+    """
+    return functools.partial(build_exit_circuit, state, index, countries, POOL_PORT)
+
+
+@implementer(txtorcon.IStreamAttacher)
+class ExitCountryAttacher(txtorcon.CircuitListenerMixin):
+    """
+    :param index: an ExitIndex (already built).
+
+    :param countries: tuple of upper-case country codes.
+    """
+
+    def __init__(self, state, reactor, index, pool, countries, json=False, log=print):
+        self._state = state
+        self._reactor = reactor
+        self._index = index
+        self._pool = pool
+        self._countries = countries
+        self._json = json
+        self._log = log
+        #: circuit id -> Circuit, for those we've put streams on
+        self._circuits = {}
+        #: port -> the Circuit we last used for it
+        self._by_port = {}
+        #: port -> Deferred for a circuit being built for it
+        self._building = {}
+
+    @defer.inlineCallbacks
+    def start(self):
+        self._state.add_circuit_listener(self)
+        yield self._state.protocol.add_event_listener('NEWCONSENSUS', self._new_consensus)
+        self._pool.start()
+        yield self._state.set_attacher(self, self._reactor)
+
+    def _new_consensus(self, text):
+        # (TorState has already seen it, so the routers are the new ones)
+        self._index.build(text).addErrback(lambda f: self._log("Failed to index exits: {}".format(f.getErrorMessage())))
+
+    def _suitable(self, circ, port):
+        return circ.state == 'BUILT' and circ.path and self._index.is_suitable(circ.path[-1], self._countries, port)
+
+    def attach_stream(self, stream, circuits):
+        if stream.flags.get('PURPOSE', 'unknown') in ['DIR_FETCH', 'DIR_UPLOAD', 'DIRPORT_TEST']:
+            return None
+        port = stream.target_port or None
+        circ = self._by_port.get(port)
+        if circ is None or not self._suitable(circ, port):
+            circ = None
+            for candidate in self._circuits.values():
+                if self._suitable(candidate, port):
+                    circ = candidate
+                    break
+        if circ is None:
+            circ = self._pool.take_matching(lambda c: self._suitable(c, port))
+            if circ is not None:
+                self._use(circ)
+        if circ is not None:
+            self._by_port[port] = circ
+            return self._attach(stream, circ)
+
+        if not self._index.exits(self._countries, port):
+            if self._json:
+                ndjson.emit(ndjson.stream(stream, event='not_attached', time=time.time()))
+            else:
+                self._log("  no exit in {} takes port {}; not attaching {}".format(
+                    ','.join(self._countries), port, stream.id))
+            return txtorcon.TorState.DO_NOT_ATTACH
+
+        # build one for this port; streams to the same port meanwhile
+        # wait for the same circuit
+        building = self._building.get(port)
+        if building is None:
+            building = self._building[port] = defer.Deferred()
+            d = build_exit_circuit(self._state, self._index, self._countries, port)
+            d.addCallbacks(self._built, self._build_failed, callbackArgs=(port,), errbackArgs=(port,))
+        d = defer.Deferred()
+
+        def _ready(circ):
+            if circ is None:
+                if self._json:
+                    ndjson.emit(ndjson.stream(stream, event='not_attached', time=time.time()))
+                d.callback(txtorcon.TorState.DO_NOT_ATTACH)
+            else:
+                d.callback(self._attach(stream, circ))
+            return circ
+        building.addCallback(_ready)
+        return d
+
+    def _built(self, circ, port):
+        self._use(circ)
+        self._by_port[port] = circ
+        self._building.pop(port).callback(circ)
+
+    def _build_failed(self, failure, port):
+        if not self._json:
+            self._log("  couldn't build a circuit for port {}: {}".format(port, failure.getErrorMessage()))
+        self._building.pop(port).callback(None)
+
+    def _use(self, circ):
+        self._circuits[circ.id] = circ
+        if self._json:
+            ndjson.emit(ndjson.circuit(circ, event='selected', time=time.time()))
+        else:
+            exit_router = circ.path[-1]
+            self._log('Using circuit {} (exit {} in {}).'.format(
+                circ.id, exit_router.name, self._index.country(exit_router)))
+            self._log('   ' + '->'.join([p.name if p.name_is_unique else ('~%s' % p.name) for p in circ.path]))
+
+    def _attach(self, stream, circ):
+        if self._json:
+            ndjson.emit(ndjson.stream(stream, event='attach', circuit=circ.id, time=time.time()))
+        else:
+            self._log("  attaching %d %s:%d to circuit %d" % (stream.id, stream.target_host, stream.target_port, circ.id))
+        return circ
+
+    # ICircuitListener
+
+    def circuit_closed(self, circ, **kw):
+        if self._circuits.pop(circ.id, None) is None:
+            return
+        for port, used in list(self._by_port.items()):
+            if used is circ:
+                del self._by_port[port]
+
+    circuit_failed = circuit_closed
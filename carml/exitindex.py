@@ -0,0 +1,233 @@
+'''
+Which exit relays are in which countries, and which ports they take.
+
+Choosing an exit for a stream that has to leave from (say) Germany on
+port 22 would otherwise mean going through every router in
+state.routers, looking up its country and policy, for every stream.
+ExitIndex reads the consensus once (and again for each NEWCONSENSUS)
+into a per-country list of exits with their port policies, looks up
+the countries it doesn't know in batches (keeping them for the next
+consensus), and remembers the answer for each port it's asked about
+until the next consensus. It never reads Router.location, which would
+ask Tor about each exit on its own.
+
+txtorcon doesn't keep the "p" (exit policy summary) lines, so we read
+them from the consensus ourselves. An exit without one is assumed to
+take any port.
+'''
+import base64
+import random
+
+from twisted.internet import defer
+
+
+class ExitPolicy(object):
+    """
+    A consensus exit-policy summary, like "accept 80,443" or
+    "reject 25,6881-6999".
+    """
+    __slots__ = ('accept', 'ranges')
+
+    def __init__(self, summary):
+        word, _, ports = summary.strip().partition(' ')
+        if word not in ('accept', 'reject'):
+            raise ValueError('Not an exit-policy summary: "{}"'.format(summary))
+        self.accept = word == 'accept'
+        self.ranges = []
+        for port in ports.split(','):
+            if not port:
+                continue
+            lo, _, hi = port.partition('-')
+            self.ranges.append((int(lo), int(hi or lo)))
+
+    def accepts(self, port):
+        """
+        :returns: True if `port` is allowed (or, if `port` is None,
+            if any port is).
+        """
+        if port is None:
+            return self.accept or self.ranges != [(1, 65535)]
+        for lo, hi in self.ranges:
+            if lo <= port <= hi:
+                return self.accept
+        return not self.accept
+
+
+class ExitIndex(object):
+    """
+    Exit relays by country, and which of them take a given port.
+    """
+
+    #: how many ip-to-country lookups to ask Tor for at once
+    BATCH = 100
+
+    def __init__(self, state):
+        self._state = state
+        #: country code (upper-case) -> list of (Router, ExitPolicy)
+        self._by_country = {}
+        #: router id_hex -> (country, ExitPolicy)
+        self._exits = {}
+        #: IP address -> country code (upper-case; '??' if Tor
+        #: doesn't know), kept across consensuses
+        self._ip_country = {}
+        #: (countries, port) -> tuple of Routers
+        self._cache = {}
+        #: routers that can be first and second hops
+        self.guards = []
+        self.middles = []
+
+    @defer.inlineCallbacks
+    def build(self, consensus=None):
+        """
+        (Re-)read the exits from `consensus` (the text of GETINFO
+        ns/all or a NEWCONSENSUS event; by default we ask Tor).
+        """
+        if consensus is None:
+            consensus = yield self._state.protocol.get_info_raw('ns/all')
+        exits = []
+        guards = []
+        middles = []
+        for hex_id, flags, policy in _parse_consensus(consensus):
+            router = self._state.routers_by_hash.get(hex_id)
+            if router is None or 'running' not in flags or 'valid' not in flags:
+                continue
+            if 'exit' in flags and 'badexit' not in flags:
+                exits.append((router, policy))
+            if 'guard' in flags:
+                guards.append(router)
+            if 'fast' in flags:
+                middles.append(router)
+
+        known = self._ip_country
+        for router, _ in exits:
+            if router.ip not in known:
+                country = _cached_country(router)
+                if country is not None:
+                    known[router.ip] = country
+        unknown = sorted(set(router.ip for router, _ in exits if router.ip not in known and router.ip != 'unknown'))
+        for start in range(0, len(unknown), self.BATCH):
+            batch = unknown[start:start + self.BATCH]
+            keys = ['ip-to-country/' + ip for ip in batch]
+            try:
+                countries = yield self._state.protocol.get_info(*keys)
+            except Exception:
+                # e.g. Tor has no GeoIP file; they'll stay unknown
+                break
+            for ip, key in zip(batch, keys):
+                known[ip] = countries.get(key, '??').strip().upper() or '??'
+
+        by_country = {}
+        by_id = {}
+        for router, policy in exits:
+            country = known.get(router.ip, '??')
+            by_country.setdefault(country, []).append((router, policy))
+            by_id[router.id_hex] = (country, policy)
+        self._by_country = by_country
+        self._exits = by_id
+        self._cache = {}
+        self.guards = guards
+        self.middles = middles
+
+    def countries(self):
+        """
+        :returns: dict mapping country code to how many exits it has.
+        """
+        return {country: len(exits) for country, exits in self._by_country.items()}
+
+    def exits(self, countries, port=None):
+        """
+        :returns: a tuple of the exits in any of `countries` (upper-case
+            codes) that take `port` (or any port, if None).
+        """
+        key = (countries, port)
+        try:
+            return self._cache[key]
+        except KeyError:
+            pass
+        found = tuple(
+            router
+            for country in countries
+            for router, policy in self._by_country.get(country, ())
+            if policy is None or policy.accepts(port)
+        )
+        self._cache[key] = found
+        return found
+
+    def country(self, router):
+        """
+        :returns: the country code of exit `router` (or '??').
+        """
+        try:
+            return self._exits[router.id_hex][0]
+        except KeyError:
+            return '??'
+
+    def is_suitable(self, router, countries, port=None):
+        """
+        :returns: True if `router` is an exit in one of `countries`
+            that takes `port`.
+        """
+        try:
+            country, policy = self._exits[router.id_hex]
+        except KeyError:
+            return False
+        return country in countries and (policy is None or policy.accepts(port))
+
+    def choose_path(self, countries, port=None):
+        """
+        :returns: a three-hop path (list of Routers) ending at a random
+            suitable exit, or None if there's no such exit.
+        """
+        exits = self.exits(countries, port)
+        if not exits:
+            return None
+        exit_router = random.choice(exits)
+        guards = list(self._state.entry_guards.values()) or self.guards
+        guard = random.choice([g for g in guards if g is not exit_router] or guards)
+        middles = [m for m in random.sample(self.middles, min(8, len(self.middles))) if m is not guard and m is not exit_router]
+        if not middles:
+            return None
+        return [guard, middles[0], exit_router]
+
+
+def _cached_country(router):
+    """
+    :returns: `router`'s country code if txtorcon already has one, or
+        None. (Router.location would ask Tor for each one that isn't
+        known yet.)
+    """
+    location = getattr(router, '_location', None)
+    code = getattr(location, 'countrycode', None)
+    return code.upper() if code else None
+
+
+def _parse_consensus(text):
+    """
+    :returns: a generator of (id_hex, flags, ExitPolicy or None) for
+        each router in consensus `text`.
+    """
+    hex_id = None
+    flags = ()
+    policy = None
+    for line in text.split('\n'):
+        if line.startswith('r '):
+            if hex_id is not None:
+                yield hex_id, flags, policy
+            args = line.split()
+            try:
+                ident = base64.b64decode(args[2] + '=' * (-len(args[2]) % 4))
+            except (IndexError, ValueError):
+                hex_id = None
+                continue
+            hex_id = '$' + ident.hex().upper()
+            flags = ()
+            policy = None
+        elif line.startswith('s '):
+            flags = set(line[2:].lower().split())
+        elif line.startswith('p '):
+            try:
+                policy = ExitPolicy(line[2:])
+            except ValueError:
+                policy = None
+    if hex_id is not None:
+        yield hex_id, flags, policy
@@ -0,0 +1,127 @@
+'''
+Running one command against several Tors at once (--connect given
+more than once).
+
+Every instance gets its own connection and TorState, but they all
+share a reactor and stdout. To tell their output apart, TaggedOutput
+prefixes each line with the instance it came from; "the instance it
+came from" is whichever one we were handling data from (or starting
+the command for) when the line was printed.
+'''
+import sys
+import json
+import contextlib
+
+
+class TaggedOutput(object):
+    """
+    A text-mode file-like object to install as sys.stdout; lines are
+    prefixed with ``[tag]`` or, for --json records, get an
+    ``"instance"`` key.
+    """
+
+    def __init__(self, stream, json=False):
+        self._stream = stream
+        self._json = json
+        self._partial = {}
+        self._prefixes = {}
+        self.current = None
+
+    def write(self, text):
+        tag = self.current
+        lines = (self._partial.pop(tag, '') + text).split('\n')
+        last = lines.pop()
+        if last:
+            self._partial[tag] = last
+        if lines:
+            prefix = self._prefix(tag)
+            if self._json:
+                self._stream.write(''.join(self._tag_record(prefix, line) for line in lines))
+            else:
+                self._stream.write(''.join(prefix + line + '\n' for line in lines))
+        return len(text)
+
+    def _prefix(self, tag):
+        try:
+            return self._prefixes[tag]
+        except KeyError:
+            if tag is None:
+                prefix = ''
+            elif self._json:
+                prefix = '{"instance":' + json.dumps(tag) + ','
+            else:
+                prefix = '[{}] '.format(tag)
+            self._prefixes[tag] = prefix
+            return prefix
+
+    @staticmethod
+    def _tag_record(prefix, line):
+        if prefix and line.startswith('{') and line != '{}':
+            return prefix + line[1:] + '\n'
+        return line + '\n'
+
+    def flush(self):
+        self._stream.flush()
+
+    def isatty(self):
+        return self._stream.isatty()
+
+    def fileno(self):
+        return self._stream.fileno()
+
+    @property
+    def encoding(self):
+        return self._stream.encoding
+
+    def close(self):
+        """
+        Write out any unfinished lines and put back the stdout we
+        replaced (if install()-ed).
+        """
+        for tag in list(self._partial):
+            self.current = tag
+            self.write('\n')
+        self.current = None
+        self.flush()
+        if sys.stdout is self:
+            sys.stdout = self._stream
+
+    @contextlib.contextmanager
+    def tagged(self, tag):
+        previous, self.current = self.current, tag
+        try:
+            yield
+        finally:
+            self.current = previous
+
+    def tag_protocol(self, tag, proto):
+        """
+        Anything printed while `proto` handles data from Tor (i.e.
+        event listeners, and commands continuing after a reply) is
+        tagged with `tag`.
+        """
+        orig_data_received = proto.dataReceived
+
+        def data_received(data):
+            with self.tagged(tag):
+                return orig_data_received(data)
+        proto.dataReceived = data_received
+
+
+def read_connect_file(f):
+    """
+    :returns: the endpoints listed in `f`, one per line; blank lines
+        and ``#`` comments are skipped.
+    """
+    endpoints = []
+    for line in f:
+        line = line.split('#', 1)[0].strip()
+        if line:
+            endpoints.append(line)
+    return endpoints
+
+
+def install(json=False):
+    output = TaggedOutput(sys.stdout, json=json)
+    sys.stdout = output
+    return output
@@ -0,0 +1,246 @@
+'''
+A "flight recorder" for events ("events --flight-recorder").
+
+We keep the most recent events -- up to some age, and up to some
+amount of memory -- in one preallocated ring buffer, and write them
+out (as an events capture; see eventstore.py) when asked to with
+SIGUSR1, or when a trigger condition fires (too many events matching a
+filter within some time).
+
+Recording an event is one struct.pack_into() and a memory copy into
+the buffer; the oldest events are overwritten as needed, so memory
+use never grows.
+'''
+import os
+import time
+import struct
+import signal
+
+from carml import ndjson
+from carml.eventstore import EventCaptureWriter
+
+
+#: each record: timestamp, event type (an index), length of the text
+RECORD = struct.Struct('<dBI')
+
+#: type-index marking "the rest of the buffer is unused; go back to
+#: the start"
+_WRAP = 255
+
+
+class RingBuffer(object):
+    """
+    The most recent (timestamp, event, text) records that fit in
+    `size` bytes.
+
+    :param types: the event names we'll record (at most 255).
+    """
+
+    def __init__(self, size, types):
+        if len(types) >= _WRAP:
+            raise ValueError("Too many event types.")
+        self._buffer = bytearray(size)
+        self._size = size
+        self._types = list(types)
+        self._type_index = {name: i for i, name in enumerate(self._types)}
+        #: offset of the oldest record
+        self._head = 0
+        #: where the next record goes
+        self._tail = 0
+        self.count = 0
+
+    def append(self, event, data, when):
+        """
+        Add `data` (bytes) for `event`, forgetting old records to make
+        room if need be.
+        """
+        needed = RECORD.size + len(data)
+        if needed > self._size // 2:
+            # an absurdly large event; not worth losing everything for
+            return False
+        if self._tail + needed > self._size:
+            # doesn't fit before the end; forget everything between
+            # here and the end, then go back to the start
+            while self.count and self._head >= self._tail:
+                self._forget_oldest()
+            if self._tail + RECORD.size <= self._size:
+                RECORD.pack_into(self._buffer, self._tail, 0.0, _WRAP, 0)
+            self._tail = 0
+        while self.count and self._tail <= self._head < self._tail + needed:
+            self._forget_oldest()
+        if not self.count:
+            self._head = self._tail
+        RECORD.pack_into(self._buffer, self._tail, when, self._type_index[event], len(data))
+        start = self._tail + RECORD.size
+        self._buffer[start:start + len(data)] = data
+        self._tail = start + len(data)
+        self.count += 1
+        return True
+
+    def _record_at(self, offset):
+        """
+        :returns: (offset, timestamp, type-index, length) of the record
+            at `offset`, or the first one if we're at the end.
+        """
+        if offset + RECORD.size > self._size:
+            offset = 0
+        when, type_index, length = RECORD.unpack_from(self._buffer, offset)
+        if type_index == _WRAP:
+            offset = 0
+            when, type_index, length = RECORD.unpack_from(self._buffer, 0)
+        return offset, when, type_index, length
+
+    def _forget_oldest(self):
+        offset, _, _, length = self._record_at(self._head)
+        self._head = offset + RECORD.size + length
+        self.count -= 1
+
+    def oldest(self):
+        """
+        :returns: the timestamp of the oldest record, or None.
+        """
+        if not self.count:
+            return None
+        return self._record_at(self._head)[1]
+
+    def forget_before(self, when):
+        """
+        Forget records older than `when`.
+        """
+        while self.count and self._record_at(self._head)[1] < when:
+            self._forget_oldest()
+
+    def records(self):
+        """
+        Generates (timestamp, event, text) for each record, oldest
+        first.
+        """
+        offset = self._head
+        for _ in range(self.count):
+            offset, when, type_index, length = self._record_at(offset)
+            start = offset + RECORD.size
+            yield when, self._types[type_index], bytes(self._buffer[start:start + length]).decode('utf8')
+            offset = start + length
+
+
+class RateTrigger(object):
+    """
+    Fires once more than `threshold` events arrive within `interval`
+    seconds (counted in one-second buckets); then not again until
+    another `interval` has passed.
+    """
+
+    def __init__(self, threshold, interval):
+        self._threshold = threshold
+        self._buckets = [0] * max(1, int(round(interval)))
+        self._interval = interval
+        self._second = None
+        self._total = 0
+        self._quiet_until = 0.0
+
+    def hit(self, when):
+        """
+        Count one matching event; :returns: True if that's the one
+        that makes us fire.
+        """
+        second = int(when)
+        if second != self._second:
+            self._advance(second)
+        slot = second % len(self._buckets)
+        self._buckets[slot] += 1
+        self._total += 1
+        if self._total > self._threshold and when >= self._quiet_until:
+            self._quiet_until = when + self._interval
+            return True
+        return False
+
+    def _advance(self, second):
+        if self._second is None or second - self._second >= len(self._buckets):
+            self._buckets = [0] * len(self._buckets)
+            self._total = 0
+        else:
+            for s in range(self._second + 1, second + 1):
+                slot = s % len(self._buckets)
+                self._total -= self._buckets[slot]
+                self._buckets[slot] = 0
+        self._second = second
+
+
+class FlightRecorder(object):
+    """
+    Records events in a RingBuffer and dump()s them to a new capture
+    in `directory` on SIGUSR1 or when `trigger` (a RateTrigger) fires
+    for an event matching `trigger_matches`.
+
+    :param keep: seconds of events to keep (at most).
+    """
+
+    def __init__(self, reactor, directory, types, max_memory, keep,
+                 trigger_matches=None, trigger=None, json=False, log=print):
+        self._reactor = reactor
+        self._directory = directory
+        self._buffer = RingBuffer(max_memory, types)
+        self._keep = keep
+        self._trigger_matches = trigger_matches
+        self._trigger = trigger
+        self._json = json
+        self._log = log or (lambda msg: None)
+        self._loop = None
+        self.dumps = []
+
+    def start(self):
+        from twisted.internet import task
+        # age out old events once a second, rather than on every event
+        self._loop = task.LoopingCall(self._expire)
+        self._loop.clock = self._reactor
+        self._loop.start(1.0, now=False)
+        signal.signal(signal.SIGUSR1, self._on_signal)
+
+    def stop(self):
+        signal.signal(signal.SIGUSR1, signal.SIG_DFL)
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
+
+    def event(self, event, text):
+        when = time.time()
+        self._buffer.append(event, text.encode('utf8'), when)
+        if self._trigger is not None and self._trigger_matches(event, text):
+            if self._trigger.hit(when):
+                if self._json:
+                    ndjson.emit({'type': 'flight_recorder', 'event': 'trigger', 'time': when})
+                else:
+                    self._log("Trigger fired; saving recent events.")
+                # after this event is done with
+                self._reactor.callLater(0, self.dump)
+
+    def _expire(self):
+        self._buffer.forget_before(time.time() - self._keep)
+
+    def _on_signal(self, signum, frame):
+        self._reactor.callFromThread(self.dump)
+
+    def dump(self):
+        """
+        Write everything we have to a new capture file.
+
+        :returns: its name.
+        """
+        self._expire()
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        path = os.path.join(self._directory, 'carml-flight-{}.cap'.format(stamp))
+        serial = 1
+        while os.path.exists(path):
+            path = os.path.join(self._directory, 'carml-flight-{}.{}.cap'.format(stamp, serial))
+            serial += 1
+        writer = EventCaptureWriter(open(path, 'wb'))
+        count = 0
+        for when, event, text in self._buffer.records():
+            writer.record(event, text, when)
+            count += 1
+        writer.close()
+        self.dumps.append(path)
+        if self._json:
+            ndjson.emit({'type': 'flight_recorder', 'event': 'dump', 'path': path, 'count': count, 'time': time.time()})
+        else:
+            self._log("Wrote {} events to {}.".format(count, path))
+        return path
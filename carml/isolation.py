@@ -0,0 +1,264 @@
+'''
+Stream isolation policies ("stream --isolate").
+
+A policy says which streams may share a circuit: those from the same
+process, to the same domain, to the same port, with the same SOCKS
+username, or from the same process to the same domain. Every stream
+gets a key from the policy, and each key gets a circuit of its own
+(from a CircuitPool, so usually without waiting for Tor to build one).
+The key's circuit is closed once it has no streams left.
+
+Everything is a dict lookup on the key, stream id or circuit id, so
+deciding where a stream goes takes the same time with ten or ten
+thousand live streams.
+'''
+import time
+import collections
+
+import txtorcon
+from twisted.internet import defer
+from zope.interface import implementer
+
+from carml import ndjson
+from carml.procindex import process_from_address, executable
+
+
+def _pid(stream, state):
+    return process_from_address(stream.source_addr, stream.source_port, state)
+
+
+def _domain(stream, state):
+    host = stream.target_host
+    if host is None:
+        return None
+    host = host.lower().rstrip('.')
+    if host.endswith('.onion'):
+        return host
+    labels = host.split('.')
+    if labels[-1].isdigit() or ':' in host:
+        # an IP address
+        return host
+    # without a public-suffix list, the last two labels is the best
+    # guess at "the site" (so www.example.com and cdn.example.com
+    # share a circuit)
+    return '.'.join(labels[-2:])
+
+
+def _port(stream, state):
+    return stream.target_port
+
+
+def _socks_username(stream, state):
+    username = stream.flags.get('SOCKS_USERNAME')
+    if username is None:
+        return None
+    return username.strip('"')
+
+
+def _pid_domain(stream, state):
+    pid = _pid(stream, state)
+    if pid is None:
+        return None
+    return pid, _domain(stream, state)
+
+
+Policy = collections.namedtuple('Policy', ['name', 'key', 'pool_size', 'max_age', 'description'])
+
+#: the policies, by name; pool_size and max_age are defaults
+POLICIES = {p.name: p for p in [
+    Policy('pid', _pid, 3, None, 'process'),
+    Policy('domain', _domain, 5, 600.0, 'domain'),
+    Policy('port', _port, 2, 600.0, 'port'),
+    Policy('socks-username', _socks_username, 3, None, 'SOCKS username'),
+    Policy('pid-domain', _pid_domain, 5, 600.0, 'process and domain'),
+]}
+
+
+class LatencyStats(object):
+    """
+    How long streams waited to be attached: totals since we started,
+    and percentiles of the most recent `keep`.
+    """
+
+    def __init__(self, keep=1000):
+        self._recent = collections.deque(maxlen=keep)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self._recent.append(seconds)
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def summary(self):
+        """
+        :returns: a dict of the statistics, in milliseconds.
+        """
+        recent = sorted(self._recent)
+
+        def percentile(p):
+            if not recent:
+                return 0.0
+            return recent[min(len(recent) - 1, int(len(recent) * p))] * 1000.0
+        return {
+            'count': self.count,
+            'mean_ms': (self.total / self.count * 1000.0) if self.count else 0.0,
+            'p50_ms': percentile(0.5),
+            'p90_ms': percentile(0.9),
+            'p99_ms': percentile(0.99),
+            'max_ms': self.max * 1000.0,
+        }
+
+
+def format_stats(summary):
+    return (
+        "attach latency: {count} streams, mean {mean_ms:.1f}ms, p50 {p50_ms:.1f}ms, "
+        "p90 {p90_ms:.1f}ms, p99 {p99_ms:.1f}ms, max {max_ms:.1f}ms".format(**summary)
+    )
+
+
+class _Assignment(object):
+    __slots__ = ('key', 'circuit_d', 'circuit', 'waiting', 'streams', 'started')
+
+    def __init__(self, key, circuit_d):
+        self.key = key
+        #: fires with the circuit for this key
+        self.circuit_d = circuit_d
+        #: the circuit, once we have it
+        self.circuit = None
+        #: a Deferred for each stream waiting for the circuit
+        self.waiting = []
+        #: ids of the streams on it
+        self.streams = set()
+        self.started = time.time()
+
+
+@implementer(txtorcon.IStreamAttacher)
+class IsolationAttacher(txtorcon.StreamListenerMixin, txtorcon.CircuitListenerMixin):
+    """
+    Attaches each stream to the circuit for its `policy` key (a Policy,
+    or the name of one). Streams with no key (e.g. we couldn't find
+    the process) share a circuit of their own, so they're still kept
+    apart from everything else.
+
+    :param max_age: if not None, once a key's circuit has been in use
+        for this many seconds, new streams for that key get a new one.
+    """
+
+    def __init__(self, state, reactor, pool, policy, max_age=None, json=False, log=print):
+        self._state = state
+        self._reactor = reactor
+        self._pool = pool
+        self._policy = POLICIES[policy] if isinstance(policy, str) else policy
+        self._max_age = max_age
+        self._json = json
+        self._log = log
+        #: key -> _Assignment
+        self._by_key = {}
+        #: stream id -> _Assignment
+        self._by_stream = {}
+        #: circuit id -> _Assignment
+        self._by_circuit = {}
+        self.stats = LatencyStats()
+
+    def start(self):
+        self._state.add_stream_listener(self)
+        self._state.add_circuit_listener(self)
+        self._pool.start()
+        self._state.set_attacher(self, self._reactor)
+
+    def _describe(self, key):
+        if key is None:
+            return 'streams with no {}'.format(self._policy.description)
+        if self._policy.name == 'pid':
+            return 'process {} ({})'.format(key, executable(key))
+        if self._policy.name == 'pid-domain':
+            return 'process {} ({}) to {}'.format(key[0], executable(key[0]), key[1])
+        return '{} {}'.format(self._policy.description, key)
+
+    def attach_stream(self, stream, circuits):
+        if stream.flags.get('PURPOSE', 'unknown') in ['DIR_FETCH', 'DIR_UPLOAD', 'DIRPORT_TEST']:
+            return None
+        started = time.time()
+        key = self._policy.key(stream, self._state)
+        if key is None and not self._json:
+            self._log("  no {} for stream {}; isolating it with the others like it".format(
+                self._policy.description, stream.id))
+        assignment = self._by_key.get(key)
+        if assignment is not None and self._max_age is not None and started - assignment.started > self._max_age:
+            # existing streams stay where they are; new ones get a
+            # fresh circuit
+            self._retire(assignment)
+            assignment = None
+        if assignment is None:
+            assignment = self._by_key[key] = _Assignment(key, self._pool.take())
+            assignment.circuit_d.addCallback(self._selected, assignment)
+        assignment.streams.add(stream.id)
+        self._by_stream[stream.id] = assignment
+        if assignment.circuit is not None:
+            return self._attach(assignment.circuit, stream, key, started)
+        # (each stream gets its own Deferred, so one going wrong
+        # doesn't affect the others)
+        d = defer.Deferred()
+        d.addCallback(self._attach, stream, key, started)
+        assignment.waiting.append(d)
+        return d
+
+    def _attach(self, circ, stream, key, started):
+        self.stats.add(time.time() - started)
+        if self._json:
+            ndjson.emit(ndjson.stream(stream, event='attach', circuit=circ.id, key=str(key), time=time.time()))
+        else:
+            self._log("  attaching stream {} to circuit {} for {}:{}".format(
+                stream.id, circ.id, stream.target_host, stream.target_port))
+        return circ
+
+    def _selected(self, circ, assignment):
+        assignment.circuit = circ
+        assignment.started = time.time()
+        self._by_circuit[circ.id] = assignment
+        if self._json:
+            ndjson.emit(ndjson.circuit(circ, event='selected', key=str(assignment.key), time=time.time()))
+        else:
+            self._log('Selected circuit {} for {}.'.format(circ.id, self._describe(assignment.key)))
+            self._log('   ' + '->'.join([p.name if p.name_is_unique else ('{%s}' % p.name) for p in circ.path]))
+        waiting, assignment.waiting = assignment.waiting, []
+        for d in waiting:
+            d.callback(circ)
+        return circ
+
+    def _retire(self, assignment):
+        """
+        No new streams for `assignment`; its circuit is released once
+        the streams it has are gone.
+        """
+        if self._by_key.get(assignment.key) is assignment:
+            del self._by_key[assignment.key]
+        if not assignment.streams:
+            assignment.circuit_d.addCallback(self._release, assignment)
+
+    def _release(self, circ, assignment):
+        self._by_circuit.pop(circ.id, None)
+        self._pool.release(circ)
+        return circ
+
+    def stream_closed(self, stream, **kw):
+        assignment = self._by_stream.pop(stream.id, None)
+        if assignment is None:
+            return
+        assignment.streams.discard(stream.id)
+        if not assignment.streams:
+            self._retire(assignment)
+
+    stream_failed = stream_closed
+
+    def circuit_closed(self, circ, **kw):
+        assignment = self._by_circuit.pop(circ.id, None)
+        if assignment is not None and self._by_key.get(assignment.key) is assignment:
+            # its next stream gets a new one
+            del self._by_key[assignment.key]
+
+    circuit_failed = circuit_closed
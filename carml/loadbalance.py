@@ -0,0 +1,227 @@
+'''
+Spreading streams across several circuits ("stream --attach 12,15,18"
+or "stream --attach auto:4").
+
+Attaching every stream to one circuit makes that circuit the
+bottleneck for bulk jobs. LoadBalancer keeps a set of circuits and
+puts each new stream on the least-loaded one, where a circuit's load
+is how many bytes it has carried lately (from CIRC_BW events, or from
+STREAM_BW events for the streams we put on it when Tor has no CIRC_BW)
+plus an allowance for each stream on it that may not have sent
+anything yet -- otherwise a burst of new streams would all land on
+whichever circuit happened to be quietest.
+
+With "auto:N", when one of the circuits closes it's replaced from a
+CircuitPool (with a path Tor chooses), so the set stays the same size.
+Circuits given by ID aren't replaced; once they've all closed, new
+streams aren't attached at all rather than going somewhere else.
+'''
+import time
+
+import txtorcon
+from twisted.internet import defer
+from zope.interface import implementer
+
+from carml import ndjson
+from carml.eventparse import CircBwEvent, StreamBwEvent
+
+
+#: what parsing a malformed (or truncated) *_BW event raises
+_BAD_EVENT = (ValueError, TypeError, IndexError)
+
+
+class _Load(object):
+    """
+    Bytes a circuit carried recently (decaying by half every
+    `half_life` seconds) and the streams we put on it.
+    """
+    __slots__ = ('circuit', 'bytes', 'updated', 'streams')
+
+    def __init__(self, circuit, now):
+        self.circuit = circuit
+        self.bytes = 0.0
+        self.updated = now
+        self.streams = set()
+
+    def recent_bytes(self, now, half_life):
+        if now > self.updated:
+            self.bytes *= 0.5 ** ((now - self.updated) / half_life)
+            self.updated = now
+        return self.bytes
+
+    def add(self, count, now, half_life):
+        self.bytes = self.recent_bytes(now, half_life) + count
+
+
+@implementer(txtorcon.IStreamAttacher)
+class LoadBalancer(txtorcon.StreamListenerMixin, txtorcon.CircuitListenerMixin):
+    """
+    Attaches each new stream to the least-loaded of `circuits`,
+    replacing any that close with one from `pool`.
+
+    :param pool: a CircuitPool, or None to not replace circuits.
+
+    :param circuits: the BUILT Circuits to start with.
+
+    :param wanted: how many circuits to keep (default: as many as in
+        `circuits`); any more are taken from `pool` straight away.
+    """
+
+    #: bytes a stream is assumed to bring with it, before we see any
+    STREAM_COST = 16 * 1024
+
+    #: seconds for a circuit's byte count to decay by half
+    HALF_LIFE = 10.0
+
+    def __init__(self, state, reactor, pool, circuits=(), wanted=None, json=False, log=print, clock=time.monotonic):
+        self._state = state
+        self._reactor = reactor
+        self._pool = pool
+        self._json = json
+        self._log = log
+        self._clock = clock
+        #: circuit id -> _Load
+        self._loads = {}
+        #: stream id -> _Load
+        self._by_stream = {}
+        #: Deferreds for streams waiting until we have a circuit
+        self._waiting = []
+        #: circuits asked for from the pool but not yet here
+        self._replacing = 0
+        now = clock()
+        for circuit in circuits:
+            self._loads[circuit.id] = _Load(circuit, now)
+        self._wanted = len(self._loads) if wanted is None else wanted
+
+    @defer.inlineCallbacks
+    def start(self):
+        self._state.add_stream_listener(self)
+        self._state.add_circuit_listener(self)
+        if self._pool is not None:
+            self._pool.start()
+        protocol = self._state.protocol
+        if 'CIRC_BW' in protocol.valid_events:
+            yield protocol.add_event_listener('CIRC_BW', self._circ_bw)
+        else:
+            yield protocol.add_event_listener('STREAM_BW', self._stream_bw)
+        self._replace()
+        yield self._state.set_attacher(self, self._reactor)
+
+    def _replace(self):
+        if self._pool is None:
+            return
+        while len(self._loads) + self._replacing < self._wanted:
+            self._replacing += 1
+            self._pool.take().addCallback(self._added)
+
+    def _added(self, circuit):
+        self._replacing -= 1
+        self._loads[circuit.id] = _Load(circuit, self._clock())
+        if self._json:
+            ndjson.emit(ndjson.circuit(circuit, event='selected', time=time.time()))
+        else:
+            self._log('Using circuit {}.'.format(circuit.id))
+            self._log('   ' + '->'.join([p.name if p.name_is_unique else ('~%s' % p.name) for p in circuit.path]))
+        waiting, self._waiting = self._waiting, []
+        for d in waiting:
+            d.callback(None)
+        return circuit
+
+    def load(self, circuit_id):
+        """
+        :returns: the load of circuit `circuit_id` (which is one of
+            ours), in bytes.
+        """
+        load = self._loads[circuit_id]
+        return load.recent_bytes(self._clock(), self.HALF_LIFE) + len(load.streams) * self.STREAM_COST
+
+    def least_loaded(self):
+        """
+        :returns: the id of our least-loaded circuit, or None if we
+            have none right now.
+        """
+        now = self._clock()
+        best = None
+        best_load = None
+        for circuit_id, load in self._loads.items():
+            if load.circuit.state != 'BUILT':
+                continue
+            value = load.recent_bytes(now, self.HALF_LIFE) + len(load.streams) * self.STREAM_COST
+            if best_load is None or value < best_load:
+                best, best_load = circuit_id, value
+        return best
+
+    def attach_stream(self, stream, circuits):
+        if stream.flags.get('PURPOSE', 'unknown') in ['DIR_FETCH', 'DIR_UPLOAD', 'DIRPORT_TEST']:
+            return None
+        circuit_id = self.least_loaded()
+        if circuit_id is None and self._pool is None:
+            if self._json:
+                ndjson.emit(ndjson.stream(stream, event='not_attached', time=time.time()))
+            else:
+                self._log("  all our circuits are closed; not attaching {}".format(stream.id))
+            return txtorcon.TorState.DO_NOT_ATTACH
+        if circuit_id is None:
+            # all of them closed; wait for a replacement
+            d = defer.Deferred()
+            self._waiting.append(d)
+            d.addCallback(lambda _: self.attach_stream(stream, circuits))
+            return d
+        load = self._loads[circuit_id]
+        load.streams.add(stream.id)
+        self._by_stream[stream.id] = load
+        if self._json:
+            ndjson.emit(ndjson.stream(stream, event='attach', circuit=circuit_id, time=time.time()))
+        elif stream.state == 'NEWRESOLVE':
+            self._log("  attaching %d (resolve %s) to circuit %d" % (stream.id, stream.target_host, circuit_id))
+        else:
+            self._log("  attaching %d %s:%d to circuit %d" % (stream.id, stream.target_host, stream.target_port, circuit_id))
+        return load.circuit
+
+    def _circ_bw(self, text):
+        try:
+            event = CircBwEvent(text)
+            circuit_id, count = event.id, event.read + event.written
+        except _BAD_EVENT:
+            return
+        load = self._loads.get(circuit_id)
+        if load is not None:
+            load.add(count, self._clock(), self.HALF_LIFE)
+
+    def _stream_bw(self, text):
+        try:
+            event = StreamBwEvent(text)
+        except _BAD_EVENT:
+            return
+        load = self._by_stream.get(event.stream_id)
+        if load is not None:
+            load.add(event.read + event.written, self._clock(), self.HALF_LIFE)
+
+    # IStreamListener
+
+    def stream_closed(self, stream, **kw):
+        load = self._by_stream.pop(stream.id, None)
+        if load is not None:
+            load.streams.discard(stream.id)
+
+    stream_failed = stream_closed
+
+    # ICircuitListener
+
+    def circuit_closed(self, circuit, **kw):
+        load = self._loads.pop(circuit.id, None)
+        if load is None:
+            return
+        for stream_id in load.streams:
+            self._by_stream.pop(stream_id, None)
+        if self._json:
+            ndjson.emit(ndjson.circuit(circuit, event='closed', time=time.time()))
+        elif self._pool is None:
+            self._log("Circuit {} closed (REASON={}).".format(
+                circuit.id, kw.get('REASON', 'not specified')))
+        else:
+            self._log("Circuit {} closed (REASON={}); replacing it.".format(
+                circuit.id, kw.get('REASON', 'not specified')))
+        self._replace()
+
+    circuit_failed = circuit_closed
@@ -0,0 +1,84 @@
+'''
+Newline-delimited JSON output (the global --json option).
+
+Commands emit() one record -- a flat-ish dict with a "type" key --
+per thing they'd otherwise print a line (or table) for, as soon as
+they have it; nothing is collected until the end. These helpers avoid
+colours, padding and humanize entirely: consumers want the raw values.
+'''
+import sys
+import json
+import datetime
+
+
+_encoder = json.JSONEncoder(separators=(',', ':'), default=str)
+
+
+def emit(record, **kw):
+    """
+    Write `record` (updated with any keyword arguments) as one line
+    of JSON on stdout.
+    """
+    if kw:
+        record.update(kw)
+    sys.stdout.write(line(record))
+
+
+def line(record):
+    """
+    :returns: `record` as one line of JSON (including the newline).
+    """
+    return _encoder.encode(record) + '\n'
+
+
+def _iso(when):
+    if isinstance(when, datetime.datetime):
+        return when.isoformat()
+    return when
+
+
+def circuit(circ, **kw):
+    record = {
+        'type': 'circuit',
+        'id': circ.id,
+        'state': circ.state,
+        'purpose': circ.purpose,
+        'path': [{'id': r.id_hex, 'name': r.name} for r in circ.path],
+        'time_created': _iso(circ.time_created),
+        'flags': circ.flags,
+    }
+    record.update(kw)
+    return record
+
+
+def stream(strm, **kw):
+    record = {
+        'type': 'stream',
+        'id': strm.id,
+        'state': strm.state,
+        'circuit': strm.circuit.id if strm.circuit else None,
+        'target_host': strm.target_host,
+        'target_addr': str(strm.target_addr) if strm.target_addr else None,
+        'target_port': strm.target_port,
+        'source_addr': str(strm.source_addr) if strm.source_addr else None,
+        'source_port': strm.source_port,
+        'flags': strm.flags,
+    }
+    record.update(kw)
+    return record
+
+
+def router(r, **kw):
+    record = {
+        'type': 'router',
+        'id': r.id_hex,
+        'name': r.name,
+        'ip': str(r.ip),
+        'or_port': int(r.or_port),
+        'dir_port': int(r.dir_port),
+        'flags': list(r.flags),
+        'bandwidth': r.bandwidth,
+        'modified': _iso(r.modified),
+    }
+    record.update(kw)
+    return record
@@ -0,0 +1,156 @@
+'''
+Buffered standard output for commands that print a line per event.
+
+Printing and flush()-ing every line costs one write() system-call per
+event, which adds up during CIRC/STREAM storms. OutputSink instead
+collects what's printed and writes it out in larger chunks: when
+enough has piled up, or shortly after the first unwritten line so
+that output still appears promptly. When stdout is a terminal we pass
+everything straight through, as before.
+
+If stdout is a slow pipe we don't want to block the reactor (and
+thus stop reading from Tor) on every chunk, so writes are done
+without blocking and whatever the pipe won't take is retried later --
+unless too much has piled up, at which point we do block; that way
+memory stays bounded and the backpressure ends up on Tor's control
+connection, just like it used to.
+'''
+import os
+import sys
+import fcntl
+
+
+class OutputSink(object):
+    """
+    A text-mode file-like object to install as sys.stdout.
+
+    :param buffer_size: write out once this many bytes are waiting.
+
+    :param flush_interval: ...or this many seconds after the oldest
+        unwritten line (needs a `reactor`).
+
+    :param max_pending: if a slow reader leaves this many bytes
+        unwritten, block until they're written.
+    """
+
+    def __init__(self, stream, reactor=None, buffer_size=64 * 1024,
+                 flush_interval=0.1, max_pending=8 * 1024 * 1024):
+        self._stream = stream
+        self._reactor = reactor
+        self._buffer_size = buffer_size
+        self._flush_interval = flush_interval
+        self._max_pending = max_pending
+        self._pending = []
+        self._size = 0
+        self._timer = None
+        self.encoding = getattr(stream, 'encoding', None) or 'utf8'
+        self.errors = getattr(stream, 'errors', None) or 'strict'
+        try:
+            self._fd = stream.fileno()
+        except (AttributeError, ValueError, IOError):
+            # e.g. a StringIO
+            self._fd = None
+        self.passthrough = self._fd is None or stream.isatty()
+
+    # the bits of the file API that print() and click.echo() use
+
+    def write(self, text):
+        if self.passthrough:
+            return self._stream.write(text)
+        data = text.encode(self.encoding, self.errors)
+        self._pending.append(data)
+        self._size += len(data)
+        if self._size >= self._buffer_size:
+            self._drain()
+        elif self._timer is None and self._reactor is not None:
+            self._timer = self._reactor.callLater(self._flush_interval, self._timeout)
+        return len(text)
+
+    def flush(self):
+        """
+        Commands call this after each line they print; when we're
+        buffering, it's the timer's job instead.
+        """
+        if self.passthrough:
+            self._stream.flush()
+
+    def isatty(self):
+        return self._stream.isatty()
+
+    def fileno(self):
+        return self._stream.fileno()
+
+    def close(self):
+        """
+        Write out everything (blocking if we must) and stop buffering;
+        we don't close the underlying stream.
+        """
+        if self._timer is not None and self._timer.active():
+            self._timer.cancel()
+        self._timer = None
+        if not self.passthrough:
+            self._drain(block=True)
+        self.passthrough = True
+
+    def _timeout(self):
+        self._timer = None
+        self._drain()
+
+    def _drain(self, block=False):
+        if not self._size:
+            return
+        # anything print()-ed before we were installed must come first
+        self._stream.flush()
+        data = memoryview(b''.join(self._pending))
+        self._pending = []
+        self._size = 0
+
+        if block or len(data) > self._max_pending:
+            _write_all(self._fd, data)
+            return
+
+        written = _write_nonblocking(self._fd, data)
+        if written < len(data):
+            self._pending.append(data[written:].tobytes())
+            self._size = len(data) - written
+            if self._timer is None and self._reactor is not None:
+                self._timer = self._reactor.callLater(self._flush_interval, self._timeout)
+
+
+def _write_all(fd, data):
+    while data:
+        data = data[os.write(fd, data):]
+
+
+def _write_nonblocking(fd, data):
+    """
+    :returns: how many bytes of `data` we could write to `fd` without
+        waiting.
+    """
+    # O_NONBLOCK is a property of the open file, which stderr may
+    # share with us; so only set it while we're actually writing
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+    written = 0
+    try:
+        while written < len(data):
+            written += os.write(fd, data[written:])
+    except BlockingIOError:
+        pass
+    finally:
+        fcntl.fcntl(fd, fcntl.F_SETFL, flags)
+    return written
+
+
+def install(reactor):
+    """
+    Replace sys.stdout with an OutputSink (unless it's a terminal).
+
+    :returns: the OutputSink; close() it when done.
+    """
+    sink = OutputSink(sys.stdout, reactor=reactor)
+    if not sink.passthrough:
+        sys.stdout = sink
+        # SIGINT etc. stop the reactor without the command finishing
+        reactor.addSystemEventTrigger('before', 'shutdown', sink.close)
+    return sink
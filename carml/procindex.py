@@ -0,0 +1,232 @@
+'''
+Which process owns a TCP connection, for many connections at once.
+
+txtorcon.util.process_from_address runs lsof once per connection,
+which is fine for one stream but stalls "stream --list --verbose" or
+"monitor" with thousands of them. Instead, ProcessIndex reads
+/proc/net/tcp and /proc/net/tcp6 (address -> socket inode) and the
+/proc/*/fd links (socket inode -> PID) in one pass, and answers
+lookups from that until it's `ttl` seconds old. When asked about a
+connection it doesn't know, it always re-reads the (cheap) socket
+tables, then looks through the fds of the processes that already have
+sockets and of any started since the last pass; only if that fails
+does it look through every process again (and not for a socket that
+was already open last time it did, since that's one we can't see).
+So a brand-new connection is found just as by looking it up alone.
+
+Where there's no /proc (e.g. not Linux) we use lsof like before.
+'''
+import os
+import time
+import socket
+import struct
+
+import txtorcon
+
+
+class ProcessIndex(object):
+    """
+    Maps (address, port) of the local end of a TCP connection to the
+    PID of the process that has it open.
+    """
+
+    def __init__(self, ttl=2.0, proc='/proc', clock=time.monotonic):
+        self._ttl = ttl
+        self._proc = proc
+        self._clock = clock
+        #: local address (as in /proc/net/tcp) -> socket inode
+        self._sockets = {}
+        self._sockets_at = None
+        #: socket inode -> PID
+        self._owners = {}
+        #: PIDs whose fds we've looked at
+        self._pids = set()
+        #: socket inodes that were open when we last looked through
+        #: every process (so if we don't know who owns one of these,
+        #: we can't see it)
+        self._scanned = set()
+        #: PID -> path of its executable
+        self._executables = {}
+
+    @classmethod
+    def available(cls, proc='/proc'):
+        return os.path.exists(os.path.join(proc, 'net', 'tcp'))
+
+    def lookup(self, addr, port):
+        """
+        :returns: the PID whose socket has local address `addr`:`port`,
+            or None.
+        """
+        try:
+            keys = _socket_keys(str(addr), int(port))
+        except (ValueError, OSError):
+            return None
+        now = self._clock()
+        if self._sockets_at is None or now - self._sockets_at > self._ttl:
+            self._read_sockets(now)
+        inode = self._find(keys)
+        if inode is None:
+            # maybe a connection since we last looked; only a fresh
+            # read can say it isn't there
+            self._read_sockets(now)
+            inode = self._find(keys)
+            if inode is None:
+                return None
+        pid = self._owners.get(inode)
+        if pid is not None:
+            return pid
+        # a new socket: most likely from a process that already has
+        # some, else from a new process
+        self._scan_fds(set(self._owners.values()))
+        pid = self._owners.get(inode)
+        if pid is None:
+            self._scan_fds(self._new_pids())
+            pid = self._owners.get(inode)
+        if pid is None and inode not in self._scanned:
+            # look through everything; if it still isn't there, it's
+            # a process we can't see, and looking again won't help
+            self._scanned = set(self._sockets.values())
+            self._owners = {}
+            self._pids = set()
+            self._scan_fds(self._new_pids())
+            pid = self._owners.get(inode)
+        return pid
+
+    def executable(self, pid):
+        """
+        :returns: the path of `pid`'s executable (or None).
+        """
+        try:
+            return self._executables[pid]
+        except KeyError:
+            pass
+        try:
+            exe = os.readlink(os.path.join(self._proc, str(pid), 'exe'))
+        except OSError:
+            exe = None
+        if len(self._executables) > 4096:
+            # PIDs get re-used; don't remember them forever
+            self._executables.clear()
+        self._executables[pid] = exe
+        return exe
+
+    def _find(self, keys):
+        for key in keys:
+            inode = self._sockets.get(key)
+            if inode is not None:
+                return inode
+        return None
+
+    def _read_sockets(self, now):
+        # keyed by the local address exactly as the kernel writes it,
+        # so there's nothing to decode for each line
+        sockets = {}
+        for name in ('tcp', 'tcp6'):
+            try:
+                with open(os.path.join(self._proc, 'net', name)) as f:
+                    next(f)
+                    for line in f:
+                        fields = line.split(None, 10)
+                        if len(fields) < 10 or fields[9] == '0':
+                            # e.g. TIME_WAIT; nobody has it open
+                            continue
+                        sockets[fields[1]] = int(fields[9])
+            except (IOError, StopIteration):
+                continue
+        self._sockets = sockets
+        self._sockets_at = now
+        # forget the owners of closed sockets
+        live = set(sockets.values())
+        self._owners = {inode: pid for inode, pid in self._owners.items() if inode in live}
+        self._scanned &= live
+
+    def _new_pids(self):
+        try:
+            entries = os.listdir(self._proc)
+        except OSError:
+            return []
+        pids = set(int(e) for e in entries if e.isdigit())
+        # (a re-used PID counts as new)
+        self._pids &= pids
+        return [pid for pid in pids if pid not in self._pids]
+
+    def _scan_fds(self, pids):
+        for pid in pids:
+            self._pids.add(pid)
+            fd_dir = os.path.join(self._proc, str(pid), 'fd')
+            try:
+                fds = os.listdir(fd_dir)
+            except OSError:
+                # gone, or not ours to look at
+                continue
+            for fd in fds:
+                try:
+                    target = os.readlink(os.path.join(fd_dir, fd))
+                except OSError:
+                    # closed since we listed them
+                    continue
+                if target.startswith('socket:['):
+                    self._owners[int(target[8:-1])] = pid
+
+
+def _socket_keys(addr, port):
+    """
+    :returns: how /proc/net/tcp (or tcp6) would write local address
+        `addr`:`port` -- each 32-bit word of the address in host order,
+        in hex. An IPv4 address may also be in tcp6, IPv4-mapped.
+    """
+    port = ':{:04X}'.format(port)
+    if ':' in addr:
+        words = struct.unpack('=4I', socket.inet_pton(socket.AF_INET6, addr))
+        return [''.join('{:08X}'.format(w) for w in words) + port]
+    packed = socket.inet_aton(addr)
+    mapped = struct.unpack('=4I', b'\0' * 10 + b'\xff\xff' + packed)
+    return [
+        '{:08X}'.format(struct.unpack('=I', packed)[0]) + port,
+        ''.join('{:08X}'.format(w) for w in mapped) + port,
+    ]
+
+
+_index = None
+
+
+def process_index():
+    """
+    :returns: the ProcessIndex shared by everything in this process,
+        or None if there's no /proc to read.
+    """
+    global _index
+    if _index is None:
+        _index = ProcessIndex() if ProcessIndex.available() else False
+    return _index or None
+
+
+def process_from_address(addr, port, state=None):
+    """
+    Like txtorcon.util.process_from_address (same arguments and
+    result), but using the shared ProcessIndex where there is a /proc.
+    """
+    if addr is None:
+        return None
+    if str(addr).lower() == '(tor_internal)':
+        if state is None:
+            return None
+        return int(state.tor_pid)
+    index = process_index()
+    if index is None:
+        try:
+            return txtorcon.util.process_from_address(addr, port, state)
+        except OSError:
+            # no lsof
+            return None
+    return index.lookup(addr, port)
+
+
+def executable(pid):
+    """
+    :returns: the path of the executable of process `pid` (or None).
+    """
+    index = process_index()
+    if index is None:
+        return os.path.realpath('/proc/{}/exe'.format(pid))
+    return index.executable(pid)
@@ -0,0 +1,164 @@
+'''
+Per-phase timing for the command runner (the global --profile option).
+
+_run_command() goes through several phases (resolving the endpoint,
+connecting, authenticating, creating the TorState, running the command
+itself); PhaseProfiler records the wall-clock time and the memory
+allocated during each one, and can also run cProfile over the command
+body.
+'''
+import sys
+import time
+import cProfile
+import tracemalloc
+import contextlib
+
+from zope.interface import implementer
+from twisted.internet.interfaces import IStreamClientEndpoint
+
+
+class _Phase(object):
+    __slots__ = ('name', 'depth', 'start', 'elapsed', 'allocated')
+
+    def __init__(self, name, depth):
+        self.name = name
+        self.depth = depth
+        self.start = time.perf_counter()
+        self.elapsed = None
+        self.allocated = None
+
+
+class PhaseProfiler(object):
+    """
+    Records named (possibly nested) phases. Use phase() as a context
+    manager -- including around an ``await`` -- or wrap() a
+    coroutine-function.
+
+    :param pstats_path: if not None, cProfile the "command" phase and
+        dump the stats here (see the stdlib pstats module).
+    """
+
+    def __init__(self, pstats_path=None):
+        self._pstats_path = pstats_path
+        self._phases = []
+        self._depth = 0
+        self._cprofile = None
+        self._start = time.perf_counter()
+        tracemalloc.start()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        phase = _Phase(name, self._depth)
+        self._phases.append(phase)
+        self._depth += 1
+        allocated_before = tracemalloc.get_traced_memory()[0]
+        if name == 'command' and self._pstats_path is not None:
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+        try:
+            yield
+        finally:
+            if self._cprofile is not None and name == 'command':
+                self._cprofile.disable()
+            phase.elapsed = time.perf_counter() - phase.start
+            phase.allocated = tracemalloc.get_traced_memory()[0] - allocated_before
+            self._depth -= 1
+
+    def record(self, name, start, elapsed):
+        """
+        Add a phase we timed ourselves (e.g. from callbacks), nested
+        inside whatever phase is current.
+        """
+        phase = _Phase(name, self._depth)
+        phase.start = start
+        phase.elapsed = elapsed
+        phase.allocated = 0
+        self._phases.append(phase)
+
+    def timed_endpoint(self, name, endpoint):
+        """
+        :returns: a client endpoint like `endpoint` whose connect()s
+            are recorded as phase `name`.
+        """
+        if endpoint is None:
+            return None
+        return _TimedEndpoint(self, name, endpoint)
+
+    def wrap(self, name, async_fn):
+        """
+        :returns: a coroutine-function calling `async_fn` inside a
+            phase called `name`.
+        """
+        async def wrapper(*args, **kw):
+            with self.phase(name):
+                return await async_fn(*args, **kw)
+        return wrapper
+
+    def report(self, out=None):
+        if out is None:
+            out = sys.stderr
+        total = time.perf_counter() - self._start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        print("Profile (wall-clock time, memory allocated):", file=out)
+        for phase in sorted(self._phases, key=lambda p: p.start):
+            if phase.elapsed is None:
+                # never finished; e.g. the command was interrupted
+                phase.elapsed = time.perf_counter() - phase.start
+                phase.allocated = 0
+            print(
+                "  {:<24} {:9.1f}ms {:>10}".format(
+                    ('  ' * phase.depth) + phase.name,
+                    phase.elapsed * 1000.0,
+                    _kib(phase.allocated),
+                ),
+                file=out,
+            )
+        print("  {:<24} {:9.1f}ms {:>10} peak".format('total', total * 1000.0, _kib(peak)), file=out)
+
+        if self._cprofile is not None:
+            self._cprofile.dump_stats(self._pstats_path)
+            print("  cProfile stats for the command written to {}".format(self._pstats_path), file=out)
+
+
+@implementer(IStreamClientEndpoint)
+class _TimedEndpoint(object):
+
+    def __init__(self, profiler, name, endpoint):
+        self._profiler = profiler
+        self._name = name
+        self._endpoint = endpoint
+
+    def connect(self, factory):
+        start = time.perf_counter()
+
+        def _connected(proto):
+            self._profiler.record(self._name, start, time.perf_counter() - start)
+            return proto
+        d = self._endpoint.connect(factory)
+        d.addCallback(_connected)
+        return d
+
+
+class NullProfiler(object):
+    """
+    Does nothing, for when --profile isn't given.
+    """
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        yield
+
+    def timed_endpoint(self, name, endpoint):
+        return endpoint
+
+    def wrap(self, name, async_fn):
+        return async_fn
+
+    def report(self, out=None):
+        pass
+
+
+def _kib(nbytes):
+    return '{:.1f}KiB'.format(nbytes / 1024.0)
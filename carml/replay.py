@@ -0,0 +1,305 @@
+'''
+Replays a control-protocol capture (see capture.py) into a real
+txtorcon TorControlProtocol, so that commands can be run -- and
+profiled -- against a recorded session instead of a live Tor.
+
+Each command we're sent is answered with the reply Tor gave to the
+same command in the capture. The asynchronous (650) events are played
+back once the command has subscribed to something: either as fast as
+the listeners can take them, or with their original timing.
+'''
+import sys
+import time
+import collections
+
+from zope.interface import implementer
+from twisted.internet import defer
+from twisted.internet.interfaces import ITransport
+from twisted.internet.error import ConnectionDone
+from twisted.python.failure import Failure
+import txtorcon
+
+from carml.capture import read_capture, TO_TOR
+
+
+#: how many events we deliver per reactor turn when not in real time
+BATCH_SIZE = 256
+
+# txtorcon sends these while connecting, which is before a capture
+# starts, so they're usually not in it
+_DEFAULT_REPLIES = (
+    ('PROTOCOLINFO', b'250-PROTOCOLINFO 1\r\n250-AUTH METHODS=NULL\r\n250-VERSION Tor="0.0.0"\r\n250 OK\r\n'),
+    ('GETINFO signal/names', b'250-signal/names=RELOAD DUMP DEBUG NEWNYM CLEARDNSCACHE\r\n250 OK\r\n'),
+    ('GETINFO version', b'250-version=0.0.0 (replay)\r\n250 OK\r\n'),
+    ('GETINFO ns/all', b'250+ns/all=\r\n.\r\n250 OK\r\n'),
+)
+
+_ALL_EVENTS = (
+    'CIRC STREAM ORCONN BW DEBUG INFO NOTICE WARN ERR NEWDESC ADDRMAP '
+    'DESCCHANGED STATUS_GENERAL STATUS_CLIENT STATUS_SERVER GUARD NS '
+    'STREAM_BW CLIENTS_SEEN NEWCONSENSUS BUILDTIMEOUT_SET SIGNAL '
+    'CONF_CHANGED CIRC_MINOR TRANSPORT_LAUNCHED CONN_BW CIRC_BW CELL_STATS '
+    'HS_DESC HS_DESC_CONTENT NETWORK_LIVENESS'
+)
+
+
+class _MessageSplitter(object):
+    """
+    Reassembles chunks of data from Tor into complete replies or
+    events (including any "+" data-blocks).
+    """
+
+    def __init__(self):
+        self._partial = b''
+        self._lines = []
+        self._in_data = False
+
+    def feed(self, data):
+        data = self._partial + data
+        lines = data.split(b'\r\n')
+        self._partial = lines.pop()
+        messages = []
+        for line in lines:
+            self._lines.append(line)
+            if self._in_data:
+                if line == b'.':
+                    self._in_data = False
+                continue
+            if line[3:4] == b'+':
+                self._in_data = True
+            elif line[3:4] in (b' ', b''):
+                messages.append(b'\r\n'.join(self._lines) + b'\r\n')
+                self._lines = []
+        return messages
+
+
+class _CommandSplitter(object):
+    """
+    Reassembles chunks of data sent to Tor into complete commands
+    (as text, without the final newline).
+    """
+
+    def __init__(self):
+        self._partial = b''
+        self._lines = []
+        self._in_data = False
+
+    def feed(self, data):
+        data = self._partial + data
+        lines = data.split(b'\r\n')
+        self._partial = lines.pop()
+        commands = []
+        for line in lines:
+            self._lines.append(line)
+            if self._in_data:
+                if line != b'.':
+                    continue
+                self._in_data = False
+            elif line.startswith(b'+'):
+                self._in_data = True
+                continue
+            commands.append(b'\r\n'.join(self._lines).decode('utf8', 'replace'))
+            self._lines = []
+        return commands
+
+
+class ReplaySession(object):
+    """
+    The replies and events found in a capture file.
+
+    :ivar replies: maps a command to the list of replies Tor gave to
+        it, in order.
+
+    :ivar events: list of (timestamp, data) for every 650 event.
+    """
+
+    def __init__(self, records):
+        commands = []
+        replies = []
+        self.events = []
+        to_tor = _CommandSplitter()
+        from_tor = _MessageSplitter()
+        for timestamp, direction, data in records:
+            if direction == TO_TOR:
+                commands.extend(to_tor.feed(data))
+            else:
+                for msg in from_tor.feed(data):
+                    if msg.startswith(b'650'):
+                        self.events.append((timestamp, msg))
+                    else:
+                        replies.append(msg)
+
+        # Tor replies in order, so the Nth reply goes with the Nth
+        # command -- except that a reply to something sent just before
+        # capturing started has no command
+        if len(replies) > len(commands):
+            replies = replies[len(replies) - len(commands):]
+        self.replies = collections.defaultdict(list)
+        for command, reply in zip(commands, replies):
+            self.replies[command].append(reply)
+
+        if 'GETINFO events/names' not in self.replies:
+            names = set(_ALL_EVENTS.split())
+            names.update(_event_name(msg) for _, msg in self.events)
+            self.replies['GETINFO events/names'].append(
+                '250-events/names={}\r\n250 OK\r\n'.format(' '.join(sorted(names))).encode('ascii')
+            )
+
+    @classmethod
+    def from_file(cls, f):
+        return cls(read_capture(f))
+
+
+def _event_name(msg):
+    return msg[4:msg.find(b' ', 4)].decode('ascii')
+
+
+@implementer(ITransport)
+class ReplayTransport(object):
+    """
+    Stands in for the TCP connection to Tor: commands written to us
+    are answered from `session`, and once a command subscribes to
+    events we play them all back and then fire `.done`.
+
+    :param realtime: if True, keep the time between events as it was
+        (divided by `speed`) instead of going as fast as possible.
+    """
+
+    disconnecting = False
+
+    def __init__(self, reactor, session, realtime=False, speed=1.0):
+        self.protocol = None
+        self.done = defer.Deferred()
+        self._reactor = reactor
+        self._session = session
+        self._realtime = realtime
+        self._speed = speed
+        self._replies = {
+            command: collections.deque(replies)
+            for command, replies in session.replies.items()
+        }
+        self._commands = _CommandSplitter()
+        self._pending = 0
+        self._feeding = False
+        self._next = 0
+        self._started = None
+        self._finished = None
+        self._busy = 0.0
+        self._counts = collections.Counter()
+
+    def write(self, data):
+        for command in self._commands.feed(data):
+            self._pending += 1
+            self._reactor.callLater(0, self._deliver, self._reply_to(command))
+            if command.startswith('SETEVENTS') and not self._feeding:
+                self._feeding = True
+                self._reactor.callLater(0, self._maybe_start)
+
+    def writeSequence(self, seq):
+        self.write(b''.join(seq))
+
+    def loseConnection(self):
+        self.disconnecting = True
+        self._reactor.callLater(0, self.protocol.connectionLost, Failure(ConnectionDone()))
+
+    abortConnection = loseConnection
+
+    def getPeer(self):
+        return None
+
+    def getHost(self):
+        return None
+
+    def _reply_to(self, command):
+        replies = self._replies.get(command)
+        if replies:
+            # we keep re-using the last answer if asked again
+            return replies.popleft() if len(replies) > 1 else replies[0]
+        for prefix, reply in _DEFAULT_REPLIES:
+            if command.startswith(prefix):
+                return reply
+        if command.startswith('GETINFO'):
+            return '552 Unrecognized key "{}" (not in capture)\r\n'.format(command[8:]).encode('utf8')
+        return b'250 OK\r\n'
+
+    def _deliver(self, reply):
+        self._pending -= 1
+        self.protocol.dataReceived(reply)
+
+    def _maybe_start(self):
+        # the first SETEVENTS is often from creating a TorState; wait
+        # until the command has finished setting up (i.e. no commands
+        # are outstanding) so it sees the events from the start
+        proto = self.protocol
+        if self._pending or proto.command is not None or proto.commands:
+            self._reactor.callLater(0, self._maybe_start)
+            return
+        self._started = time.perf_counter()
+        self._feed()
+
+    def _feed(self):
+        events = self._session.events
+        if self._realtime:
+            elapsed = (time.perf_counter() - self._started) * self._speed
+            first = events[0][0] if events else 0.0
+            end = self._next
+            while end < len(events) and events[end][0] - first <= elapsed:
+                end += 1
+        else:
+            end = min(self._next + BATCH_SIZE, len(events))
+
+        if end > self._next:
+            batch = events[self._next:end]
+            for _, msg in batch:
+                self._counts[_event_name(msg)] += 1
+            start = time.perf_counter()
+            self.protocol.dataReceived(b''.join(msg for _, msg in batch))
+            self._busy += time.perf_counter() - start
+            self._next = end
+
+        if self._next >= len(events):
+            self._finished = time.perf_counter()
+            self.done.callback(self)
+        elif self._realtime:
+            delay = (events[self._next][0] - events[0][0]) / self._speed
+            delay -= time.perf_counter() - self._started
+            self._reactor.callLater(max(0.0, delay), self._feed)
+        else:
+            self._reactor.callLater(0, self._feed)
+
+    def report(self, out=None):
+        if out is None:
+            out = sys.stderr
+        if self._started is None:
+            print("Replay: the command never subscribed to any events.", file=out)
+            return
+        total = sum(self._counts.values())
+        wall = (self._finished or time.perf_counter()) - self._started
+        print(
+            "Replayed {} events in {:.3f}s ({:.0f} events/second).".format(
+                total, wall, total / wall if wall else 0.0,
+            ),
+            file=out,
+        )
+        print(
+            "Listeners were busy for {:.3f}s ({:.0f} events/second sustained).".format(
+                self._busy, total / self._busy if self._busy else 0.0,
+            ),
+            file=out,
+        )
+        for name, count in self._counts.most_common():
+            print("  {:<20} {:>9}".format(name, count), file=out)
+
+
+async def connect(reactor, transport):
+    """
+    Like txtorcon.connect() but to a ReplayTransport instead of a
+    real Tor.
+
+    :returns: a txtorcon.Tor instance
+    """
+    proto = txtorcon.TorControlProtocol()
+    transport.protocol = proto
+    proto.makeConnection(transport)
+    await proto.post_bootstrap
+    return txtorcon.Tor(reactor, proto)
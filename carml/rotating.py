@@ -0,0 +1,142 @@
+'''
+Writing a stream of lines to files, for "events --output".
+
+Lines are collected in memory and written out in large chunks (when
+enough have piled up, or on a timer) so that an event costs a string
+append instead of a write() and a flush(). Optionally, output is split
+into segments -- a new file once one gets big or old enough -- and
+each segment can be compressed as it is written.
+'''
+import os
+import time
+import gzip
+
+
+#: file-name extension for each kind of compression
+EXTENSIONS = {
+    None: '',
+    'gzip': '.gz',
+    'zstd': '.zst',
+}
+
+
+def _open_compressed(path, compress):
+    """
+    :returns: a binary file-like object writing to `path`, compressed
+        with `compress` (one of EXTENSIONS).
+    """
+    if compress == 'gzip':
+        # a low level keeps up with a busy relay; it's text
+        return gzip.open(path, 'wb', compresslevel=5)
+    if compress == 'zstd':
+        import zstandard
+        return zstandard.ZstdCompressor(level=3).stream_writer(open(path, 'wb'))
+    return open(path, 'wb')
+
+
+class RotatingOutput(object):
+    """
+    Writes text lines to `path`.
+
+    If `max_bytes` or `max_age` is set, output goes to a series of
+    segment files named after `path` plus the time each one was
+    started (e.g. ``events.log.20240102-150405.gz``); a new segment is
+    started once the current one has `max_bytes` (before compression)
+    or is `max_age` seconds old. Otherwise everything goes to `path`.
+
+    :param compress: None, 'gzip' or 'zstd'.
+
+    :param buffer_size: write to the file once this many bytes are
+        waiting.
+
+    :param reactor: if not None, we also write out every
+        `flush_interval` seconds (and check `max_age`).
+    """
+
+    def __init__(self, path, max_bytes=None, max_age=None, compress=None,
+                 buffer_size=256 * 1024, reactor=None, flush_interval=1.0):
+        self._path = path
+        self._max_bytes = max_bytes
+        self._max_age = max_age
+        self._compress = compress
+        self._buffer_size = buffer_size
+        self._rotating = max_bytes is not None or max_age is not None
+        self._pending = []
+        self._size = 0
+        self._loop = None
+        self._f = None
+        self._started = None
+        self._written = 0
+        self.closed = False
+        #: the files we've written to, oldest first
+        self.segments = []
+        self._open_segment()
+        if reactor is not None:
+            from twisted.internet import task
+            self._loop = task.LoopingCall(self._tick)
+            self._loop.clock = reactor
+            self._loop.start(flush_interval, now=False)
+            # e.g. SIGINT or SIGTERM stop the reactor without our
+            # caller getting a chance to close() us
+            reactor.addSystemEventTrigger('before', 'shutdown', self.close)
+
+    def write(self, text):
+        self._pending.append(text)
+        self._size += len(text)
+        if self._size >= self._buffer_size:
+            self._write_pending()
+
+    def flush(self):
+        self._write_pending()
+        # for a compressed file this ends a block, so we don't do it
+        # every time we write
+        self._f.flush()
+
+    def _write_pending(self, rotate=True):
+        if self._pending:
+            data = ''.join(self._pending).encode('utf8')
+            self._pending = []
+            self._size = 0
+            self._f.write(data)
+            self._written += len(data)
+        if rotate and self._max_bytes is not None and self._written >= self._max_bytes:
+            self._rotate()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
+        self._write_pending(rotate=False)
+        self._f.close()
+
+    def _tick(self):
+        self.flush()
+        if self._max_age is not None and time.time() - self._started >= self._max_age:
+            if self._written:
+                self._rotate()
+
+    def _rotate(self):
+        self._f.close()
+        self._open_segment()
+
+    def _segment_path(self):
+        ext = EXTENSIONS[self._compress]
+        if not self._rotating:
+            return self._path
+        stamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(self._started))
+        path = '{}.{}{}'.format(self._path, stamp, ext)
+        # more than one segment a second
+        serial = 1
+        while os.path.exists(path):
+            path = '{}.{}.{}{}'.format(self._path, stamp, serial, ext)
+            serial += 1
+        return path
+
+    def _open_segment(self):
+        self._started = time.time()
+        self._written = 0
+        path = self._segment_path()
+        self._f = _open_compressed(path, self._compress)
+        self.segments.append(path)
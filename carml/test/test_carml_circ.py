@@ -0,0 +1,66 @@
+import io
+import sys
+import json
+
+import txtorcon
+from twisted.internet import defer
+from twisted.trial import unittest
+from zope.interface import implementer
+
+from carml.carml_circ import _JsonCircuitListener
+
+
+@implementer(txtorcon.interface.IRouterContainer)
+class Routers(object):
+
+    def router_from_id(self, routerid):
+        raise KeyError(routerid)
+
+
+class JsonCircuitListenerTests(unittest.TestCase):
+    """
+    Feed CIRC events through a txtorcon Circuit, as TorState does.
+    """
+
+    def setUp(self):
+        self.out = io.StringIO()
+        self.patch(sys, 'stdout', self.out)
+        self.done = defer.Deferred()
+        self.circuit = txtorcon.Circuit(Routers())
+        self.circuit.update('17 LAUNCHED PURPOSE=GENERAL'.split())
+        self.circuit.listen(_JsonCircuitListener(17, self.done))
+
+    def records(self):
+        return [json.loads(line) for line in self.out.getvalue().splitlines()]
+
+    def test_failed(self):
+        self.circuit.update('17 FAILED PURPOSE=GENERAL REASON=TIMEOUT REMOTE_REASON=DESTROYED'.split())
+        [record] = self.records()
+        self.assertEqual('failed', record['event'])
+        self.assertEqual('TIMEOUT', record['reason'])
+        self.assertEqual('DESTROYED', record['remote_reason'])
+        self.failureResultOf(self.done, RuntimeError)
+
+    def test_closed(self):
+        self.circuit.update('17 CLOSED PURPOSE=GENERAL REASON=REQUESTED'.split())
+        [record] = self.records()
+        self.assertEqual('closed', record['event'])
+        self.assertEqual('REQUESTED', record['reason'])
+        self.successResultOf(self.done)
+
+    def test_other_circuit(self):
+        other = txtorcon.Circuit(Routers())
+        other.update('18 LAUNCHED'.split())
+        other.listen(_JsonCircuitListener(17, self.done))
+        other.update('18 FAILED REASON=TIMEOUT'.split())
+        self.assertEqual([], self.records())
+        self.assertNoResult(self.done)
+
+    def test_upper_case_keywords_only(self):
+        # the ICircuitListener keywords are Tor's own (upper-case) ones
+        self.circuit.state = 'FAILED'
+        _JsonCircuitListener(17, self.done).circuit_failed(self.circuit, REASON='TIMEOUT', REMOTE_REASON='DESTROYED')
+        [record] = self.records()
+        self.assertEqual('TIMEOUT', record['reason'])
+        self.assertEqual('DESTROYED', record['remote_reason'])
+        self.failureResultOf(self.done, RuntimeError)
@@ -0,0 +1,94 @@
+from twisted.trial import unittest
+
+from carml.carml_stream import StreamBandwidth, _Ring
+
+
+class RingTests(unittest.TestCase):
+
+    def test_buckets(self):
+        ring = _Ring(1, 4)
+        ring.add(100.2, 1, 10)
+        ring.add(100.7, 1, 10)
+        ring.add(102.0, 5, 50)
+        self.assertEqual([(99, 0, 0), (100, 2, 20), (101, 0, 0), (102, 5, 50)], list(ring.items()))
+
+    def test_overwrites_oldest(self):
+        ring = _Ring(1, 4)
+        for n in range(6):
+            ring.add(100 + n, n, 0)
+        self.assertEqual([(102, 2, 0), (103, 3, 0), (104, 4, 0), (105, 5, 0)], list(ring.items()))
+
+    def test_long_gap(self):
+        ring = _Ring(1, 4)
+        ring.add(100, 1, 1)
+        ring.add(1000, 2, 2)
+        self.assertEqual([(997, 0, 0), (998, 0, 0), (999, 0, 0), (1000, 2, 2)], list(ring.items()))
+
+    def test_out_of_order(self):
+        ring = _Ring(1, 4)
+        ring.add(105, 1, 0)
+        ring.add(103, 2, 0)
+        # too old
+        ring.add(101, 4, 0)
+        self.assertEqual([(102, 0, 0), (103, 2, 0), (104, 0, 0), (105, 1, 0)], list(ring.items()))
+
+    def test_since(self):
+        ring = _Ring(60, 4)
+        ring.add(0, 1, 10)
+        ring.add(60, 2, 20)
+        ring.add(150, 4, 40)
+        self.assertEqual((6, 60), ring.since(60))
+        self.assertEqual((7, 70), ring.since(0))
+
+
+class StreamBandwidthTests(unittest.TestCase):
+
+    def test_empty(self):
+        bw = StreamBandwidth()
+        self.assertEqual(0.0, bw.duration())
+        self.assertEqual((0.0, 0.0), bw.rate())
+        self.assertEqual((0, 0), bw.recent(10))
+
+    def test_totals(self):
+        bw = StreamBandwidth()
+        for n in range(10):
+            bw.add_bandwidth(1000 + n, 100, 10)
+        self.assertEqual(1000, bw.bytes_read())
+        self.assertEqual(100, bw.bytes_written())
+        self.assertEqual(10.0, bw.duration())
+        self.assertEqual((100.0, 10.0), bw.rate())
+
+    def test_one_event(self):
+        bw = StreamBandwidth()
+        bw.add_bandwidth(1000, 100, 10)
+        self.assertEqual(1.0, bw.duration())
+        self.assertEqual((100.0, 10.0), bw.rate())
+
+    def test_short_stream_one_tier(self):
+        bw = StreamBandwidth()
+        for n in range(StreamBandwidth.TIERS[0][1] - 1):
+            bw.add_bandwidth(1000 + n, 1, 1)
+        self.assertEqual(1, len(bw._tiers))
+
+    def test_tiers_added(self):
+        bw = StreamBandwidth()
+        for n in range(0, 2 * 60 * 60, 5):
+            bw.add_bandwidth(n, 1, 2)
+        self.assertEqual(len(StreamBandwidth.TIERS), len(bw._tiers))
+        # nothing lost in rolling up (the stream is younger than the
+        # coarsest tier)
+        total_read = sum(r for _, r, _ in bw._tiers[-1].items())
+        total_written = sum(w for _, _, w in bw._tiers[-1].items())
+        self.assertEqual((bw.read, bw.written), (total_read, total_written))
+
+    def test_recent(self):
+        bw = StreamBandwidth()
+        for n in range(600):
+            bw.add_bandwidth(n, 10, 1)
+        # from the one-second tier
+        self.assertEqual((10, 1), bw.recent(1))
+        self.assertEqual((50, 5), bw.recent(5))
+        # from the one-minute tier
+        self.assertEqual((3000, 300), bw.recent(300))
+        # as far back as we have
+        self.assertEqual((6000, 600), bw.recent(24 * 60 * 60))
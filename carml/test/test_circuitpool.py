@@ -0,0 +1,152 @@
+import time
+
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+from carml.circuitpool import CircuitPool
+
+
+class FakeCircuit(object):
+
+    def __init__(self, circ_id, state='LAUNCHED'):
+        self.id = circ_id
+        self.state = state
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+        self.state = 'CLOSED'
+        return defer.succeed(None)
+
+
+class FakeState(object):
+
+    def __init__(self):
+        self.listeners = []
+
+    def add_circuit_listener(self, listener):
+        self.listeners.append(listener)
+
+
+class CircuitPoolTests(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.state = FakeState()
+        self.launched = []
+        self.now = 1000.0
+        self.patch(time, 'time', lambda: self.now)
+
+    def build(self):
+        circ = FakeCircuit(len(self.launched) + 1)
+        self.launched.append(circ)
+        return defer.succeed(circ)
+
+    def built(self, pool, circ):
+        circ.state = 'BUILT'
+        pool.circuit_built(circ)
+
+    def pool(self, size, **kw):
+        pool = CircuitPool(self.state, self.clock, size, build=self.build, **kw)
+        pool.start()
+        return pool
+
+    def test_fills(self):
+        pool = self.pool(3)
+        self.assertEqual(3, len(self.launched))
+        self.assertEqual(0, len(pool))
+        for circ in self.launched:
+            self.built(pool, circ)
+        self.assertEqual(3, len(pool))
+        self.assertEqual(3, pool.built)
+
+    def test_take_spare(self):
+        pool = self.pool(2)
+        self.built(pool, self.launched[0])
+        self.assertIs(self.launched[0], self.successResultOf(pool.take()))
+        # a replacement is on its way
+        self.assertEqual(3, len(self.launched))
+
+    def test_take_waits(self):
+        pool = self.pool(1)
+        d = pool.take()
+        self.assertNoResult(d)
+        self.built(pool, self.launched[1])
+        self.assertIs(self.launched[1], self.successResultOf(d))
+
+    def test_take_skips_closed(self):
+        pool = self.pool(2)
+        self.built(pool, self.launched[0])
+        self.built(pool, self.launched[1])
+        self.launched[0].state = 'CLOSED'
+        self.assertIs(self.launched[1], self.successResultOf(pool.take()))
+
+    def test_max_age(self):
+        pool = self.pool(1, max_age=60)
+        self.built(pool, self.launched[0])
+        self.now += 61
+        d = pool.take()
+        self.assertTrue(self.launched[0].closed)
+        self.assertNoResult(d)
+
+    def test_take_matching(self):
+        pool = self.pool(2)
+        self.built(pool, self.launched[0])
+        self.built(pool, self.launched[1])
+        self.assertIsNone(pool.take_matching(lambda c: c.id == 5))
+        self.assertIs(self.launched[1], pool.take_matching(lambda c: c.id == 2))
+        self.assertEqual(1, len(pool))
+
+    def test_spare_closed(self):
+        pool = self.pool(1)
+        self.built(pool, self.launched[0])
+        pool.circuit_closed(self.launched[0], REASON='FINISHED')
+        self.assertEqual(0, len(pool))
+        self.assertEqual(2, len(self.launched))
+
+    def test_pending_failed(self):
+        pool = self.pool(1)
+        pool.circuit_failed(self.launched[0], REASON='TIMEOUT')
+        self.assertEqual(1, pool.failed)
+        # not straight away
+        self.assertEqual(1, len(self.launched))
+        self.clock.advance(CircuitPool.RETRY_DELAY)
+        self.assertEqual(2, len(self.launched))
+
+    def test_build_failed(self):
+        fail = [True]
+
+        def build():
+            if fail[0]:
+                return defer.fail(RuntimeError("no"))
+            return self.build()
+        logged = []
+        pool = CircuitPool(self.state, self.clock, 2, build=build, log=logged.append)
+        pool.start()
+        # one try, then wait before the next
+        self.assertEqual(1, pool.failed)
+        self.assertEqual(["Failed to build a circuit: no"], logged)
+        self.assertEqual(1, len(self.clock.getDelayedCalls()))
+        fail[0] = False
+        self.clock.advance(CircuitPool.RETRY_DELAY)
+        self.assertEqual(2, len(self.launched))
+
+    def test_release(self):
+        pool = self.pool(1)
+        circ = self.launched[0]
+        self.built(pool, circ)
+        pool.release(self.successResultOf(pool.take()))
+        self.assertTrue(circ.closed)
+
+    def test_stop(self):
+        pool = self.pool(1)
+        d = pool.take()
+        pool.stop()
+        self.failureResultOf(d, defer.CancelledError)
+
+    def test_ignores_other_circuits(self):
+        pool = self.pool(1)
+        pool.circuit_built(FakeCircuit(99, 'BUILT'))
+        pool.circuit_closed(FakeCircuit(98, 'CLOSED'))
+        self.assertEqual(0, len(pool))
+        self.assertEqual(0, pool.failed)
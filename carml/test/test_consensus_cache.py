@@ -0,0 +1,120 @@
+import os
+
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from carml import consensus_cache
+
+
+VALID_AFTER = '2024-01-01 12:00:00'
+
+KW = dict(
+    nickname='relay', idhash='AAAA', orhash='BBBB', modified='2024-01-01 11:00:00',
+    ip='10.0.0.1', orport=9001, dirport=0, flags=['Fast', 'Running'], bandwidth=1000,
+)
+
+
+class FakeProtocol(object):
+
+    def __init__(self):
+        self.asked = []
+
+    def get_info_incremental(self, key, line_cb):
+        self.asked.append(key)
+        return defer.succeed('')
+
+
+class RecordTests(unittest.TestCase):
+
+    def test_round_trip(self):
+        record = consensus_cache._record_from_kw(KW)
+        self.assertEqual(KW, consensus_cache._kw_from_record(record))
+
+    def test_ipv6(self):
+        kw = dict(KW, ip_v6=['[::1]:9001'])
+        del kw['bandwidth']
+        self.assertEqual(kw, consensus_cache._kw_from_record(consensus_cache._record_from_kw(kw)))
+
+
+class SnapshotFileTests(unittest.TestCase):
+
+    def setUp(self):
+        self.path = os.path.join(os.path.abspath(self.mktemp()), 'routers.snapshot')
+        self.records = [consensus_cache._record_from_kw(KW)] * 3
+
+    def test_save_and_load(self):
+        consensus_cache.save_routers(self.path, VALID_AFTER, self.records)
+        self.assertEqual(self.records, consensus_cache.load_routers(self.path, VALID_AFTER))
+        self.assertEqual(0o700, os.stat(os.path.dirname(self.path)).st_mode & 0o777)
+        # no temporary file left behind
+        self.assertEqual(['routers.snapshot'], os.listdir(os.path.dirname(self.path)))
+
+    def test_different_consensus(self):
+        consensus_cache.save_routers(self.path, VALID_AFTER, self.records)
+        self.assertIsNone(consensus_cache.load_routers(self.path, '2024-01-01 13:00:00'))
+
+    def test_replaced(self):
+        consensus_cache.save_routers(self.path, VALID_AFTER, self.records)
+        consensus_cache.save_routers(self.path, '2024-01-01 13:00:00', self.records[:1])
+        self.assertEqual(self.records[:1], consensus_cache.load_routers(self.path, '2024-01-01 13:00:00'))
+
+    def test_missing(self):
+        self.assertIsNone(consensus_cache.load_routers(self.path, VALID_AFTER))
+
+    def test_empty(self):
+        os.makedirs(os.path.dirname(self.path))
+        open(self.path, 'wb').close()
+        self.assertIsNone(consensus_cache.load_routers(self.path, VALID_AFTER))
+
+    def test_not_a_snapshot(self):
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path, 'wb') as f:
+            f.write(b'something else entirely\n')
+        self.assertIsNone(consensus_cache.load_routers(self.path, VALID_AFTER))
+
+    def test_truncated(self):
+        consensus_cache.save_routers(self.path, VALID_AFTER, self.records)
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        with open(self.path, 'wb') as f:
+            f.write(data[:-10])
+        self.assertIsNone(consensus_cache.load_routers(self.path, VALID_AFTER))
+
+
+class ConsensusFromSnapshotTests(unittest.TestCase):
+
+    def test_answers_ns_all_once(self):
+        created = []
+        protocol = FakeProtocol()
+        proxy = consensus_cache._ConsensusFromSnapshot(
+            protocol, lambda **kw: created.append(kw), [consensus_cache._record_from_kw(KW)],
+        )
+        self.successResultOf(proxy.get_info_incremental('ns/all', None))
+        self.assertEqual([KW], created)
+        self.assertEqual([], protocol.asked)
+        # after that it's Tor's
+        proxy.get_info_incremental('ns/all', None)
+        self.assertEqual(['ns/all'], protocol.asked)
+
+    def test_no_records(self):
+        protocol = FakeProtocol()
+        proxy = consensus_cache._ConsensusFromSnapshot(protocol, None, None)
+        proxy.get_info_incremental('ns/all', None)
+        self.assertEqual(['ns/all'], protocol.asked)
+
+
+class SharedRecordsTests(unittest.TestCase):
+
+    def test_waiters(self):
+        shared = consensus_cache._SharedRecords()
+        d = shared.when_ready()
+        self.assertNoResult(d)
+        shared.ready(['record'])
+        self.assertEqual(['record'], self.successResultOf(d))
+        self.assertEqual(['record'], self.successResultOf(shared.when_ready()))
+
+    def test_failed(self):
+        shared = consensus_cache._SharedRecords()
+        d = shared.when_ready()
+        shared.ready(None)
+        self.assertIsNone(self.successResultOf(d))
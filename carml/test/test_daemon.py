@@ -0,0 +1,118 @@
+import os
+import socket
+import tempfile
+
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+from carml import cli
+from carml import carml_daemon
+from carml import daemon_client
+
+
+class Config(object):
+    connect = None
+    json = False
+
+
+class DaemonFactoryTests(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.factory = carml_daemon.DaemonFactory(self.clock, Config(), object(), object())
+
+    def answer(self, run):
+        self.patch(cli, '_command_runner', lambda name: run)
+        return defer.ensureDeferred(self.factory.answer({'command': 'circ', 'args': []}))
+
+    def test_output(self):
+        async def run(reactor, cfg, tor):
+            print("Circuits:")
+        reply = self.successResultOf(self.answer(run))
+        self.assertEqual({'output': 'Circuits:\n', 'error': None}, reply)
+
+    def test_error(self):
+        async def run(reactor, cfg, tor):
+            print("partly")
+            raise RuntimeError("no such circuit")
+        reply = self.successResultOf(self.answer(run))
+        self.assertEqual({'output': 'partly\n', 'error': 'no such circuit'}, reply)
+
+    def test_timeout_keeps_output(self):
+        async def run(reactor, cfg, tor):
+            print("Circuits:")
+            await defer.Deferred()
+        d = self.answer(run)
+        self.assertNoResult(d)
+        self.clock.advance(carml_daemon.REQUEST_TIMEOUT)
+        reply = self.successResultOf(d)
+        self.assertEqual('Circuits:\n', reply['output'])
+        self.assertIn('timed out', reply['error'])
+
+    def test_declined(self):
+        reply = self.successResultOf(defer.ensureDeferred(self.factory.answer({'command': 'events'})))
+        self.assertTrue(reply['declined'])
+
+
+class SocketPathTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = os.path.abspath(self.mktemp())
+        os.mkdir(self.tmp)
+        self.patch(tempfile, 'gettempdir', lambda: self.tmp)
+        self.patch(os, 'environ', {})
+
+    def test_runtime_dir(self):
+        os.environ['XDG_RUNTIME_DIR'] = '/run/user/1000'
+        self.assertEqual(
+            '/run/user/1000/carml-{}.sock'.format(os.getuid()),
+            daemon_client.default_socket_path(),
+        )
+
+    def test_private_dir(self):
+        path = daemon_client.default_socket_path()
+        self.assertEqual(daemon_client.private_dir(), os.path.dirname(path))
+        carml_daemon._make_private_dir(daemon_client.private_dir())
+        self.assertEqual(0o700, os.stat(daemon_client.private_dir()).st_mode & 0o777)
+
+    def test_private_dir_shared(self):
+        os.mkdir(daemon_client.private_dir(), 0o777)
+        os.chmod(daemon_client.private_dir(), 0o777)
+        self.assertRaises(RuntimeError, carml_daemon._make_private_dir, daemon_client.private_dir())
+
+    def test_private_dir_not_a_directory(self):
+        os.symlink(self.tmp, daemon_client.private_dir())
+        self.assertRaises(RuntimeError, carml_daemon._make_private_dir, daemon_client.private_dir())
+
+
+class QueryDaemonTests(unittest.TestCase):
+
+    def setUp(self):
+        directory = self.mktemp()
+        os.mkdir(directory)
+        self.path = os.path.join(directory, 'carml.sock')
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(self.path)
+        self.server.listen(1)
+        self.addCleanup(self.server.close)
+
+    def test_no_socket(self):
+        self.assertIsNone(daemon_client.query_daemon(self.path + '.missing', 'circ', []))
+
+    def test_ours(self):
+        self.assertTrue(daemon_client.is_ours(self.path))
+
+    def test_not_ours(self):
+        uid = os.getuid() + 1
+        self.patch(os, 'getuid', lambda: uid)
+        self.assertFalse(daemon_client.is_ours(self.path))
+        self.assertIsNone(daemon_client.query_daemon(self.path, 'circ', [], timeout=0.1))
+        # it didn't even connect
+        self.server.setblocking(False)
+        self.assertRaises(BlockingIOError, self.server.accept)
+
+    def test_not_a_socket(self):
+        path = self.path + '.txt'
+        with open(path, 'w') as f:
+            f.write('{}')
+        self.assertFalse(daemon_client.is_ours(path))
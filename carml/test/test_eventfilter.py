@@ -0,0 +1,88 @@
+from twisted.trial import unittest
+
+from carml.eventfilter import compile_filter, compile_filters, keyword_finder, FilterError
+
+
+CIRC = '12 BUILT $AAAA~a,$BBBB~b PURPOSE=HS_SERVICE_REND HS_STATE=HSSR_JOINED REND_QUERY=abc TIME_CREATED=2024-01-01T00:00:00.000000'
+STREAM = '7 NEW 0 www.example.com:443 SOURCE_ADDR=127.0.0.1:5432 PURPOSE=USER'
+QUOTED = 'NOTICE BOOTSTRAP PROGRESS=100 TAG=done SUMMARY="Done here"'
+
+
+class CompileFilterTests(unittest.TestCase):
+
+    def test_equals(self):
+        self.assertTrue(compile_filter('PURPOSE=HS_SERVICE_REND')('CIRC', CIRC))
+        self.assertFalse(compile_filter('PURPOSE=GENERAL')('CIRC', CIRC))
+
+    def test_equals_whole_value(self):
+        # not just a prefix of the value
+        self.assertFalse(compile_filter('PURPOSE=HS_SERVICE')('CIRC', CIRC))
+
+    def test_not_equals(self):
+        self.assertFalse(compile_filter('PURPOSE!=HS_SERVICE_REND')('CIRC', CIRC))
+        self.assertTrue(compile_filter('PURPOSE!=GENERAL')('CIRC', CIRC))
+
+    def test_key_case(self):
+        self.assertTrue(compile_filter('purpose=HS_SERVICE_REND')('CIRC', CIRC))
+
+    def test_quoted(self):
+        self.assertTrue(compile_filter('SUMMARY="Done here"')('STATUS_CLIENT', QUOTED))
+        self.assertTrue(compile_filter('SUMMARY~^Done')('STATUS_CLIENT', QUOTED))
+
+    def test_id_and_status(self):
+        self.assertTrue(compile_filter('ID=12')('CIRC', CIRC))
+        self.assertFalse(compile_filter('ID=1')('CIRC', CIRC))
+        self.assertTrue(compile_filter('STATUS=BUILT')('CIRC', CIRC))
+        self.assertTrue(compile_filter('STATUS in (NEW, NEWRESOLVE)')('STREAM', STREAM))
+
+    def test_in(self):
+        self.assertTrue(compile_filter('PURPOSE in (GENERAL, HS_SERVICE_REND)')('CIRC', CIRC))
+        self.assertFalse(compile_filter('PURPOSE not in (GENERAL, HS_SERVICE_REND)')('CIRC', CIRC))
+        self.assertTrue(compile_filter('PURPOSE not in (GENERAL)')('CIRC', CIRC))
+
+    def test_event(self):
+        self.assertTrue(compile_filter('EVENT=circ')('CIRC', CIRC))
+        self.assertFalse(compile_filter('EVENT!=CIRC')('CIRC', CIRC))
+        self.assertTrue(compile_filter('EVENT in (STREAM, CIRC)')('CIRC', CIRC))
+        self.assertTrue(compile_filter('EVENT~^CI')('CIRC', CIRC))
+
+    def test_regex_on_value(self):
+        self.assertTrue(compile_filter('SOURCE_ADDR~^127\\.')('STREAM', STREAM))
+        self.assertFalse(compile_filter('SOURCE_ADDR~^10\\.')('STREAM', STREAM))
+        self.assertFalse(compile_filter('MISSING~.*')('STREAM', STREAM))
+
+    def test_regex_anywhere(self):
+        self.assertTrue(compile_filter('/example\\.com/')('STREAM', STREAM))
+        self.assertFalse(compile_filter('/example\\.org/')('STREAM', STREAM))
+
+    def test_literal_value(self):
+        # "." in a value isn't a wildcard
+        self.assertFalse(compile_filter('SOURCE_ADDR=127x0.0.1:5432')('STREAM', STREAM))
+
+    def test_errors(self):
+        self.assertRaises(FilterError, compile_filter, 'PURPOSE')
+        self.assertRaises(FilterError, compile_filter, 'PURPOSE in ()')
+        self.assertRaises(FilterError, compile_filter, 'PURPOSE~(')
+        self.assertRaises(FilterError, compile_filter, '/(/')
+
+
+class CompileFiltersTests(unittest.TestCase):
+
+    def test_none(self):
+        self.assertIsNone(compile_filters([]))
+
+    def test_all_must_match(self):
+        matches = compile_filters(['EVENT=CIRC', 'STATUS=BUILT'])
+        self.assertTrue(matches('CIRC', CIRC))
+        self.assertFalse(matches('STREAM', STREAM))
+        self.assertFalse(compile_filters(['EVENT=CIRC', 'STATUS=FAILED'])('CIRC', CIRC))
+
+
+class KeywordFinderTests(unittest.TestCase):
+
+    def test_find(self):
+        self.assertEqual('HSSR_JOINED', keyword_finder('HS_STATE')(CIRC))
+        self.assertEqual('Done here', keyword_finder('summary')(QUOTED))
+        self.assertEqual('7', keyword_finder('ID')(STREAM))
+        self.assertEqual('NEW', keyword_finder('STATUS')(STREAM))
+        self.assertIsNone(keyword_finder('REASON')(STREAM))
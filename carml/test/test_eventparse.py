@@ -0,0 +1,118 @@
+from twisted.trial import unittest
+
+from carml import eventparse
+from carml.eventparse import parse, parse_keywords
+
+
+FP1 = '$' + 'A' * 40
+FP2 = '$' + 'B' * 40
+
+
+class ParseTests(unittest.TestCase):
+
+    def test_circ(self):
+        event = parse('CIRC', '12 BUILT {}~one,{}=two PURPOSE=GENERAL TIME_CREATED=2024-01-01T00:00:00'.format(FP1, FP2))
+        self.assertIsInstance(event, eventparse.CircEvent)
+        self.assertEqual(12, event.id)
+        self.assertEqual('BUILT', event.status)
+        self.assertEqual([(FP1, 'one'), (FP2, 'two')], event.path)
+        self.assertEqual('GENERAL', event.purpose)
+        self.assertIsNone(event.reason)
+
+    def test_circ_no_path(self):
+        event = parse('CIRC', '12 LAUNCHED PURPOSE=GENERAL')
+        self.assertEqual([], event.path)
+        self.assertEqual('GENERAL', event.purpose)
+
+    def test_circ_bare_fingerprints(self):
+        event = parse('CIRC', '3 EXTENDED {}'.format(FP1))
+        self.assertEqual([(FP1, None)], event.path)
+
+    def test_circ_failed(self):
+        event = parse('CIRC', '12 FAILED {} PURPOSE=GENERAL REASON=TIMEOUT REMOTE_REASON=DESTROYED'.format(FP1))
+        self.assertEqual('TIMEOUT', event.reason)
+        self.assertEqual('DESTROYED', event.get('REMOTE_REASON'))
+
+    def test_stream(self):
+        event = parse('STREAM', '7 SUCCEEDED 12 www.example.com:443 SOURCE_ADDR=127.0.0.1:5432 PURPOSE=USER')
+        self.assertIsInstance(event, eventparse.StreamEvent)
+        self.assertEqual(7, event.id)
+        self.assertEqual('SUCCEEDED', event.status)
+        self.assertEqual(12, event.circuit_id)
+        self.assertEqual('www.example.com', event.target_host)
+        self.assertEqual(443, event.target_port)
+        self.assertEqual('127.0.0.1:5432', event.get('SOURCE_ADDR'))
+
+    def test_stream_ipv6_target(self):
+        event = parse('STREAM', '7 NEW 0 [::1]:80')
+        self.assertEqual('[::1]', event.target_host)
+        self.assertEqual(80, event.target_port)
+
+    def test_bw(self):
+        event = parse('BW', '100 200')
+        self.assertEqual((100, 200), (event.read, event.written))
+
+    def test_stream_bw(self):
+        event = parse('STREAM_BW', '7 300 200 2024-01-01T00:00:00.000000')
+        self.assertEqual((7, 300, 200), (event.stream_id, event.written, event.read))
+
+    def test_circ_bw(self):
+        event = parse('CIRC_BW', 'ID=12 READ=300 WRITTEN=200 TIME=2024-01-01T00:00:00')
+        self.assertEqual((12, 300, 200), (event.id, event.read, event.written))
+        event = parse('CONN_BW', 'ID=4 TYPE=OR READ=0 WRITTEN=1')
+        self.assertIsInstance(event, eventparse.CircBwEvent)
+
+    def test_other(self):
+        event = parse('GUARD', 'ENTRY {} GOOD'.format(FP1))
+        self.assertIs(eventparse.Event, type(event))
+        self.assertEqual({}, event.keywords)
+
+    def test_invalid(self):
+        for name, text in [('CIRC', 'x BUILT'), ('CIRC', '12'), ('STREAM', '7'), ('BW', '1'), ('STREAM_BW', '7 x 1')]:
+            self.assertRaises(ValueError, parse, name, text)
+
+
+class GetTests(unittest.TestCase):
+
+    def test_whole_word(self):
+        event = eventparse.Event('CIRC_ID=5 ID=6')
+        self.assertEqual('6', event.get('ID'))
+        self.assertEqual('5', event.get('CIRC_ID'))
+
+    def test_missing(self):
+        event = eventparse.Event('CIRC_ID=5')
+        self.assertIsNone(event.get('ID'))
+        self.assertEqual('x', event.get('ID', 'x'))
+
+    def test_quoted(self):
+        event = eventparse.Event('TAG=done SUMMARY="Done ID=1" ID=2')
+        self.assertEqual('2', event.get('ID'))
+        self.assertEqual('Done ID=1', event.get('SUMMARY'))
+
+    def test_same_as_keywords(self):
+        text = 'A=1 BB=2 C= D=x=y'
+        event = eventparse.Event(text)
+        for key, value in parse_keywords(text).items():
+            self.assertEqual(value, eventparse.Event(text).get(key))
+        self.assertEqual({'A': '1', 'BB': '2', 'C': '', 'D': 'x=y'}, event.keywords)
+
+
+class ParseKeywordsTests(unittest.TestCase):
+
+    def test_plain(self):
+        self.assertEqual({'A': '1', 'B': '2'}, parse_keywords('word A=1 other B=2'))
+
+    def test_quoted(self):
+        self.assertEqual(
+            {'SUMMARY': 'Done "now"\\', 'TAG': 'done'},
+            parse_keywords('TAG=done SUMMARY="Done \\"now\\"\\\\"'),
+        )
+
+    def test_quoted_then_plain(self):
+        self.assertEqual(
+            {'A': 'x y', 'B': '2'},
+            parse_keywords('  first A="x y" second B=2'),
+        )
+
+    def test_unterminated(self):
+        self.assertEqual({'A': 'x y'}, parse_keywords('A="x y'))
@@ -0,0 +1,139 @@
+import os
+import time
+import zlib
+
+from twisted.trial import unittest
+
+from carml import eventstore
+from carml.eventstore import EventCapture, EventCaptureWriter, parse_time
+
+
+class EventCaptureTests(unittest.TestCase):
+
+    def setUp(self):
+        self.path = os.path.abspath(self.mktemp())
+        self.events = []
+        for n in range(100):
+            evt = 'CIRC' if n % 2 else 'STREAM'
+            self.events.append((1000.0 + n, evt, '{} {} BUILT'.format(evt, n)))
+
+    def write(self, events=None, close=True, **kw):
+        f = open(self.path, 'wb')
+        writer = EventCaptureWriter(f, **kw)
+        for when, evt, text in self.events if events is None else events:
+            writer.record(evt, text, when)
+        if close:
+            writer.close()
+        else:
+            # as if we crashed just after writing these out
+            writer.flush()
+            f.close()
+        return writer
+
+    def read(self):
+        f = open(self.path, 'rb')
+        self.addCleanup(f.close)
+        return EventCapture(f)
+
+    def test_round_trip(self):
+        self.write(chunk_size=1024)
+        capture = self.read()
+        self.assertTrue(len(capture.chunks) > 1)
+        self.assertEqual(self.events, list(capture.events()))
+
+    def test_unicode(self):
+        events = [(1.0, 'INFO', 'caf\N{LATIN SMALL LETTER E WITH ACUTE}')]
+        self.write(events)
+        self.assertEqual(events, list(self.read().events()))
+
+    def test_index_matches_scan(self):
+        self.write(chunk_size=1024)
+        capture = self.read()
+        scanned = list(capture._scan_chunks())
+        self.assertEqual(
+            [(c.offset, c.size, c.count, c.types, c.first, c.last) for c in capture.chunks],
+            [(c.offset, c.size, c.count, c.types, c.first, c.last) for c in scanned],
+        )
+
+    def test_crash_recovery(self):
+        self.write(chunk_size=1024, close=False)
+        self.assertEqual(self.events, list(self.read().events()))
+
+    def test_truncated_chunk(self):
+        self.write(chunk_size=1024, close=False)
+        complete = self.read().chunks
+        with open(self.path, 'r+b') as f:
+            f.truncate(os.path.getsize(self.path) - 10)
+        capture = self.read()
+        self.assertEqual(len(complete) - 1, len(capture.chunks))
+        self.assertEqual(
+            self.events[:sum(c.count for c in capture.chunks)],
+            list(capture.events()),
+        )
+
+    def test_since_until(self):
+        self.write(chunk_size=1024)
+        self.assertEqual(
+            [e for e in self.events if 1020 <= e[0] <= 1030],
+            list(self.read().events(since=1020, until=1030)),
+        )
+
+    def test_types(self):
+        self.write(chunk_size=1024)
+        self.assertEqual(
+            [e for e in self.events if e[1] == 'CIRC'],
+            list(self.read().events(types=['CIRC'])),
+        )
+
+    def test_skips_chunks(self):
+        events = [(1000.0 + n, 'CIRC' if n < 50 else 'STREAM', 'x' * 100) for n in range(100)]
+        self.write(events, chunk_size=1024)
+        capture = self.read()
+        decompressed = []
+        real_decompress = zlib.decompress
+
+        def decompress(data):
+            decompressed.append(data)
+            return real_decompress(data)
+        self.patch(eventstore.zlib, 'decompress', decompress)
+        found = list(capture.events(since=1090))
+        self.assertEqual(events[90:], found)
+        self.assertEqual(1, len(decompressed))
+        del decompressed[:]
+        self.assertEqual(events[:50], list(capture.events(types=['CIRC'])))
+        self.assertEqual(len([c for c in capture.chunks if 'CIRC' in c.types]), len(decompressed))
+
+    def test_many_types(self):
+        events = [(float(n), 'EVENT{}'.format(n), str(n)) for n in range(300)]
+        self.write(events)
+        capture = self.read()
+        self.assertEqual(2, len(capture.chunks))
+        self.assertEqual(events, list(capture.events()))
+
+    def test_not_a_capture(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'something else\n')
+        self.assertRaises(RuntimeError, self.read)
+
+    def test_empty(self):
+        self.write([])
+        self.assertEqual([], self.read().chunks)
+
+
+class ParseTimeTests(unittest.TestCase):
+
+    def test_epoch(self):
+        self.assertEqual(1700000000.5, parse_time('1700000000.5'))
+
+    def test_iso(self):
+        self.assertEqual(
+            time.mktime((2024, 1, 2, 3, 12, 0, 0, 0, -1)),
+            parse_time('2024-01-02 03:12'),
+        )
+
+    def test_today(self):
+        now = time.mktime((2024, 1, 2, 15, 0, 0, 0, 0, -1))
+        self.assertEqual(time.mktime((2024, 1, 2, 3, 12, 30, 0, 0, -1)), parse_time('03:12:30', now))
+
+    def test_bad(self):
+        self.assertRaises(ValueError, parse_time, 'yesterday')
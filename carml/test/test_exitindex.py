@@ -0,0 +1,161 @@
+import base64
+
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from carml.exitindex import ExitIndex, ExitPolicy, _parse_consensus
+
+
+class Location(object):
+
+    def __init__(self, countrycode):
+        self.countrycode = countrycode
+
+
+class FakeRouter(object):
+
+    def __init__(self, n, ip, country=None):
+        self.id_hex = '$' + ('%02X' % n) * 20
+        self.ip = ip
+        self.name = 'relay%d' % n
+        self._location = Location(country) if country else None
+
+    @property
+    def location(self):
+        raise AssertionError("Router.location asks Tor about each router")
+
+
+class FakeProtocol(object):
+
+    def __init__(self, countries):
+        self.countries = countries
+        self.asked = []
+
+    def get_info(self, *keys):
+        self.asked.append(keys)
+        return defer.succeed({
+            key: self.countries.get(key.split('/', 1)[1], '??')
+            for key in keys
+        })
+
+
+class FakeState(object):
+
+    def __init__(self, routers, countries):
+        self.routers_by_hash = {router.id_hex: router for router in routers}
+        self.protocol = FakeProtocol(countries)
+        self.entry_guards = {}
+
+
+def consensus_entry(router, flags, policy=None):
+    ident = base64.b64encode(bytes.fromhex(router.id_hex[1:])).decode('ascii').rstrip('=')
+    lines = [
+        'r {} {} digest 2024-01-01 00:00:00 {} 9001 0'.format(router.name, ident, router.ip),
+        's ' + flags,
+    ]
+    if policy is not None:
+        lines.append('p ' + policy)
+    return '\n'.join(lines)
+
+
+class ExitPolicyTests(unittest.TestCase):
+
+    def test_accept(self):
+        policy = ExitPolicy('accept 80,443,6660-6669')
+        self.assertTrue(policy.accepts(443))
+        self.assertTrue(policy.accepts(6665))
+        self.assertFalse(policy.accepts(22))
+        self.assertTrue(policy.accepts(None))
+
+    def test_reject(self):
+        policy = ExitPolicy('reject 25,119')
+        self.assertFalse(policy.accepts(25))
+        self.assertTrue(policy.accepts(22))
+
+    def test_reject_everything(self):
+        self.assertFalse(ExitPolicy('reject 1-65535').accepts(None))
+
+    def test_not_a_policy(self):
+        self.assertRaises(ValueError, ExitPolicy, 'allow 80')
+
+
+class ExitIndexTests(unittest.TestCase):
+
+    def setUp(self):
+        self.de = FakeRouter(1, '10.0.0.1', 'de')
+        self.nl = FakeRouter(2, '10.0.0.2')
+        self.se = FakeRouter(3, '10.0.0.3')
+        self.guard = FakeRouter(4, '10.0.0.4')
+        self.state = FakeState(
+            [self.de, self.nl, self.se, self.guard],
+            {'10.0.0.2': 'nl', '10.0.0.3': 'se'},
+        )
+        self.consensus = '\n'.join([
+            consensus_entry(self.de, 'Exit Fast Running Valid', 'accept 443'),
+            consensus_entry(self.nl, 'Exit Fast Running Valid', 'reject 25'),
+            consensus_entry(self.se, 'Exit BadExit Running Valid'),
+            consensus_entry(self.guard, 'Fast Guard Running Valid', 'reject 1-65535'),
+        ])
+
+    def test_parse_consensus(self):
+        parsed = list(_parse_consensus(self.consensus))
+        self.assertEqual([self.de.id_hex, self.nl.id_hex, self.se.id_hex, self.guard.id_hex], [p[0] for p in parsed])
+        self.assertIn('exit', parsed[0][1])
+        self.assertTrue(parsed[0][2].accepts(443))
+        self.assertIsNone(parsed[2][2])
+
+    @defer.inlineCallbacks
+    def test_build(self):
+        index = ExitIndex(self.state)
+        yield index.build(self.consensus)
+        self.assertEqual({'DE': 1, 'NL': 1}, index.countries())
+        self.assertEqual((self.de,), index.exits(('DE',), 443))
+        self.assertEqual((), index.exits(('DE',), 22))
+        self.assertEqual((self.nl,), index.exits(('NL',), 22))
+        self.assertEqual([self.guard], index.guards)
+        self.assertEqual('NL', index.country(self.nl))
+        self.assertEqual('??', index.country(self.guard))
+
+    @defer.inlineCallbacks
+    def test_one_lookup_for_unknown_countries(self):
+        index = ExitIndex(self.state)
+        yield index.build(self.consensus)
+        # only the exit txtorcon didn't know the country of (the bad
+        # exit isn't used)
+        self.assertEqual([('ip-to-country/10.0.0.2',)], self.state.protocol.asked)
+
+    @defer.inlineCallbacks
+    def test_countries_kept_for_next_consensus(self):
+        index = ExitIndex(self.state)
+        yield index.build(self.consensus)
+        yield index.build(self.consensus)
+        self.assertEqual(1, len(self.state.protocol.asked))
+        self.assertEqual('NL', index.country(self.nl))
+
+    @defer.inlineCallbacks
+    def test_batches(self):
+        routers = [FakeRouter(n, '10.0.1.%d' % n) for n in range(1, 21)]
+        state = FakeState(routers, {})
+        index = ExitIndex(state)
+        index.BATCH = 8
+        yield index.build('\n'.join(consensus_entry(r, 'Exit Running Valid') for r in routers))
+        self.assertEqual([8, 8, 4], [len(keys) for keys in state.protocol.asked])
+        self.assertEqual({'??': 20}, index.countries())
+
+    @defer.inlineCallbacks
+    def test_is_suitable(self):
+        index = ExitIndex(self.state)
+        yield index.build(self.consensus)
+        self.assertTrue(index.is_suitable(self.de, ('DE', 'NL'), 443))
+        self.assertFalse(index.is_suitable(self.de, ('DE', 'NL'), 80))
+        self.assertFalse(index.is_suitable(self.nl, ('DE',), 443))
+        self.assertFalse(index.is_suitable(self.guard, ('??',), 443))
+
+    @defer.inlineCallbacks
+    def test_exits_cached_until_next_consensus(self):
+        index = ExitIndex(self.state)
+        yield index.build(self.consensus)
+        first = index.exits(('DE', 'NL'), 443)
+        self.assertIs(first, index.exits(('DE', 'NL'), 443))
+        yield index.build(self.consensus)
+        self.assertIsNot(first, index.exits(('DE', 'NL'), 443))
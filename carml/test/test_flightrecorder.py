@@ -0,0 +1,100 @@
+import random
+
+from twisted.trial import unittest
+
+from carml.flightrecorder import RingBuffer, RateTrigger, RECORD
+
+
+TYPES = ['CIRC', 'STREAM']
+
+
+class RingBufferTests(unittest.TestCase):
+
+    def test_empty(self):
+        ring = RingBuffer(1024, TYPES)
+        self.assertEqual([], list(ring.records()))
+        self.assertIsNone(ring.oldest())
+
+    def test_records(self):
+        ring = RingBuffer(1024, TYPES)
+        ring.append('CIRC', b'1 BUILT', 1.0)
+        ring.append('STREAM', b'2 NEW', 2.0)
+        self.assertEqual([(1.0, 'CIRC', '1 BUILT'), (2.0, 'STREAM', '2 NEW')], list(ring.records()))
+        self.assertEqual(1.0, ring.oldest())
+
+    def test_oldest_overwritten(self):
+        size = 10 * (RECORD.size + 10)
+        ring = RingBuffer(size, TYPES)
+        for n in range(25):
+            self.assertTrue(ring.append('CIRC', b'%010d' % n, float(n)))
+        records = list(ring.records())
+        self.assertEqual((24.0, 'CIRC', '%010d' % 24), records[-1])
+        self.assertEqual([float(n) for n in range(25 - len(records), 25)], [r[0] for r in records])
+        self.assertTrue(len(records) >= 9)
+
+    def test_too_big(self):
+        ring = RingBuffer(100, TYPES)
+        ring.append('CIRC', b'small', 1.0)
+        self.assertFalse(ring.append('CIRC', b'x' * 100, 2.0))
+        self.assertEqual([(1.0, 'CIRC', 'small')], list(ring.records()))
+
+    def test_forget_before(self):
+        ring = RingBuffer(1024, TYPES)
+        for n in range(10):
+            ring.append('CIRC', b'x', float(n))
+        ring.forget_before(7.0)
+        self.assertEqual([7.0, 8.0, 9.0], [r[0] for r in ring.records()])
+        ring.forget_before(100.0)
+        self.assertEqual(0, ring.count)
+        # and it still works after being emptied
+        ring.append('STREAM', b'y', 101.0)
+        self.assertEqual([(101.0, 'STREAM', 'y')], list(ring.records()))
+
+    def test_too_many_types(self):
+        self.assertRaises(ValueError, RingBuffer, 1024, ['E{}'.format(n) for n in range(255)])
+
+    def test_random(self):
+        """
+        Whatever the sizes, we always have the most recent records, in
+        order, and never more than fit.
+        """
+        rng = random.Random(1)
+        for size in (64, 100, 257, 1000, 4096):
+            ring = RingBuffer(size, TYPES)
+            appended = []
+            for n in range(2000):
+                data = b'z' * rng.randint(0, size // 2 - RECORD.size)
+                event = rng.choice(TYPES)
+                self.assertTrue(ring.append(event, data, float(n)))
+                appended.append((float(n), event, data.decode('ascii')))
+                records = list(ring.records())
+                self.assertEqual(ring.count, len(records))
+                self.assertEqual(appended[-len(records):], records)
+                self.assertTrue(sum(RECORD.size + len(r[2]) for r in records) <= size)
+                self.assertEqual(records[0][0], ring.oldest())
+
+
+class RateTriggerTests(unittest.TestCase):
+
+    def test_fires_over_threshold(self):
+        trigger = RateTrigger(3, 10)
+        self.assertEqual([False, False, False, True], [trigger.hit(100.0 + n) for n in range(4)])
+
+    def test_window(self):
+        trigger = RateTrigger(3, 10)
+        # one every four seconds never has more than three in ten
+        self.assertFalse(any(trigger.hit(100.0 + 4 * n) for n in range(20)))
+
+    def test_quiet_after_firing(self):
+        trigger = RateTrigger(1, 5)
+        self.assertFalse(trigger.hit(100.0))
+        self.assertTrue(trigger.hit(100.5))
+        self.assertFalse(trigger.hit(101.0))
+        self.assertFalse(trigger.hit(104.0))
+        self.assertTrue(trigger.hit(105.5))
+
+    def test_long_gap(self):
+        trigger = RateTrigger(2, 5)
+        trigger.hit(100.0)
+        trigger.hit(100.0)
+        self.assertFalse(trigger.hit(1000.0))
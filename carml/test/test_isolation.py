@@ -0,0 +1,161 @@
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from carml.isolation import IsolationAttacher, Policy, LatencyStats, _domain
+
+
+class FakeRouter(object):
+    name_is_unique = True
+
+    def __init__(self, name):
+        self.name = name
+
+
+class FakeCircuit(object):
+    state = 'BUILT'
+
+    def __init__(self, circ_id):
+        self.id = circ_id
+        self.path = [FakeRouter('guard'), FakeRouter('middle'), FakeRouter('exit')]
+
+
+class FakeStream(object):
+
+    def __init__(self, stream_id, key, host='www.example.com'):
+        self.id = stream_id
+        self.key = key
+        self.target_host = host
+        self.target_port = 443
+        self.flags = {}
+
+
+class FakePool(object):
+    """
+    Hands out new circuits when we say so.
+    """
+
+    def __init__(self):
+        self.waiting = []
+        self.released = []
+        self._next_id = 1
+
+    def take(self):
+        d = defer.Deferred()
+        self.waiting.append(d)
+        return d
+
+    def build(self):
+        circ = FakeCircuit(self._next_id)
+        self._next_id += 1
+        self.waiting.pop(0).callback(circ)
+        return circ
+
+    def release(self, circ):
+        self.released.append(circ)
+
+
+BY_KEY = Policy('test', lambda stream, state: stream.key, 1, None, 'key')
+
+
+class IsolationAttacherTests(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = FakePool()
+        self.logged = []
+        self.attacher = IsolationAttacher(None, None, self.pool, BY_KEY, log=self.logged.append)
+
+    def attach(self, stream):
+        results = []
+        d = defer.maybeDeferred(self.attacher.attach_stream, stream, {})
+        d.addBoth(results.append)
+        return results
+
+    def test_same_key_same_circuit(self):
+        first = self.attach(FakeStream(1, 'a'))
+        second = self.attach(FakeStream(2, 'a'))
+        other = self.attach(FakeStream(3, 'b'))
+        circ_a = self.pool.build()
+        circ_b = self.pool.build()
+        self.assertEqual([circ_a], first)
+        self.assertEqual([circ_a], second)
+        self.assertEqual([circ_b], other)
+        # once it's there, straight away
+        self.assertEqual([circ_a], self.attach(FakeStream(4, 'a')))
+        self.assertEqual(4, self.attacher.stats.count)
+
+    def test_no_key_is_isolated_too(self):
+        unknown = self.attach(FakeStream(1, None))
+        known = self.attach(FakeStream(2, 'a'))
+        circ_none = self.pool.build()
+        circ_a = self.pool.build()
+        self.assertEqual([circ_none], unknown)
+        self.assertEqual([circ_a], known)
+        self.assertEqual([circ_none], self.attach(FakeStream(3, None)))
+        self.assertTrue(any('no key' in line for line in self.logged))
+
+    def test_one_failure_does_not_spoil_the_rest(self):
+        first = self.attach(FakeStream(1, 'a'))
+        second = self.attach(FakeStream(2, 'a'))
+
+        def log(msg):
+            if 'stream 1 ' in msg:
+                raise RuntimeError("boom")
+        self.attacher._log = log
+        circ = self.pool.build()
+        self.assertEqual(1, len(first))
+        first[0].trap(RuntimeError)
+        self.assertEqual([circ], second)
+        self.assertEqual([circ], self.attach(FakeStream(3, 'a')))
+
+    def test_released_when_streams_gone(self):
+        stream = FakeStream(1, 'a')
+        self.attach(stream)
+        circ = self.pool.build()
+        self.attacher.stream_closed(stream)
+        self.assertEqual([circ], self.pool.released)
+        # and the next stream for 'a' gets a new circuit
+        self.attach(FakeStream(2, 'a'))
+        self.assertEqual(1, len(self.pool.waiting))
+
+    def test_circuit_closed(self):
+        self.attach(FakeStream(1, 'a'))
+        circ = self.pool.build()
+        self.attacher.circuit_closed(circ)
+        self.attach(FakeStream(2, 'a'))
+        self.assertEqual(1, len(self.pool.waiting))
+
+    def test_directory_streams_left_alone(self):
+        stream = FakeStream(1, 'a')
+        stream.flags['PURPOSE'] = 'DIR_FETCH'
+        self.assertEqual([None], self.attach(stream))
+
+
+class DomainTests(unittest.TestCase):
+
+    def key(self, host):
+        return _domain(FakeStream(1, None, host), None)
+
+    def test_site(self):
+        self.assertEqual('example.com', self.key('www.example.com'))
+        self.assertEqual('example.com', self.key('CDN.Example.COM.'))
+
+    def test_whole(self):
+        self.assertEqual('1.2.3.4', self.key('1.2.3.4'))
+        self.assertEqual('abcdef.onion', self.key('abcdef.onion'))
+        self.assertIs(None, self.key(None))
+
+
+class LatencyStatsTests(unittest.TestCase):
+
+    def test_summary(self):
+        stats = LatencyStats(keep=100)
+        for ms in range(1, 101):
+            stats.add(ms / 1000.0)
+        summary = stats.summary()
+        self.assertEqual(100, summary['count'])
+        self.assertAlmostEqual(50.5, summary['mean_ms'])
+        self.assertAlmostEqual(51.0, summary['p50_ms'])
+        self.assertAlmostEqual(100.0, summary['max_ms'])
+
+    def test_empty(self):
+        self.assertEqual(0.0, LatencyStats().summary()['p99_ms'])
@@ -0,0 +1,154 @@
+import txtorcon
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from carml.loadbalance import LoadBalancer
+
+
+class FakeRouter(object):
+    name_is_unique = True
+
+    def __init__(self, name):
+        self.name = name
+
+
+class FakeCircuit(object):
+
+    def __init__(self, circ_id):
+        self.id = circ_id
+        self.state = 'BUILT'
+        self.path = [FakeRouter('guard'), FakeRouter('middle'), FakeRouter('exit')]
+
+
+class FakeStream(object):
+    state = 'NEW'
+    target_host = 'www.example.com'
+    target_port = 443
+
+    def __init__(self, stream_id):
+        self.id = stream_id
+        self.flags = {}
+
+
+class FakeProtocol(object):
+
+    def __init__(self, valid_events):
+        self.valid_events = valid_events
+        self.listeners = {}
+
+    def add_event_listener(self, name, callback):
+        self.listeners[name] = callback
+        return defer.succeed(None)
+
+
+class FakeState(object):
+
+    def __init__(self, valid_events=('CIRC_BW', 'STREAM_BW')):
+        self.protocol = FakeProtocol(valid_events)
+        self.attacher = None
+
+    def add_stream_listener(self, listener):
+        pass
+
+    def add_circuit_listener(self, listener):
+        pass
+
+    def set_attacher(self, attacher, reactor):
+        self.attacher = attacher
+        return defer.succeed(None)
+
+
+class FakePool(object):
+
+    def __init__(self):
+        self.started = False
+        self.waiting = []
+
+    def start(self):
+        self.started = True
+
+    def take(self):
+        d = defer.Deferred()
+        self.waiting.append(d)
+        return d
+
+
+class LoadBalancerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        self.circuits = [FakeCircuit(1), FakeCircuit(2)]
+        self.logged = []
+
+    def balancer(self, pool=None, valid_events=('CIRC_BW', 'STREAM_BW'), **kw):
+        self.state = FakeState(valid_events)
+        balancer = LoadBalancer(
+            self.state, None, pool, self.circuits,
+            log=self.logged.append, clock=lambda: self.now, **kw
+        )
+        self.successResultOf(balancer.start())
+        return balancer
+
+    def test_least_loaded(self):
+        balancer = self.balancer()
+        self.state.protocol.listeners['CIRC_BW']('ID=1 READ=100000 WRITTEN=0')
+        self.assertIs(self.circuits[1], balancer.attach_stream(FakeStream(10), {}))
+        # the new stream counts for something; but not 100000 bytes
+        self.assertIs(self.circuits[1], balancer.attach_stream(FakeStream(11), {}))
+
+    def test_spread(self):
+        balancer = self.balancer()
+        chosen = [balancer.attach_stream(FakeStream(n), {}).id for n in range(4)]
+        self.assertEqual([1, 2, 1, 2], chosen)
+
+    def test_load_decays(self):
+        balancer = self.balancer()
+        self.state.protocol.listeners['CIRC_BW']('ID=1 READ=1000 WRITTEN=0')
+        self.now += LoadBalancer.HALF_LIFE
+        self.assertAlmostEqual(500.0, balancer.load(1))
+
+    def test_stream_bw(self):
+        balancer = self.balancer(valid_events=('STREAM_BW',))
+        circ = balancer.attach_stream(FakeStream(10), {})
+        self.state.protocol.listeners['STREAM_BW']('10 300 200')
+        self.assertEqual(500 + LoadBalancer.STREAM_COST, balancer.load(circ.id))
+
+    def test_bad_events(self):
+        balancer = self.balancer()
+        for text in ['', 'READ=1', 'ID=x READ=1', 'ID=1 READ=lots']:
+            balancer._circ_bw(text)
+        for text in ['', '10', '10 x 1']:
+            balancer._stream_bw(text)
+        self.assertEqual(0, balancer.load(1))
+
+    def test_no_pool(self):
+        balancer = self.balancer()
+        balancer.circuit_closed(self.circuits[0], REASON='FINISHED')
+        self.assertIs(self.circuits[1], balancer.attach_stream(FakeStream(10), {}))
+        balancer.circuit_closed(self.circuits[1], REASON='FINISHED')
+        self.assertEqual(txtorcon.TorState.DO_NOT_ATTACH, balancer.attach_stream(FakeStream(11), {}))
+
+    def test_replaced_from_pool(self):
+        pool = FakePool()
+        balancer = self.balancer(pool)
+        self.assertTrue(pool.started)
+        self.assertEqual([], pool.waiting)
+        balancer.circuit_closed(self.circuits[0], REASON='FINISHED')
+        balancer.circuit_closed(self.circuits[1], REASON='FINISHED')
+        d = balancer.attach_stream(FakeStream(10), {})
+        self.assertNoResult(d)
+        replacement = FakeCircuit(3)
+        pool.waiting[0].callback(replacement)
+        self.assertIs(replacement, self.successResultOf(d))
+
+    def test_auto(self):
+        self.circuits = []
+        pool = FakePool()
+        self.balancer(pool, wanted=4)
+        self.assertEqual(4, len(pool.waiting))
+
+    def test_directory_streams(self):
+        balancer = self.balancer()
+        stream = FakeStream(10)
+        stream.flags['PURPOSE'] = 'DIR_FETCH'
+        self.assertIsNone(balancer.attach_stream(stream, {}))
@@ -0,0 +1,87 @@
+import io
+import os
+
+from twisted.internet import task
+from twisted.trial import unittest
+
+from carml.output import OutputSink
+
+
+class OutputSinkTests(unittest.TestCase):
+
+    def setUp(self):
+        read_fd, write_fd = os.pipe()
+        self.reader = os.fdopen(read_fd, 'rb')
+        self.stream = os.fdopen(write_fd, 'w')
+        self.addCleanup(self.reader.close)
+        self.addCleanup(self.stream.close)
+        os.set_blocking(read_fd, False)
+        self.clock = task.Clock()
+
+    def read(self):
+        try:
+            return self.reader.read() or b''
+        except BlockingIOError:
+            return b''
+
+    def sink(self, **kw):
+        return OutputSink(self.stream, reactor=self.clock, **kw)
+
+    def test_passthrough(self):
+        out = io.StringIO()
+        sink = OutputSink(out)
+        self.assertTrue(sink.passthrough)
+        sink.write('hello\n')
+        self.assertEqual('hello\n', out.getvalue())
+
+    def test_buffered_until_timer(self):
+        sink = self.sink()
+        self.assertFalse(sink.passthrough)
+        sink.write('one\n')
+        sink.write('two\n')
+        sink.flush()
+        self.assertEqual(b'', self.read())
+        self.clock.advance(0.1)
+        self.assertEqual(b'one\ntwo\n', self.read())
+
+    def test_buffer_full(self):
+        sink = self.sink(buffer_size=10)
+        sink.write('12345\n')
+        self.assertEqual(b'', self.read())
+        sink.write('67890\n')
+        self.assertEqual(b'12345\n67890\n', self.read())
+
+    def test_close(self):
+        sink = self.sink()
+        sink.write('last\n')
+        sink.close()
+        self.assertEqual(b'last\n', self.read())
+        self.assertTrue(sink.passthrough)
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+    def test_encoding(self):
+        sink = self.sink()
+        sink.write('\N{SNOWMAN}\n')
+        sink.close()
+        self.assertEqual('\N{SNOWMAN}\n'.encode(sink.encoding), self.read())
+
+    def test_slow_reader(self):
+        sink = self.sink(buffer_size=1024)
+        line = 'x' * 1023 + '\n'
+        # more than the pipe holds; the rest waits for the reader
+        # rather than blocking us
+        for _ in range(1024):
+            sink.write(line)
+        self.assertTrue(sink._size > 0)
+        total = 0
+        while sink._size:
+            total += len(self.read())
+            self.clock.advance(0.1)
+        total += len(self.read())
+        self.assertEqual(1024 * 1024, total)
+
+    def test_blocking_restored(self):
+        # (stderr may share the open file with stdout)
+        sink = self.sink(buffer_size=10)
+        sink.write('12345678901\n')
+        self.assertTrue(os.get_blocking(self.stream.fileno()))
@@ -0,0 +1,133 @@
+import os
+import shutil
+import socket
+import tempfile
+
+from twisted.trial import unittest
+
+from carml.procindex import ProcessIndex, _socket_keys
+
+
+HEADER = '  sl  local_address rem_address   st tx_queue rx_queue tr tm->when retrnsmt   uid  timeout inode\n'
+
+
+class FakeProc(object):
+    """
+    Just enough of /proc for ProcessIndex: net/tcp, net/tcp6 and
+    <pid>/fd/ links to sockets.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.sockets = {}
+        os.mkdir(os.path.join(path, 'net'))
+        self._write_tables()
+
+    def _write_tables(self):
+        with open(os.path.join(self.path, 'net', 'tcp'), 'w') as f:
+            f.write(HEADER)
+            for n, (key, inode) in enumerate(self.sockets.items()):
+                f.write('  {}: {} 0100007F:2382 01 00000000:00000000 00:00000000 00000000  1000        0 {} 1 0\n'.format(n, key, inode))
+        with open(os.path.join(self.path, 'net', 'tcp6'), 'w') as f:
+            f.write(HEADER)
+
+    def connect(self, pid, port, inode):
+        """
+        Process `pid` opens a connection from 127.0.0.1:`port`.
+        """
+        self.sockets[_socket_keys('127.0.0.1', port)[0]] = inode
+        self._write_tables()
+        fd_dir = os.path.join(self.path, str(pid), 'fd')
+        if not os.path.exists(fd_dir):
+            os.makedirs(fd_dir)
+        os.symlink('socket:[{}]'.format(inode), os.path.join(fd_dir, str(len(os.listdir(fd_dir)) + 3)))
+
+
+class ProcessIndexTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.proc = FakeProc(self.dir)
+        self.now = 100.0
+        self.index = ProcessIndex(ttl=2.0, proc=self.dir, clock=lambda: self.now)
+
+    def test_lookup(self):
+        self.proc.connect(1234, 40000, 5001)
+        self.assertEqual(1234, self.index.lookup('127.0.0.1', 40000))
+
+    def test_unknown(self):
+        self.proc.connect(1234, 40000, 5001)
+        self.assertIs(None, self.index.lookup('127.0.0.1', 40001))
+
+    def test_new_connection_right_away(self):
+        # a connection made just after a lookup (with no time passing
+        # at all) is still found
+        self.proc.connect(1234, 40000, 5001)
+        self.assertEqual(1234, self.index.lookup('127.0.0.1', 40000))
+        self.proc.connect(1234, 40001, 5002)
+        self.assertEqual(1234, self.index.lookup('127.0.0.1', 40001))
+        self.proc.connect(99, 40002, 5003)
+        self.assertEqual(99, self.index.lookup('127.0.0.1', 40002))
+
+    def test_new_socket_in_old_process(self):
+        # a process that had no sockets at the last full scan
+        os.makedirs(os.path.join(self.dir, '7', 'fd'))
+        self.proc.connect(1234, 40000, 5001)
+        self.assertEqual(1234, self.index.lookup('127.0.0.1', 40000))
+        self.proc.connect(7, 40001, 5002)
+        self.assertEqual(7, self.index.lookup('127.0.0.1', 40001))
+
+    def test_burst(self):
+        for n in range(50):
+            self.proc.connect(1000 + n % 5, 41000 + n, 6000 + n)
+            self.assertEqual(1000 + n % 5, self.index.lookup('127.0.0.1', 41000 + n))
+
+    def test_invisible_owner_scanned_once(self):
+        # a socket whose process we can't see (e.g. another user's)
+        self.proc.sockets[_socket_keys('127.0.0.1', 40000)[0]] = 5001
+        self.proc._write_tables()
+        self.assertIs(None, self.index.lookup('127.0.0.1', 40000))
+        scans = []
+        self.index._scan_fds = lambda pids: scans.append(list(pids))
+        self.assertIs(None, self.index.lookup('127.0.0.1', 40000))
+        # not everything again
+        self.assertEqual([[], []], scans)
+
+    def test_bad_address(self):
+        self.assertIs(None, self.index.lookup('not an address', 80))
+        self.assertIs(None, self.index.lookup(None, 80))
+
+
+class SocketKeyTests(unittest.TestCase):
+
+    def test_ipv4(self):
+        keys = _socket_keys('127.0.0.1', 9050)
+        self.assertEqual(2, len(keys))
+        self.assertTrue(keys[0].endswith(':235A'))
+
+    def test_ipv6(self):
+        keys = _socket_keys('::1', 80)
+        self.assertEqual(1, len(keys))
+        self.assertEqual(32 + 5, len(keys[0]))
+
+    def test_ipv4_invalid(self):
+        self.assertRaises(OSError, _socket_keys, '300.1.2.3', 80)
+
+
+class RealProcTests(unittest.TestCase):
+
+    def setUp(self):
+        if not ProcessIndex.available():
+            raise unittest.SkipTest("no /proc")
+
+    def test_our_own_socket(self):
+        server = socket.socket()
+        self.addCleanup(server.close)
+        server.bind(('127.0.0.1', 0))
+        server.listen(5)
+        index = ProcessIndex()
+        for _ in range(3):
+            client = socket.create_connection(server.getsockname())
+            self.addCleanup(client.close)
+            self.assertEqual(os.getpid(), index.lookup(*client.getsockname()))
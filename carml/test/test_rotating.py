@@ -0,0 +1,117 @@
+import os
+import gzip
+import time
+
+from twisted.internet import task
+from twisted.trial import unittest
+
+from carml.rotating import RotatingOutput
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class Clock(task.Clock):
+
+    def __init__(self):
+        super(Clock, self).__init__()
+        self.triggers = []
+
+    def addSystemEventTrigger(self, phase, event, callable):
+        self.triggers.append((phase, event, callable))
+
+
+class RotatingOutputTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = os.path.abspath(self.mktemp())
+        os.mkdir(self.dir)
+        self.path = os.path.join(self.dir, 'events.log')
+        self.now = 1700000000.0
+        self.patch(time, 'time', lambda: self.now)
+
+    def read(self, path):
+        with open(path, 'rb') as f:
+            return f.read().decode('utf8')
+
+    def test_one_file(self):
+        out = RotatingOutput(self.path)
+        out.write('one\n')
+        out.write('two\n')
+        out.close()
+        self.assertEqual([self.path], out.segments)
+        self.assertEqual('one\ntwo\n', self.read(self.path))
+
+    def test_buffered(self):
+        out = RotatingOutput(self.path, buffer_size=8)
+        out.write('one\n')
+        self.assertEqual('', self.read(self.path))
+        out.write('two\n')
+        out.flush()
+        self.assertEqual('one\ntwo\n', self.read(self.path))
+        out.close()
+
+    def test_close_twice(self):
+        out = RotatingOutput(self.path)
+        out.close()
+        out.close()
+        self.assertTrue(out.closed)
+
+    def test_max_bytes(self):
+        out = RotatingOutput(self.path, max_bytes=8, buffer_size=1)
+        for n in range(5):
+            out.write('line {}\n'.format(n))
+        out.close()
+        # two lines each, all in the same second
+        self.assertEqual(
+            [self.path + '.' + time.strftime('%Y%m%d-%H%M%S', time.localtime(self.now)) + suffix
+             for suffix in ['', '.1', '.2']],
+            out.segments,
+        )
+        self.assertEqual(
+            ''.join('line {}\n'.format(n) for n in range(5)),
+            ''.join(self.read(path) for path in out.segments),
+        )
+
+    def test_max_age(self):
+        clock = Clock()
+        out = RotatingOutput(self.path, max_age=60, reactor=clock)
+        self.assertEqual([('before', 'shutdown', out.close)], clock.triggers)
+        out.write('old\n')
+        self.now += 30
+        clock.advance(30)
+        self.assertEqual(1, len(out.segments))
+        self.now += 30
+        clock.advance(30)
+        self.assertEqual(2, len(out.segments))
+        # nothing written, so no new segment
+        self.now += 60
+        clock.advance(60)
+        self.assertEqual(2, len(out.segments))
+        out.write('new\n')
+        out.close()
+        self.assertEqual(['old\n', 'new\n'], [self.read(path) for path in out.segments])
+        self.assertFalse(clock.getDelayedCalls())
+
+    def test_gzip(self):
+        out = RotatingOutput(self.path, max_bytes=1024 * 1024, compress='gzip')
+        out.write('compressed\n')
+        out.close()
+        [segment] = out.segments
+        self.assertTrue(segment.endswith('.gz'))
+        with gzip.open(segment, 'rb') as f:
+            self.assertEqual(b'compressed\n', f.read())
+
+    def test_zstd(self):
+        if zstandard is None:
+            raise unittest.SkipTest('needs zstandard')
+        out = RotatingOutput(self.path, max_bytes=1024 * 1024, compress='zstd')
+        out.write('compressed\n')
+        out.close()
+        [segment] = out.segments
+        self.assertTrue(segment.endswith('.zst'))
+        with open(segment, 'rb') as f:
+            reader = zstandard.ZstdDecompressor().stream_reader(f)
+            self.assertEqual(b'compressed\n', reader.read())